@@ -0,0 +1,67 @@
+"""Measure the memory allocated while preparing the binary data arrays of a
+large profile spectrum, comparing the current encoding path against the
+copy-heavy path it replaced.
+
+Usage::
+
+    python benchmarks/binary_encoding.py [n_points] [n_spectra]
+"""
+import base64
+import sys
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+
+from psims.mzml.binary_encoding import encode_array, COMPRESSION_ZLIB
+
+
+def legacy_prepare_array(array, compression=COMPRESSION_ZLIB, dtype=np.float64):
+    array = np.array(array, dtype=dtype)
+    bytestring = np.asanyarray(array).astype(dtype).tobytes()
+    if compression == COMPRESSION_ZLIB:
+        bytestring = zlib.compress(bytestring)
+    return base64.standard_b64encode(bytestring)
+
+
+def current_prepare_array(array, compression=COMPRESSION_ZLIB, dtype=np.float64):
+    array = np.asarray(array, dtype=dtype)
+    return encode_array(array, compression=compression, dtype=dtype)
+
+
+def make_spectrum(n_points, seed=0):
+    rng = np.random.RandomState(seed)
+    mz = np.linspace(200., 2000., n_points)
+    intensity = rng.lognormal(5, 2, n_points).astype(np.float32)
+    return mz, intensity
+
+
+def measure(prepare, spectra, compression):
+    peaks = []
+    start = time.time()
+    for mz, intensity in spectra:
+        tracemalloc.start()
+        prepare(mz, compression=compression, dtype=np.float64)
+        prepare(intensity, compression=compression, dtype=np.float32)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+    elapsed = time.time() - start
+    return np.mean(peaks), elapsed / len(spectra)
+
+
+def main(n_points=2000000, n_spectra=5):
+    spectra = [make_spectrum(n_points, i) for i in range(n_spectra)]
+    input_size = sum(mz.nbytes + intensity.nbytes for mz, intensity in spectra) / float(n_spectra)
+    print("%d points per spectrum, %0.1f MB of input arrays per spectrum" % (n_points, input_size / 1e6))
+    for compression in ('none', COMPRESSION_ZLIB):
+        for label, prepare in (("legacy", legacy_prepare_array), ("current", current_prepare_array)):
+            peak, per_spectrum = measure(prepare, spectra, compression)
+            print("%-8s %-5s peak allocated per spectrum: %8.1f MB  (%0.3f s/spectrum)" % (
+                label, compression, peak / 1e6, per_spectrum))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,115 @@
+"""Measure the throughput of writing an indexed mzML file when the writer reports the
+offset of each spectrum to the index, comparing it against the path it replaced, which
+split everything written on ``<`` and searched each piece for the start of a spectrum
+or chromatogram.
+
+Usage::
+
+    python benchmarks/index_offsets.py [n_spectra] [n_points]
+
+Spectra are written from templates, so that the time spent building components does not
+hide the time spent in the output stream.
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+from psims.mzml import MzMLWriter
+from psims.mzml.writer import PlainMzMLWriter
+from psims.mzml.index import IndexingStream
+
+
+ATTRIBUTE_PATTERN = re.compile(br"(\S+)=[\"']([^\"']+)[\"']")
+START_TAG_PATTERNS = {
+    'spectrum': re.compile(b"<spectrum "),
+    'chromatogram': re.compile(b"<chromatogram "),
+}
+
+
+class LegacyIndexingStream(IndexingStream):
+    def mark(self, name, id, index=None):
+        return
+
+    def tokenize(self, buff):
+        delim = b'<'
+        started_with_delim = buff.startswith(delim)
+        parts = buff.split(delim)
+        tail = parts[-1]
+        front = parts[:-1]
+        i = 0
+        for part in front:
+            i += 1
+            if part == b"":
+                continue
+            if i == 1:
+                if started_with_delim:
+                    yield delim + part
+                else:
+                    yield part
+            else:
+                yield delim + part
+        if tail.strip() and i > 0:
+            yield delim + tail
+        else:
+            yield tail
+
+    def scan(self, data, distance):
+        for indexer in self.indices:
+            is_match = START_TAG_PATTERNS[indexer.name].search(data)
+            if is_match:
+                attrs = dict(ATTRIBUTE_PATTERN.findall(data))
+                indexer.add(attrs[b'id'], distance + is_match.start(), attrs)
+                return True
+        return False
+
+    def write(self, data):
+        for line in self.tokenize(data):
+            self.scan(line, self.accumulator)
+            super(LegacyIndexingStream, self).write(line)
+
+
+class LegacyMzMLWriter(MzMLWriter):
+    def __init__(self, outfile, close=False, **kwargs):
+        outfile = LegacyIndexingStream(outfile)
+        self.offset_index = None
+        PlainMzMLWriter.__init__(self, outfile, close, **kwargs)
+        self.index_builder = outfile
+
+
+def write_file(writer_type, path, n_spectra, n_points):
+    mz = np.linspace(200., 2000., n_points)
+    intensity = np.random.RandomState(0).lognormal(5, 2, n_points).astype(np.float32)
+    start = time.time()
+    with open(path, 'wb') as handle:
+        with writer_type(handle, close=False, spectrum_templates=True) as f:
+            f.controlled_vocabularies()
+            with f.run(id='benchmark'):
+                with f.spectrum_list(count=n_spectra):
+                    for i in range(n_spectra):
+                        f.write_spectrum(
+                            mz, intensity, id='scan=%d' % (i + 1), scan_start_time=i * 0.01,
+                            params=[{"ms level": 1}, "MS1 spectrum"])
+    return time.time() - start
+
+
+def main(n_spectra=100000, n_points=100):
+    warnings.simplefilter("ignore")
+    handle, path = tempfile.mkstemp(suffix='.mzML')
+    os.close(handle)
+    try:
+        for label, writer_type in (("legacy", LegacyMzMLWriter), ("current", MzMLWriter)):
+            elapsed = write_file(writer_type, path, n_spectra, n_points)
+            size = os.path.getsize(path)
+            print("%s: %0.2f seconds, %0.0f spectra/second, %0.1f MB/second" % (
+                label, elapsed, n_spectra / elapsed, size / elapsed / 1e6))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,92 @@
+"""Measure the time taken to read single spectra from an indexed mzML file with
+:class:`~.MzMLReader`, comparing it against finding the same spectra with a sequential
+:func:`lxml.etree.iterparse` pass over the document.
+
+Usage::
+
+    python benchmarks/reader.py [n_spectra] [n_points] [n_fetches]
+
+Each fetch reads the spectrum's ``"scan start time"`` and decodes its m/z and intensity
+arrays. The reader is timed both reading the offsets from the document's ``<indexList>``
+and from the offset index written beside it.
+"""
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+from lxml import etree
+
+from psims.mzml import MzMLWriter, MzMLReader
+from psims.mzml.binary_encoding import decode_array
+
+
+def write_file(path, n_spectra, n_points):
+    mz = np.linspace(200., 2000., n_points)
+    intensity = np.random.RandomState(0).lognormal(5, 2, n_points).astype(np.float32)
+    with open(path, 'wb') as handle:
+        with MzMLWriter(handle, close=False, spectrum_templates=True, offset_index=True) as f:
+            f.controlled_vocabularies()
+            with f.run(id='benchmark'):
+                with f.spectrum_list(count=n_spectra):
+                    for i in range(n_spectra):
+                        f.write_spectrum(
+                            mz, intensity, id='scan=%d' % (i + 1), scan_start_time=i * 0.01,
+                            params=[{"ms level": 1}, "MS1 spectrum"])
+
+
+def fetch(spectrum):
+    return (spectrum['scan start time'], spectrum['m/z array'], spectrum['intensity array'])
+
+
+def read_with_reader(path, ids, offset_index):
+    start = time.time()
+    with MzMLReader(path, offset_index=offset_index) as reader:
+        opened = time.time() - start
+        for spectrum_id in ids:
+            fetch(reader.get_by_id(spectrum_id))
+    return opened, time.time() - start
+
+
+def read_with_iterparse(path, spectrum_id):
+    # Decoding follows the layout written by :func:`write_file`
+    for _, element in etree.iterparse(path, tag='{*}spectrum'):
+        if element.get('id') == spectrum_id:
+            for param in element.iter('{*}cvParam'):
+                if param.get('name') == 'scan start time':
+                    break
+            arrays = [decode_array(binary.text.strip(), 'zlib', dtype)
+                      for binary, dtype in zip(element.iter('{*}binary'), (np.float64, np.float32))]
+            return arrays
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def main(n_spectra=100000, n_points=100, n_fetches=1000):
+    warnings.simplefilter("ignore")
+    handle, path = tempfile.mkstemp(suffix='.mzML')
+    os.close(handle)
+    try:
+        write_file(path, n_spectra, n_points)
+        print("%d spectra, %0.1f MB" % (n_spectra, os.path.getsize(path) / 1e6))
+        ids = ['scan=%d' % i for i in np.random.RandomState(1).randint(1, n_spectra + 1, n_fetches)]
+        for label, offset_index in (("reader, <indexList>", False), ("reader, offset index", None)):
+            opened, elapsed = read_with_reader(path, ids, offset_index)
+            print("%s: opened in %0.3f seconds, %d random fetches in %0.3f seconds, %0.1f us/spectrum" % (
+                label, opened, n_fetches, elapsed - opened, (elapsed - opened) / n_fetches * 1e6))
+        for position in (n_spectra // 2, n_spectra):
+            start = time.time()
+            read_with_iterparse(path, 'scan=%d' % position)
+            print("iterparse: fetched spectrum %d in %0.3f seconds" % (position, time.time() - start))
+    finally:
+        for suffix in ('', '.idx'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,208 @@
+"""Drive the synchronous document writers from :mod:`asyncio` without blocking the event loop.
+
+An :class:`AsyncXMLDocumentWriter` owns an instance of a synchronous writer, which renders
+into an in-memory buffer on a dedicated thread. Each coroutine method runs the corresponding
+synchronous method on that thread, so building components, resolving parameters, encoding
+binary data and serializing XML all happen off of the event loop, and then sends whatever was
+rendered to the asynchronous stream, waiting on its ``drain`` method if it has one so that
+a slow reader applies back-pressure to the producer.
+
+Because every call is forwarded to the synchronous writer in order, the same state machine
+checks apply, and the document produced is identical.
+
+This module requires Python 3.5 or later.
+"""
+import asyncio
+import inspect
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+try:
+    _get_running_loop = asyncio.get_running_loop
+except AttributeError:
+    # Python 3.5 and 3.6
+    _get_running_loop = asyncio.get_event_loop
+
+
+class _PendingOutput(object):
+    """A write-only file which holds what the synchronous writer renders until
+    it is sent to the asynchronous stream.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        with self._lock:
+            chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class AsyncSection(object):
+    """An asynchronous context manager around one of the synchronous writer's
+    document sections, which is created and entered on the writer's thread.
+
+    Attributes
+    ----------
+    section : :class:`~.DocumentSection`
+        The synchronous section, once entered
+    """
+
+    def __init__(self, writer, factory, args, kwargs):
+        self.writer = writer
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+        self.section = None
+
+    def _enter(self):
+        section = self.factory(*self.args, **self.kwargs)
+        section.__enter__()
+        self.section = section
+
+    async def __aenter__(self):
+        await self.writer.run_in_writer(self._enter)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # Nothing to close if the section was never entered
+        if self.section is None:
+            return
+        await self.writer.run_in_writer(self.section.__exit__, exc_type, exc_value, traceback)
+
+    def __getattr__(self, name):
+        if self.section is None:
+            raise AttributeError(name)
+        return getattr(self.section, name)
+
+
+def offloaded(name):
+    """Create a coroutine method which runs the synchronous writer's method ``name``
+    on the writer's thread.
+    """
+    async def method(self, *args, **kwargs):
+        return await self.run_in_writer(getattr(self.sync_writer, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Asynchronously call :meth:`%s` on :attr:`sync_writer`" % (name, )
+    return method
+
+
+def section(name):
+    """Create a method returning an :class:`AsyncSection` for the synchronous
+    writer's section method ``name``.
+    """
+    def method(self, *args, **kwargs):
+        return AsyncSection(self, getattr(self.sync_writer, name), args, kwargs)
+    method.__name__ = name
+    method.__doc__ = "Open :meth:`%s` on :attr:`sync_writer` with ``async with``" % (name, )
+    return method
+
+
+class AsyncXMLDocumentWriter(object):
+    """Base class for writing a document to an asynchronous stream with a synchronous
+    :class:`~.XMLDocumentWriter`.
+
+    Subclasses set :attr:`writer_type`, and expose the synchronous writer's methods with
+    :func:`offloaded` and :func:`section`. Any other attribute is looked up on
+    :attr:`sync_writer`, so components can be built as usual.
+
+    Parameters
+    ----------
+    stream : object
+        The destination. Must have a ``write`` method, which may be a coroutine function, like
+        :class:`asyncio.StreamWriter` or :class:`asyncio.WriteTransport`. If it has a ``drain``
+        coroutine method, it is awaited after each write.
+    close : bool
+        Whether to close ``stream`` when the document is finished
+    **kwargs
+        Forwarded to :attr:`writer_type`
+
+    Attributes
+    ----------
+    sync_writer : :class:`~.XMLDocumentWriter`
+        The synchronous writer rendering the document
+    """
+
+    writer_type = None
+
+    def __init__(self, stream, close=False, **kwargs):
+        self.stream = stream
+        self._close = close
+        self._output = _PendingOutput()
+        # A single thread keeps the calls ordered, and the XML writer on one thread
+        self._executor = ThreadPoolExecutor(1)
+        self.sync_writer = self.writer_type(self._output, close=False, **kwargs)
+
+    def __getattr__(self, name):
+        if name == 'sync_writer':
+            raise AttributeError(name)
+        return getattr(self.sync_writer, name)
+
+    async def run_in_writer(self, func, *args, **kwargs):
+        """Call ``func`` on the writer's thread, then send anything it rendered to :attr:`stream`
+
+        Returns
+        -------
+        object
+            The value returned by ``func``
+        """
+        loop = _get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+        finally:
+            await self._send()
+
+    async def _send(self):
+        data = self._output.take()
+        if not data:
+            return
+        result = self.stream.write(data)
+        if inspect.isawaitable(result):
+            await result
+        drain = getattr(self.stream, 'drain', None)
+        if drain is not None:
+            await drain()
+
+    async def begin(self):
+        await self.run_in_writer(self.sync_writer.begin)
+
+    async def end(self, exc_type=None, exc_value=None, traceback=None):
+        try:
+            await self.run_in_writer(self.sync_writer.end, exc_type, exc_value, traceback)
+        finally:
+            self._executor.shutdown(wait=False)
+            if self._close:
+                await self.close()
+
+    async def close(self):
+        self.stream.close()
+        wait_closed = getattr(self.stream, 'wait_closed', None)
+        if wait_closed is not None:
+            await wait_closed()
+
+    async def __aenter__(self):
+        await self.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.end(exc_type, exc_value, traceback)
+
+    write = offloaded('write')
+    controlled_vocabularies = offloaded('controlled_vocabularies')
@@ -14,6 +14,7 @@ from sqlalchemy import (Numeric, Unicode,
 from sqlalchemy import exc as sa_exc
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
 from six import string_types as basestring
 
@@ -686,7 +687,7 @@ def create(doc_path, output_path="sqlite://"):
     By default the table will be held in memory.
     '''
     tree = preprocess_xml(doc_path)
-    engine = create_engine(output_path)
+    engine = _create_engine(output_path)
     Base.metadata.create_all(engine)
     session = sessionmaker(bind=engine, autoflush=False)()
     with warnings.catch_warnings():
@@ -708,8 +709,16 @@ def create(doc_path, output_path="sqlite://"):
     return session
 
 
+def _create_engine(path):
+    if path in ("sqlite://", "sqlite:///:memory:"):
+        # An in-memory database exists only on the connection that created it, so share
+        # that connection with writers that resolve terms from other threads
+        return create_engine(path, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    return create_engine(path)
+
+
 def session(path="sqlite:///unimod.db"):
-    engine = create_engine(path)
+    engine = _create_engine(path)
     Base.metadata.create_all(engine)
     session = sessionmaker(bind=engine, autoflush=False)()
     return session
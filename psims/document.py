@@ -2,14 +2,15 @@ import warnings
 from collections import defaultdict, OrderedDict
 from functools import partial, update_wrapper
 from contextlib import contextmanager
+from io import BytesIO
 
 from .controlled_vocabulary import obo_cache, ControlledVocabulary
-from .utils import add_metaclass, ensure_iterable, Mapping
+from .utils import add_metaclass, ensure_iterable, Mapping, LRUCache
 
 from .xml import (
     id_maker, CVParam, UserParam,
     ParamGroupReference, _element,
-    XMLWriterMixin)
+    XMLWriterMixin, XMLFormattingStreamWriter, TagBase)
 
 
 class ChildTrackingMeta(type):
@@ -101,9 +102,209 @@ class AmbiguousTermWarning(UserWarning):
     pass
 
 
+class ParamPrototype(object):
+    """A fully resolved parameter without its value, from which new
+    parameters can be stamped out without consulting the controlled vocabularies again.
+
+    Attributes
+    ----------
+    param_type : type
+        The :class:`~.CVParam` subclass to build
+    attrs : tuple
+        The ``(key, value)`` pairs of the resolved attributes, in order
+    """
+    __slots__ = ('param_type', 'attrs')
+
+    def __init__(self, param_type, attrs):
+        self.param_type = param_type
+        self.attrs = attrs
+
+    @classmethod
+    def capture(cls, param):
+        return cls(param.__class__, tuple(param.attrs.items()))
+
+    def instantiate(self, value=None):
+        return self.param_type.from_prototype(self.attrs, value)
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.param_type.__name__}, {self.attrs!r})".format(self=self)
+
+
+def _same_vocabularies(vocabularies, previous):
+    """Check whether ``vocabularies`` holds the same vocabulary objects as ``previous``, in
+    the same order. ``previous`` holds references to them, so their identities are not reused.
+    """
+    return len(vocabularies) == len(previous) and all(
+        current is prior for current, prior in zip(vocabularies, previous))
+
+
+class VocabularyBoundCache(LRUCache):
+    """A :class:`~.LRUCache` of values resolved against a list of controlled vocabularies,
+    which discards them when the vocabularies change.
+    """
+
+    def __init__(self, max_size=1024):
+        super(VocabularyBoundCache, self).__init__(max_size)
+        self._vocabularies = ()
+
+    def synchronize(self, vocabularies):
+        """Discard all entries if the vocabularies they were resolved against have been
+        added to, removed, or replaced
+        """
+        if not _same_vocabularies(vocabularies, self._vocabularies):
+            self.clear()
+            self._vocabularies = tuple(vocabularies)
+
+
+class ParamResolutionCache(VocabularyBoundCache):
+    """A bounded least-recently-used cache of :class:`ParamPrototype` instances,
+    keyed by the arguments to :meth:`VocabularyResolver.param` other than the value.
+
+    Attributes
+    ----------
+    max_size : int
+        The maximum number of prototypes to keep
+    hits : int
+        The number of lookups which found a prototype
+    misses : int
+        The number of lookups which did not find a prototype
+    """
+
+    def make_key(self, name, accession, cv_ref, kwargs):
+        """Build the key identifying the resolution of a parameter
+
+        Returns
+        -------
+        tuple or None
+            :const:`None` if any of the arguments are not hashable, in which case the
+            parameter must not be cached
+        """
+        key = (name, accession, cv_ref, tuple(kwargs.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+
+def _render_key(value):
+    """Build a hashable key for a parameter which distinguishes values that compare
+    equal but are rendered differently, like ``1`` and ``1.0``
+    """
+    if isinstance(value, TagBase):
+        return (value.__class__, value.tag_name, tuple(
+            (k, _render_key(v)) for k, v in value.attrs.items()))
+    elif isinstance(value, Mapping):
+        return (dict, tuple((k, _render_key(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return (value.__class__, tuple(_render_key(v) for v in value))
+    return (value.__class__, value)
+
+
+class RenderedParamCache(VocabularyBoundCache):
+    """A bounded least-recently-used cache of the serialized markup of lists of
+    parameters, keyed by the parameters as given to :meth:`ComponentBase.write_params`
+    and the indentation they are written at.
+
+    A list of parameters is only rendered and stored the second time it is seen, so
+    lists which never recur, such as those carrying a scan number, cost a lookup but
+    never occupy the cache.
+
+    Attributes
+    ----------
+    max_size : int
+        The maximum number of rendered lists to keep
+    max_bytes : int
+        The maximum total size of the rendered markup to keep
+    hits : int
+        The number of lookups which found rendered markup
+    misses : int
+        The number of lookups which did not find rendered markup
+    nbytes : int
+        The total size of the rendered markup kept
+    """
+
+    def __init__(self, max_size=1024, max_bytes=2 ** 20):
+        super(RenderedParamCache, self).__init__(max_size)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._seen = OrderedDict()
+
+    def make_key(self, params, xml_file):
+        """Build the key identifying the markup of ``params`` written to ``xml_file``
+
+        Returns
+        -------
+        tuple or None
+            :const:`None` if any of the parameters are not hashable, or ``xml_file``
+            cannot have pre-rendered markup written to it, like when it writes to a
+            path rather than a stream, in which case the parameters must not be cached
+        """
+        if not isinstance(xml_file, XMLFormattingStreamWriter) or not hasattr(xml_file.stream, 'write'):
+            return None
+        if not xml_file.wrote_text_stack or xml_file.wrote_text_stack[-1]:
+            return None
+        try:
+            key = (xml_file.encoding, xml_file.indent_chars, xml_file.indent_level,
+                   tuple(map(_render_key, params)))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def admit(self, key):
+        """Record a sighting of ``key``, returning whether it has been seen before
+        and its markup should be rendered and stored with :meth:`put`
+        """
+        if self._seen.pop(key, None) is not None:
+            return True
+        self._seen[key] = True
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def _is_full(self):
+        return len(self._store) > self.max_size or self.nbytes > self.max_bytes
+
+    def _added(self, value):
+        self.nbytes += len(value)
+
+    def _removed(self, value):
+        self.nbytes -= len(value)
+
+    def clear(self):
+        super(RenderedParamCache, self).clear()
+        self._seen.clear()
+        self.nbytes = 0
+
+    def __repr__(self):
+        return ("{self.__class__.__name__}({size}/{self.max_size}, nbytes={self.nbytes}, "
+                "hits={self.hits}, misses={self.misses})").format(self=self, size=len(self))
+
+
 class VocabularyResolver(object):
+    """Resolves parameters and terms against a collection of controlled vocabularies.
+
+    Parameters are resolved once for each distinct combination of name or accession,
+    controlled vocabulary, units and other attributes, after which :meth:`param` builds
+    new parameters from the cached :class:`ParamPrototype` in :attr:`param_cache`. Unit
+    validation warnings are therefore only issued the first time a combination is seen.
+
+    Attributes
+    ----------
+    vocabularies : list
+        The controlled vocabularies to search
+    param_cache : :class:`ParamResolutionCache` or None
+        The cache of resolved parameters. If :const:`None`, every parameter is resolved
+        from scratch.
+    rendered_param_cache : :class:`RenderedParamCache` or None
+        The cache of serialized lists of parameters used by :meth:`ComponentBase.write_params`.
+        If :const:`None`, every list of parameters is serialized from scratch.
+    """
     warn_on_ambiguous_missing_units = True
     validate_units = True
+    param_cache_size = 1024
+    rendered_param_cache_size = 1024
 
     def __init__(self, vocabularies=None, vocabulary_resolver=None):
         if vocabularies is None:
@@ -112,6 +313,9 @@ class VocabularyResolver(object):
             vocabulary_resolver = obo_cache
         self.vocabulary_resolver = vocabulary_resolver
         self.vocabularies = list(map(self._bind_vocabulary, vocabularies))
+        self.param_cache = ParamResolutionCache(self.param_cache_size) if self.param_cache_size else None
+        self.rendered_param_cache = RenderedParamCache(
+            self.rendered_param_cache_size) if self.rendered_param_cache_size else None
 
     def _bind_vocabulary(self, cv):
         cv.resolver = self.vocabulary_resolver
@@ -171,6 +375,20 @@ class VocabularyResolver(object):
         if name == 'ref' and value is not None and cv_ref is None and not kwargs:
             return self.param_group_reference(value)
 
+        cache_key = None
+        if self.param_cache is not None:
+            self.param_cache.synchronize(self.vocabularies)
+            cache_key = self.param_cache.make_key(name, accession, cv_ref, kwargs)
+            if cache_key is not None:
+                prototype = self.param_cache.get(cache_key)
+                if prototype is not None:
+                    return prototype.instantiate(value)
+        param = self._resolve_param(name, value, cv_ref, accession, kwargs)
+        if cache_key is not None:
+            self.param_cache.put(cache_key, ParamPrototype.capture(param))
+        return param
+
+    def _resolve_param(self, name, value, cv_ref, accession, kwargs):
         self._resolve_units(kwargs)
         if name is None and accession is None:
             raise ValueError("Could not coerce parameter from %r, %r, %r" % (name, value, kwargs))
@@ -251,7 +469,7 @@ class VocabularyResolver(object):
                             (state['unit_accession'], unit_term.id),
                             (state['unit_name'], unit_term.name),
                             (state['unit_cv_ref'], unit_source.id),
-                        ), stacklevel=4)
+                        ), stacklevel=5)
             elif len(has_units) > 1:
                 provided_unit_accession = state.get("unit_accession")
                 if provided_unit_accession is None:
@@ -260,7 +478,7 @@ class VocabularyResolver(object):
                             "Multiple unit options are possible for parameter %r but none were specified" % (
                                 name),
                             AmbiguousTermWarning,
-                            stacklevel=4
+                            stacklevel=5
                         )
                     try:
                         unit_term, unit_source = self.term(has_units[0].accession, include_source=True)
@@ -281,7 +499,7 @@ class VocabularyResolver(object):
                                 name,
                                 ((state['unit_accession'], state['unit_name'], state['unit_cv_ref']),
                                  has_units)),
-                            stacklevel=4
+                            stacklevel=5
                         )
 
     def term(self, name, include_source=False):
@@ -673,6 +891,38 @@ class ComponentBase(object):
         if params is None:
             params = self.params
         params = self.prepare_params(params)
+        cache = getattr(self.context, 'rendered_param_cache', None)
+        cache_key = None
+        if cache is not None:
+            cache.synchronize(self.context.vocabularies)
+            cache_key = cache.make_key(params, xml_file)
+        if cache_key is None:
+            self._write_params(xml_file, params)
+            return
+        rendered = cache.get(cache_key)
+        if rendered is None:
+            if not cache.admit(cache_key):
+                self._write_params(xml_file, params)
+                return
+            rendered = self._render_params(xml_file, params)
+            cache.put(cache_key, rendered)
+        xml_file.write_raw(rendered)
+
+    def _render_params(self, xml_file, params):
+        buffer = BytesIO()
+        with XMLFormattingStreamWriter(buffer, encoding=xml_file.encoding,
+                                       indent=xml_file.indent_chars) as writer:
+            with writer.element("params"):
+                writer.indent_level = xml_file.indent_level
+                writer.flush()
+                start = len(buffer.getvalue())
+                self._write_params(writer, params)
+                writer.flush()
+                end = len(buffer.getvalue())
+                writer.indent_level = 1
+        return buffer.getvalue()[start:end]
+
+    def _write_params(self, xml_file, params):
         user_params = []
         cv_params = []
         references = []
@@ -0,0 +1,53 @@
+"""An :mod:`asyncio` interface to :class:`~.MzIdentMLWriter`.
+
+Requires Python 3.5 or later.
+"""
+from psims.async_writer import AsyncXMLDocumentWriter, offloaded, section
+
+from .writer import MzIdentMLWriter
+
+
+class AsyncMzIdentMLWriter(AsyncXMLDocumentWriter):
+    """Writes an mzIdentML document to an asynchronous stream.
+
+    Each coroutine method runs the :class:`~.MzIdentMLWriter` method of the same name on a
+    dedicated thread, and the collection and list sections are opened with ``async with``:
+
+    .. code-block:: python
+
+        async with AsyncMzIdentMLWriter(stream) as writer:
+            await writer.controlled_vocabularies()
+            await writer.provenance(software=software)
+            ...
+            async with writer.analysis_data():
+                async with writer.spectrum_identification_list(id=1):
+                    for result in results:
+                        await writer.write_spectrum_identification_result(**result)
+
+    All keyword arguments are passed to :class:`~.MzIdentMLWriter`.
+    """
+
+    writer_type = MzIdentMLWriter
+
+    provenance = offloaded('provenance')
+    inputs = offloaded('inputs')
+    write_sample = offloaded('write_sample')
+    write_db_sequence = offloaded('write_db_sequence')
+    write_peptide = offloaded('write_peptide')
+    write_peptide_evidence = offloaded('write_peptide_evidence')
+    spectrum_identification_protocol = offloaded('spectrum_identification_protocol')
+    protein_detection_protocol = offloaded('protein_detection_protocol')
+    write_spectrum_identification_result = offloaded('write_spectrum_identification_result')
+    write_spectrum_identification_item = offloaded('write_spectrum_identification_item')
+    write_protein_ambiguity_group = offloaded('write_protein_ambiguity_group')
+    write_protein_detection_hypothesis = offloaded('write_protein_detection_hypothesis')
+    write_peptide_hypothesis = offloaded('write_peptide_hypothesis')
+
+    analysis_sample_collection = section('analysis_sample_collection')
+    sequence_collection = section('sequence_collection')
+    analysis_collection = section('analysis_collection')
+    analysis_protocol_collection = section('analysis_protocol_collection')
+    data_collection = section('data_collection')
+    analysis_data = section('analysis_data')
+    spectrum_identification_list = section('spectrum_identification_list')
+    protein_detection_list = section('protein_detection_list')
@@ -1,7 +1,18 @@
 from .writer import (
-    MzMLWriter, ARRAY_TYPES,
+    MzMLWriter, PipelinedMzMLWriter, ARRAY_TYPES,
     MZ_ARRAY, INTENSITY_ARRAY, CHARGE_ARRAY,
     compression_map, default_cv_list)
 
-__all__ = ["MzMLWriter", "ARRAY_TYPES", "compression_map", "default_cv_list",
+from .sharding import write_spectrum_shards
+from .batch import SpectrumBatch
+from .derived import TotalIonChromatogram, BasePeakChromatogram, ExtractedIonChromatograms
+from .param_groups import ParamGroupFactorer
+from .offset_index import OffsetIndex
+from .metadata_index import SpectrumMetadataIndex
+from .reader import MzMLReader
+
+__all__ = ["MzMLWriter", "PipelinedMzMLWriter", "write_spectrum_shards", "SpectrumBatch",
+           "ARRAY_TYPES", "compression_map", "default_cv_list",
+           "TotalIonChromatogram", "BasePeakChromatogram", "ExtractedIonChromatograms",
+           "ParamGroupFactorer", "OffsetIndex", "SpectrumMetadataIndex", "MzMLReader",
            "MZ_ARRAY", "INTENSITY_ARRAY", "CHARGE_ARRAY", ]
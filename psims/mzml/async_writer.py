@@ -0,0 +1,52 @@
+"""An :mod:`asyncio` interface to :class:`~.IndexedMzMLWriter`.
+
+Requires Python 3.5 or later.
+"""
+from psims.async_writer import AsyncXMLDocumentWriter, offloaded, section
+
+from .writer import IndexedMzMLWriter
+
+
+class AsyncMzMLWriter(AsyncXMLDocumentWriter):
+    """Writes an indexed mzML document to an asynchronous stream.
+
+    Each coroutine method runs the :class:`~.IndexedMzMLWriter` method of the same name on a
+    dedicated thread, including encoding binary data arrays, and the list sections are opened
+    with ``async with``:
+
+    .. code-block:: python
+
+        async with AsyncMzMLWriter(stream) as writer:
+            await writer.controlled_vocabularies()
+            ...
+            async with writer.run(id="run1"):
+                async with writer.spectrum_list(count=n):
+                    for scan in scans:
+                        await writer.write_spectrum(scan.mz, scan.intensity, id=scan.id)
+
+    All keyword arguments, like ``encoding_workers`` or ``spectrum_templates``, are passed
+    to :class:`~.IndexedMzMLWriter`. As everything rendered by a call is already sent to the
+    stream in one write, ``write_buffer_size`` defaults to 0.
+    """
+
+    writer_type = IndexedMzMLWriter
+
+    def __init__(self, stream, close=False, **kwargs):
+        kwargs.setdefault('write_buffer_size', 0)
+        super(AsyncMzMLWriter, self).__init__(stream, close, **kwargs)
+
+    file_description = offloaded('file_description')
+    software_list = offloaded('software_list')
+    reference_param_group_list = offloaded('reference_param_group_list')
+    sample_list = offloaded('sample_list')
+    scan_settings_list = offloaded('scan_settings_list')
+    instrument_configuration_list = offloaded('instrument_configuration_list')
+    data_processing_list = offloaded('data_processing_list')
+    write_spectrum = offloaded('write_spectrum')
+    write_spectra = offloaded('write_spectra')
+    write_chromatogram = offloaded('write_chromatogram')
+    write_chromatograms = offloaded('write_chromatograms')
+
+    run = section('run')
+    spectrum_list = section('spectrum_list')
+    chromatogram_list = section('chromatogram_list')
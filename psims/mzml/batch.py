@@ -0,0 +1,93 @@
+"""Columnar batches of spectra for :meth:`~.PlainMzMLWriter.write_spectra`.
+
+A :class:`SpectrumBatch` holds the scalar metadata of many spectra in a NumPy structured
+array, one record per spectrum, and the peaks of all of them in shared ragged buffers
+delimited by an array of offsets. Iterating over it produces the keyword arguments of
+:meth:`~.PlainMzMLWriter.write_spectrum` for each spectrum, with the arrays as views of
+the buffers, so the peaks are never copied.
+"""
+import numpy as np
+
+from .writer import SPECTRUM_ARGUMENT_DEFAULTS
+
+
+class SpectrumBatch(object):
+    """Many spectra stored column by column.
+
+    Each field of :attr:`metadata` named after a keyword argument of
+    :meth:`~.PlainMzMLWriter.write_spectrum`, like ``id``, ``scan_start_time``,
+    ``polarity`` or ``centroided``, is passed as that argument. Every other field
+    is written as a parameter of the spectrum with the field's name, like
+    ``"ms level"``.
+
+    Attributes
+    ----------
+    metadata : :class:`numpy.ndarray`
+        A structured array with one record per spectrum
+    mz_array : :class:`numpy.ndarray`
+        The m/z arrays of all of the spectra, one after another
+    intensity_array : :class:`numpy.ndarray` or None
+        The intensity arrays of all of the spectra, aligned with :attr:`mz_array`
+    charge_array : :class:`numpy.ndarray` or None
+        The charge arrays of all of the spectra, aligned with :attr:`mz_array`
+    offsets : :class:`numpy.ndarray`
+        The position in the buffers where each spectrum starts, followed by where
+        the last one ends. The end may be left out.
+    """
+
+    def __init__(self, metadata, mz_array, intensity_array, offsets, charge_array=None):
+        metadata = np.asarray(metadata)
+        if metadata.dtype.names is None:
+            raise TypeError("The spectrum metadata must be a structured array")
+        mz_array = np.asarray(mz_array)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(offsets) == len(metadata):
+            offsets = np.append(offsets, len(mz_array))
+        if len(offsets) != len(metadata) + 1:
+            raise ValueError("Expected %d offsets for %d spectra, got %d" % (
+                len(metadata) + 1, len(metadata), len(offsets)))
+        for name, array in (('intensity', intensity_array), ('charge', charge_array)):
+            if array is not None and len(array) != len(mz_array):
+                raise ValueError("The %s buffer has %d values but the m/z buffer has %d" % (
+                    name, len(array), len(mz_array)))
+        self.metadata = metadata
+        self.mz_array = mz_array
+        self.intensity_array = intensity_array
+        self.charge_array = charge_array
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def _columns(self):
+        arguments = []
+        params = []
+        for name in self.metadata.dtype.names:
+            values = self.metadata[name].tolist()
+            if self.metadata.dtype[name].kind == 'S':
+                values = [value.decode('utf8') for value in values]
+            if name in SPECTRUM_ARGUMENT_DEFAULTS:
+                arguments.append((name, values))
+            else:
+                params.append((name, values))
+        return arguments, params
+
+    def __iter__(self):
+        arguments, params = self._columns()
+        bounds = self.offsets.tolist()
+        for i in range(len(self)):
+            start, end = bounds[i], bounds[i + 1]
+            spectrum = {'mz_array': self.mz_array[start:end]}
+            if self.intensity_array is not None:
+                spectrum['intensity_array'] = self.intensity_array[start:end]
+            if self.charge_array is not None:
+                spectrum['charge_array'] = self.charge_array[start:end]
+            for name, values in arguments:
+                spectrum[name] = values[i]
+            if params:
+                spectrum['params'] = [{"name": name, "value": values[i]} for name, values in params]
+            yield spectrum
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({count} spectra, {peaks} peaks)".format(
+            self=self, count=len(self), peaks=len(self.mz_array))
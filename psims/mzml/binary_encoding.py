@@ -1,18 +1,62 @@
 import base64
+import hashlib
 import zlib
 
 import numpy as np
 
 import six
 
+from psims.utils import LRUCache
+
+from . import numpress
+
 if six.PY2:
     decode_base64 = base64.decodestring
 else:
     decode_base64 = base64.decodebytes
 
 
+if six.PY2:
+    def _byte_view(array):
+        return array.tobytes()
+else:
+    def _byte_view(array):
+        return memoryview(array)
+
+
+def as_byte_view(array, dtype):
+    """Get a read-only view of the raw bytes of ``array`` after
+    conversion to ``dtype``.
+
+    If ``array`` is already a C-contiguous :class:`np.ndarray` of ``dtype``, the
+    view shares its memory and no copy is made. Otherwise, a single converted
+    copy is made.
+
+    Parameters
+    ----------
+    array : :class:`np.ndarray` or :class:`Sequence`
+        The data to view
+    dtype : type
+        The type the data should be viewed as
+
+    Returns
+    -------
+    :class:`memoryview`
+    """
+    array = np.ascontiguousarray(array, dtype=dtype).reshape(-1)
+    return _byte_view(array.view(np.uint8))
+
+
 COMPRESSION_NONE = 'none'
 COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_NUMPRESS_LINEAR = 'numpress linear'
+COMPRESSION_NUMPRESS_PIC = 'numpress pic'
+COMPRESSION_NUMPRESS_SLOF = 'numpress slof'
+COMPRESSION_NUMPRESS_LINEAR_ZLIB = 'numpress linear zlib'
+COMPRESSION_NUMPRESS_PIC_ZLIB = 'numpress pic zlib'
+COMPRESSION_NUMPRESS_SLOF_ZLIB = 'numpress slof zlib'
+COMPRESSION_TRUNCATE = 'truncate'
+COMPRESSION_TRUNCATE_ZLIB = 'truncate zlib'
 
 
 encoding_map = {
@@ -46,42 +90,564 @@ dtype_to_encoding = {
 }
 
 
+ENCODING_AUTO_LOSSLESS = 'auto-lossless'
+ENCODING_AUTO_LOSSLESS_FLOAT16 = 'auto-lossless float16'
+
+# Maps each automatic encoding mode to whether 16-bit floats may be chosen
+auto_encodings = {
+    ENCODING_AUTO_LOSSLESS: False,
+    ENCODING_AUTO_LOSSLESS_FLOAT16: True,
+}
+
+
+def _round_trips(array, dtype):
+    narrowed = array.astype(dtype)
+    with np.errstate(invalid='ignore'):
+        exact = narrowed == array
+    if not exact.all():
+        exact |= np.isnan(narrowed) & np.isnan(array)
+        return bool(exact.all())
+    return True
+
+
+def narrowest_lossless_dtype(array, allow_float16=False):
+    """Find the narrowest type in :data:`dtype_to_encoding` which represents every
+    value of ``array`` exactly.
+
+    Integer arrays are narrowed to 32-bit integers when their values fit, and all other
+    arrays are narrowed to 32-bit, or optionally 16-bit, floats when their values survive
+    the conversion unchanged.
+
+    Parameters
+    ----------
+    array : :class:`np.ndarray` or :class:`Sequence`
+        The data to be encoded
+    allow_float16 : bool, optional
+        Whether 16-bit floats may be chosen. Not all readers support them.
+
+    Returns
+    -------
+    type
+    """
+    array = np.asanyarray(array)
+    if array.dtype.kind in 'iu':
+        if array.size == 0:
+            return np.int32
+        low, high = array.min(), array.max()
+        for dtype in (np.int32, np.int64):
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return dtype
+        raise ValueError("Integer values exceed the range of a 64-bit integer")
+    if array.dtype.kind != 'f':
+        array = array.astype(np.float64)
+    candidates = (np.float16, np.float32) if allow_float16 else (np.float32,)
+    for dtype in candidates:
+        if np.dtype(dtype).itemsize >= array.dtype.itemsize:
+            return dtype
+        if _round_trips(array, dtype):
+            return dtype
+    return np.float64
+
+
 compression_map = {
     COMPRESSION_ZLIB: "zlib compression",
     COMPRESSION_NONE: 'no compression',
     None: 'no compression',
     False: 'no compression',
-    True: "zlib compression"
+    True: "zlib compression",
+    COMPRESSION_NUMPRESS_LINEAR: "MS-Numpress linear prediction compression",
+    COMPRESSION_NUMPRESS_PIC: "MS-Numpress positive integer compression",
+    COMPRESSION_NUMPRESS_SLOF: "MS-Numpress short logged float compression",
+    COMPRESSION_NUMPRESS_LINEAR_ZLIB: "MS-Numpress linear prediction compression followed by zlib compression",
+    COMPRESSION_NUMPRESS_PIC_ZLIB: "MS-Numpress positive integer compression followed by zlib compression",
+    COMPRESSION_NUMPRESS_SLOF_ZLIB: "MS-Numpress short logged float compression followed by zlib compression",
+    # Truncated arrays are decoded exactly like untruncated ones, the truncation
+    # is recorded separately with :data:`TRUNCATION_PARAM`
+    COMPRESSION_TRUNCATE: 'no compression',
+    COMPRESSION_TRUNCATE_ZLIB: "zlib compression",
+}
+
+
+# Maps each MS-Numpress compression method to its encoder, decoder, error bound function,
+# and whether the encoded bytes are subsequently zlib compressed
+numpress_codecs = {
+    COMPRESSION_NUMPRESS_LINEAR: (numpress.encode_linear, numpress.decode_linear, numpress.linear_error_bound, False),
+    COMPRESSION_NUMPRESS_PIC: (numpress.encode_pic, numpress.decode_pic, numpress.pic_error_bound, False),
+    COMPRESSION_NUMPRESS_SLOF: (numpress.encode_slof, numpress.decode_slof, numpress.slof_error_bound, False),
+    COMPRESSION_NUMPRESS_LINEAR_ZLIB: (
+        numpress.encode_linear, numpress.decode_linear, numpress.linear_error_bound, True),
+    COMPRESSION_NUMPRESS_PIC_ZLIB: (numpress.encode_pic, numpress.decode_pic, numpress.pic_error_bound, True),
+    COMPRESSION_NUMPRESS_SLOF_ZLIB: (numpress.encode_slof, numpress.decode_slof, numpress.slof_error_bound, True),
+}
+
+
+# Maps each mantissa truncation compression method to the compression method
+# applied after truncation
+truncation_codecs = {
+    COMPRESSION_TRUNCATE: COMPRESSION_NONE,
+    COMPRESSION_TRUNCATE_ZLIB: COMPRESSION_ZLIB,
 }
 
+# The default number of explicit mantissa bits kept by mantissa truncation
+DEFAULT_SIGNIFICANT_BITS = 12
+
+# The name of the user parameter recording the number of mantissa bits kept
+TRUNCATION_PARAM = "truncated mantissa significant bits"
+
+
+def _float_bits(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        raise ValueError("Mantissa truncation requires a floating point type, not %s" % dtype)
+    return np.finfo(dtype).nmant, np.dtype('u%d' % dtype.itemsize)
+
+
+def truncate_mantissa(array, significant_bits=DEFAULT_SIGNIFICANT_BITS, dtype=np.float32):
+    """Zero all but the ``significant_bits`` highest explicit mantissa bits of each
+    value of ``array`` after conversion to ``dtype``.
+
+    The result decodes exactly like any other array of ``dtype``, but its runs of zero bits
+    make it far more compressible.
+
+    Parameters
+    ----------
+    array : :class:`np.ndarray`
+        The data to truncate
+    significant_bits : int, optional
+        The number of explicit mantissa bits to keep
+    dtype : type, optional
+        The floating point type to convert ``array`` to
+
+    Returns
+    -------
+    :class:`np.ndarray`
+        A new array of ``dtype``
+    """
+    mantissa_bits, int_type = _float_bits(dtype)
+    if significant_bits < 1:
+        raise ValueError("Must keep at least one significant bit, not %d" % significant_bits)
+    array = np.array(array, dtype=dtype).reshape(-1)
+    dropped = mantissa_bits - significant_bits
+    if dropped > 0:
+        mask = int_type.type(((1 << (8 * int_type.itemsize)) - 1) ^ ((1 << dropped) - 1))
+        bits = array.view(int_type)
+        bits &= mask
+    return array
+
+
+# MS-Numpress always decodes to 64-bit floats, regardless of the type of the original data
+NUMPRESS_DTYPE = np.float64
+
 
 for dtype in list(encoding_map.values()):
     encoding_map[dtype] = dtype
 
 
-def encode_array(array, compression=COMPRESSION_NONE, dtype=np.float32):
-    bytestring = np.asanyarray(array).astype(dtype).tobytes()
-    if compression == COMPRESSION_NONE:
-        bytestring = bytestring
-    elif compression == COMPRESSION_ZLIB:
-        bytestring = zlib.compress(bytestring)
+def _zlib_compress(bytestring, level=None):
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    return zlib.compress(bytestring, level)
+
+
+def encode_array(array, compression=COMPRESSION_NONE, dtype=np.float32, compression_level=None,
+                 significant_bits=DEFAULT_SIGNIFICANT_BITS):
+    """Encode ``array`` as a base64 byte string with the requested compression
+    method.
+
+    Parameters
+    ----------
+    array : :class:`np.ndarray`
+        The data to encode
+    compression : str, optional
+        The compression method to use, a key of :data:`compression_map`
+    dtype : type, optional
+        The type to convert ``array`` to before encoding. If ``array`` is already
+        a contiguous array of this type, its memory is used without copying. MS-Numpress
+        compression methods always encode 64-bit floats.
+    compression_level : int, optional
+        The zlib compression level to use for compression methods involving zlib. Defaults
+        to zlib's own default.
+    significant_bits : int, optional
+        The number of explicit mantissa bits to keep for mantissa truncation compression
+        methods. See :func:`truncate_mantissa`.
+
+    Returns
+    -------
+    bytes
+    """
+    if compression in truncation_codecs:
+        array = truncate_mantissa(array, significant_bits, dtype)
+        compression = truncation_codecs[compression]
+    if compression in numpress_codecs:
+        encoder, _, _, use_zlib = numpress_codecs[compression]
+        bytestring = encoder(array)
+        if use_zlib:
+            bytestring = _zlib_compress(bytestring, compression_level)
     else:
-        raise ValueError("Unknown compression: %s" % compression)
+        # zlib and base64 both read directly from the array's buffer,
+        # avoiding an intermediate copy of the array's bytes
+        bytestring = as_byte_view(array, dtype)
+        if compression == COMPRESSION_NONE:
+            bytestring = bytestring
+        elif compression == COMPRESSION_ZLIB:
+            bytestring = _zlib_compress(bytestring, compression_level)
+        else:
+            raise ValueError("Unknown compression: %s" % compression)
     encoded_string = base64.standard_b64encode(bytestring)
     return encoded_string
 
 
-def decode_array(bytestring, compression=COMPRESSION_NONE, dtype=np.float32):
+# The default number of bytes of array data :class:`StreamingArrayEncoder` reads at a time
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+# The compression methods :class:`StreamingArrayEncoder` can encode incrementally
+streamable_compressions = (
+    COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_TRUNCATE, COMPRESSION_TRUNCATE_ZLIB)
+
+
+class StreamingArrayEncoder(object):
+    """Encodes an array into the same base64 byte string as :func:`encode_array`, but
+    produces it in pieces rather than all at once.
+
+    Only a chunk of the array is converted, compressed, and base64 encoded at a time, so
+    the memory used is bounded by :attr:`chunk_size` regardless of the size of the array,
+    and arrays like :class:`np.memmap` are read incrementally rather than loaded whole.
+
+    The array is only read when the encoder is iterated over or its length is requested.
+    The length of a compressed encoding can only be found by compressing the array, so
+    finding the length of a compressed encoding reads and compresses the array once without
+    keeping the result, and iterating over it does so again.
+
+    Attributes
+    ----------
+    array : :class:`np.ndarray`
+        The data to encode
+    compression : str
+        The compression method to use, one of :data:`streamable_compressions`
+    dtype : type
+        The type to convert each chunk of :attr:`array` to before encoding
+    compression_level : int
+        The zlib compression level to use
+    significant_bits : int
+        The number of explicit mantissa bits to keep for mantissa truncation
+    chunk_size : int
+        The approximate number of bytes of converted array data to encode at a time
+    """
+
+    def __init__(self, array, compression=COMPRESSION_NONE, dtype=np.float32, compression_level=None,
+                 significant_bits=DEFAULT_SIGNIFICANT_BITS, chunk_size=DEFAULT_CHUNK_SIZE):
+        if compression not in streamable_compressions:
+            raise ValueError("Cannot incrementally encode with compression: %s" % compression)
+        self.array = np.asanyarray(array).reshape(-1)
+        self.compression = compression
+        self.dtype = dtype
+        self.compression_level = compression_level
+        self.significant_bits = significant_bits
+        self.chunk_size = chunk_size
+        self._encoded_length = None
+
+    def _iter_raw(self):
+        itemsize = np.dtype(self.dtype).itemsize
+        # Keep chunks a multiple of three bytes so that they base64 encode independently
+        step = max(3 * (self.chunk_size // (3 * itemsize)), 3)
+        truncate = self.compression in truncation_codecs
+        for i in range(0, len(self.array), step):
+            chunk = self.array[i:i + step]
+            if truncate:
+                chunk = truncate_mantissa(chunk, self.significant_bits, self.dtype)
+            yield as_byte_view(chunk, self.dtype)
+
+    def _iter_compressed(self):
+        if truncation_codecs.get(self.compression, self.compression) == COMPRESSION_NONE:
+            for block in self._iter_raw():
+                yield block
+            return
+        level = self.compression_level
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(level)
+        for block in self._iter_raw():
+            block = compressor.compress(block)
+            if block:
+                yield block
+        yield compressor.flush()
+
+    def __iter__(self):
+        remainder = b''
+        for block in self._iter_compressed():
+            if remainder:
+                block = remainder + bytes(block)
+            cut = len(block) - len(block) % 3
+            if cut:
+                yield base64.standard_b64encode(block[:cut])
+            remainder = bytes(block[cut:])
+        if remainder:
+            yield base64.standard_b64encode(remainder)
+
+    def __len__(self):
+        if self._encoded_length is None:
+            if truncation_codecs.get(self.compression, self.compression) == COMPRESSION_NONE:
+                size = self.array.size * np.dtype(self.dtype).itemsize
+            else:
+                size = sum(len(block) for block in self._iter_compressed())
+            self._encoded_length = 4 * ((size + 2) // 3)
+        return self._encoded_length
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({size} values, {self.compression!r}, {dtype})".format(
+            self=self, size=self.array.size, dtype=np.dtype(self.dtype).name)
+
+
+class EncodingCache(LRUCache):
+    """A bounded least-recently-used cache of encoded arrays, keyed by a digest of the
+    array's bytes and the parameters it was encoded with.
+
+    Attributes
+    ----------
+    max_size : int
+        The maximum number of encodings to keep
+    hits : int
+        The number of lookups which found an encoding
+    misses : int
+        The number of lookups which did not find an encoding
+    """
+
+    def make_key(self, array, dtype, compression, *options):
+        """Build the key identifying the encoding of ``array``
+
+        Parameters
+        ----------
+        array : :class:`np.ndarray`
+            The data to be encoded
+        dtype : type
+            The type the data will be encoded as
+        compression : str
+            The compression method to be used
+        *options
+            Any other parameters which affect the encoding
+
+        Returns
+        -------
+        tuple
+        """
+        digest = hashlib.sha1(as_byte_view(array, dtype)).digest()
+        return (digest, np.dtype(dtype).str, compression) + options
+
+
+def _decode_bytes(bytestring, compression=COMPRESSION_NONE):
     try:
         decoded_string = bytestring.encode("ascii")
     except AttributeError:
         decoded_string = bytestring
     decoded_string = decode_base64(decoded_string)
+    if compression in numpress_codecs:
+        _, decoder, _, use_zlib = numpress_codecs[compression]
+        if use_zlib:
+            decoded_string = zlib.decompress(decoded_string)
+        return decoder(decoded_string)
     if compression == COMPRESSION_NONE:
         decoded_string = decoded_string
     elif compression == COMPRESSION_ZLIB:
         decoded_string = zlib.decompress(decoded_string)
     else:
         raise ValueError("Unknown compression: %s" % compression)
-    array = np.fromstring(decoded_string, dtype=dtype)
+    return decoded_string
+
+
+def _view_decoded(decoded, dtype):
+    if isinstance(decoded, np.ndarray):
+        return decoded
+    # A read-only view over the decompressed bytes, copied only once the
+    # values are written to their destination
+    return np.frombuffer(decoded, dtype=dtype)
+
+
+def decode_array(bytestring, compression=COMPRESSION_NONE, dtype=np.float32):
+    """Decode a base64 byte string produced by :func:`encode_array` into a new array.
+
+    Parameters
+    ----------
+    bytestring : bytes or str
+        The encoded data
+    compression : str, optional
+        The compression method used, a key of :data:`compression_map`
+    dtype : type, optional
+        The type the data were encoded as. Ignored for MS-Numpress compression
+        methods, which always decode to 64-bit floats.
+
+    Returns
+    -------
+    :class:`np.ndarray`
+    """
+    if compression in numpress_codecs:
+        dtype = NUMPRESS_DTYPE
+    view = _view_decoded(_decode_bytes(bytestring, compression), dtype)
+    array = np.empty(len(view), dtype=dtype)
+    array[:] = view
     return array
+
+
+def decode_array_into(bytestring, out, compression=COMPRESSION_NONE, dtype=np.float32):
+    """Decode a base64 byte string produced by :func:`encode_array` into the
+    start of a caller-supplied array, avoiding allocating a new array for
+    the result.
+
+    Parameters
+    ----------
+    bytestring : bytes or str
+        The encoded data
+    out : :class:`np.ndarray`
+        A one dimensional array to write the decoded values into. It must be at least
+        as long as the decoded data. The values are converted to ``out.dtype`` if it
+        differs from ``dtype``.
+    compression : str, optional
+        The compression method used, a key of :data:`compression_map`
+    dtype : type, optional
+        The type the data were encoded as. Ignored for MS-Numpress compression
+        methods, which always decode to 64-bit floats.
+
+    Returns
+    -------
+    :class:`np.ndarray`
+        A view of the filled prefix of ``out``
+
+    Raises
+    ------
+    ValueError
+        If ``out`` is too small to hold the decoded data
+    """
+    view = _view_decoded(_decode_bytes(bytestring, compression), dtype)
+    n = len(view)
+    if n > len(out):
+        raise ValueError("Output array of length %d is too small for %d decoded values" % (len(out), n))
+    filled = out[:n]
+    filled[:] = view
+    return filled
+
+
+class DecodedArrayBatch(object):
+    """A collection of variable length arrays stored back to back in a single
+    contiguous array, as produced by :func:`decode_arrays`.
+
+    The ``i``-th array is ``data[offsets[i]:offsets[i + 1]]``.
+
+    Attributes
+    ----------
+    data : :class:`np.ndarray`
+        The concatenated values of all of the arrays. May be longer than ``offsets[-1]``
+        if a larger buffer was supplied.
+    offsets : :class:`np.ndarray`
+        The starting position of each array in :attr:`data`, followed by the end position
+        of the last array
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({size} arrays, {total} values)".format(
+            self=self, size=len(self), total=self.offsets[-1])
+
+
+def decode_arrays(batch, out=None, compression=COMPRESSION_NONE, dtype=np.float32):
+    """Decode many base64 byte strings produced by :func:`encode_array` into one
+    contiguous buffer.
+
+    When ``out`` is large enough to hold every decoded value, no array is allocated
+    for the results, so the same buffer may be reused across batches.
+
+    Parameters
+    ----------
+    batch : :class:`Iterable`
+        The encoded data. Each item is either an encoded byte string, which is decoded
+        using ``compression`` and ``dtype``, or a ``(bytestring, compression, dtype)`` tuple.
+    out : :class:`np.ndarray`, optional
+        The buffer to decode into. Its dtype determines the type of the result. If it is
+        not given or is too small, a larger buffer is allocated in its place.
+    compression : str, optional
+        The default compression method, a key of :data:`compression_map`
+    dtype : type, optional
+        The default type the data were encoded as. Ignored for MS-Numpress compression
+        methods, which always decode to 64-bit floats.
+
+    Returns
+    -------
+    :class:`DecodedArrayBatch`
+    """
+    if out is None:
+        out = np.empty(0, dtype=np.float64)
+    offsets = [0]
+    position = 0
+    for item in batch:
+        if isinstance(item, tuple):
+            bytestring, item_compression, item_dtype = item
+        else:
+            bytestring, item_compression, item_dtype = item, compression, dtype
+        view = _view_decoded(_decode_bytes(bytestring, item_compression), item_dtype)
+        end = position + len(view)
+        if end > len(out):
+            grown = np.empty(max(end, 2 * len(out)), dtype=out.dtype)
+            grown[:position] = out[:position]
+            out = grown
+        out[position:end] = view
+        position = end
+        offsets.append(position)
+    return DecodedArrayBatch(out, np.array(offsets, dtype=np.intp))
+
+
+def error_bound(array, compression=COMPRESSION_NONE, significant_bits=DEFAULT_SIGNIFICANT_BITS):
+    """Compute the largest absolute error that encoding ``array`` with
+    ``compression`` can introduce.
+
+    Lossless compression methods always return 0.
+
+    Parameters
+    ----------
+    array : :class:`np.ndarray`
+        The data to be encoded
+    compression : str, optional
+        The compression method to use, a key of :data:`compression_map`
+    significant_bits : int, optional
+        The number of explicit mantissa bits kept by mantissa truncation
+
+    Returns
+    -------
+    float
+
+    Raises
+    ------
+    ValueError
+        If ``compression`` is unknown, or cannot encode ``array``
+    """
+    if compression in truncation_codecs:
+        array = np.asanyarray(array)
+        if array.size == 0:
+            return 0.
+        return float(np.max(np.abs(array))) * 2.0 ** -significant_bits
+    if compression in numpress_codecs:
+        bound = numpress_codecs[compression][2]
+        return bound(np.asanyarray(array).astype(NUMPRESS_DTYPE))
+    if compression not in compression_map:
+        raise ValueError("Unknown compression: %s" % compression)
+    return 0.
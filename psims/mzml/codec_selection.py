@@ -0,0 +1,364 @@
+"""Adaptive selection of the compression method used for each type of binary data array.
+
+m/z, intensity, and other arrays compress very differently, so rather than use a single
+compression method for every array, :class:`AdaptiveCompressionSelector` measures the size
+and encoding time of every candidate compression method on a sample of the arrays of each
+type, and then locks in the combination which produces the smallest output while staying within
+the time budget set by a :class:`CompressionPolicy`.
+
+Spectra and chromatograms are sampled and chosen for separately, each with its own time
+budget, as their arrays of the same type, like ``"intensity array"``, differ in shape and size.
+
+A lossy compression method is only locked in for the arrays it was sampled on. Every later
+array is checked against the policy's error tolerance, and one which the method would encode
+with too much error, or cannot encode at all, is written with the best lossless method instead.
+"""
+from collections import namedtuple, defaultdict, OrderedDict
+from numbers import Number
+from timeit import default_timer as timer
+
+try:
+    from collections import Mapping
+except ImportError:
+    from collections.abc import Mapping
+
+import numpy as np
+
+from .binary_encoding import (
+    encode_array, error_bound,
+    COMPRESSION_NONE, COMPRESSION_ZLIB,
+    COMPRESSION_NUMPRESS_LINEAR, COMPRESSION_NUMPRESS_LINEAR_ZLIB,
+    COMPRESSION_NUMPRESS_PIC, COMPRESSION_NUMPRESS_PIC_ZLIB,
+    COMPRESSION_NUMPRESS_SLOF, COMPRESSION_NUMPRESS_SLOF_ZLIB)
+
+
+COMPRESSION_AUTO = 'auto'
+
+
+CodecChoice = namedtuple("CodecChoice", ("compression", "level"))
+
+CodecMeasurement = namedtuple("CodecMeasurement", (
+    "array_type", "compression", "level", "ratio", "time", "selected", "entity_kind", "fallbacks"))
+
+SPECTRUM = 'spectrum'
+CHROMATOGRAM = 'chromatogram'
+
+
+DEFAULT_CODEC = CodecChoice(COMPRESSION_ZLIB, None)
+
+
+LOSSY_CODECS = (
+    COMPRESSION_NUMPRESS_LINEAR, COMPRESSION_NUMPRESS_LINEAR_ZLIB,
+    COMPRESSION_NUMPRESS_PIC, COMPRESSION_NUMPRESS_PIC_ZLIB,
+    COMPRESSION_NUMPRESS_SLOF, COMPRESSION_NUMPRESS_SLOF_ZLIB,
+)
+
+
+class CompressionPolicy(object):
+    """Describes the constraints on the compression methods :class:`AdaptiveCompressionSelector`
+    may choose from.
+
+    Attributes
+    ----------
+    max_time_per_spectrum : float or None
+        The maximum number of seconds to spend encoding all of the arrays of a single
+        spectrum, or of a single chromatogram. If :const:`None`, the smallest encoding is
+        always chosen.
+    sample_size : int
+        The number of spectra or chromatograms to measure before choosing compression methods
+    zlib_levels : tuple
+        The zlib compression levels to consider
+    max_error : float, :class:`Mapping`, or None
+        The largest absolute error a lossy compression method may introduce. May be a mapping
+        from array type to error to set different tolerances for each array type. If :const:`None`,
+        only lossless compression methods are considered.
+    """
+
+    def __init__(self, max_time_per_spectrum=None, sample_size=10, zlib_levels=(1, 6, 9), max_error=None):
+        self.max_time_per_spectrum = max_time_per_spectrum
+        self.sample_size = sample_size
+        self.zlib_levels = tuple(zlib_levels)
+        self.max_error = max_error
+
+    def error_tolerance(self, array_type):
+        if self.max_error is None:
+            return None
+        if isinstance(self.max_error, Mapping):
+            return self.max_error.get(array_type)
+        return self.max_error
+
+    def candidates(self, array_type):
+        """List the compression methods which may be used for ``array_type``
+
+        Parameters
+        ----------
+        array_type : str
+
+        Returns
+        -------
+        list of :class:`CodecChoice`
+        """
+        candidates = [CodecChoice(COMPRESSION_NONE, None)]
+        candidates.extend(CodecChoice(COMPRESSION_ZLIB, level) for level in self.zlib_levels)
+        if self.error_tolerance(array_type) is not None:
+            candidates.extend(CodecChoice(compression, None) for compression in LOSSY_CODECS)
+        return candidates
+
+    def __repr__(self):
+        template = ("{self.__class__.__name__}(max_time_per_spectrum={self.max_time_per_spectrum}, "
+                    "sample_size={self.sample_size}, zlib_levels={self.zlib_levels}, "
+                    "max_error={self.max_error})")
+        return template.format(self=self)
+
+
+class _CodecStatistics(object):
+    __slots__ = ('raw_size', 'encoded_size', 'time', 'acceptable')
+
+    def __init__(self):
+        self.raw_size = 0
+        self.encoded_size = 0
+        self.time = 0.0
+        self.acceptable = True
+
+    @property
+    def ratio(self):
+        if self.encoded_size == 0:
+            return 0.0
+        return self.raw_size / float(self.encoded_size)
+
+
+class AdaptiveCompressionSelector(object):
+    """Chooses a compression method for each type of binary data array from measurements
+    taken on the first few spectra or chromatograms written.
+
+    Until an array type has been seen in :attr:`policy.sample_size` entities, every candidate
+    compression method is applied to each array of that type and measured, and :const:`DEFAULT_CODEC`
+    is used. Once enough samples have been taken, the compression methods for all of the array types
+    being sampled are chosen together by starting from the fastest method for each array type, then
+    repeatedly switching to whichever smaller encoding saves the most space per second of extra
+    encoding time, until the time budget is exhausted. Array types which first appear after this
+    point are sampled in the same way and are chosen using the remaining time budget.
+
+    Spectra and chromatograms are sampled separately, and each has the whole time budget.
+
+    Attributes
+    ----------
+    policy : :class:`CompressionPolicy`
+        The constraints on the selection
+    statistics : :class:`OrderedDict`
+        Maps ``(entity_kind, array_type)`` to a mapping from :class:`CodecChoice` to the
+        measured statistics
+    selected : :class:`OrderedDict`
+        Maps ``(entity_kind, array_type)`` to the :class:`CodecChoice` chosen for it
+    fallbacks : :class:`OrderedDict`
+        Maps ``(entity_kind, array_type)`` to the number of arrays written with its lossless
+        fallback because the lossy :class:`CodecChoice` chosen for it could not encode them
+        within the error tolerance
+    """
+
+    def __init__(self, policy=None):
+        if policy is None:
+            policy = CompressionPolicy()
+        elif isinstance(policy, Number):
+            policy = CompressionPolicy(max_time_per_spectrum=policy)
+        self.policy = policy
+        self.statistics = OrderedDict()
+        self.selected = OrderedDict()
+        self.fallbacks = OrderedDict()
+        self._fallback_choices = {}
+        self._entities_sampled = defaultdict(int)
+        self._observed_in_entity = set()
+
+    def select(self, array_type, array, dtype, entity_kind=SPECTRUM):
+        """Choose the compression method for ``array``, measuring the candidates
+        if ``array_type`` is still being sampled.
+
+        Parameters
+        ----------
+        array_type : str
+            The kind of array being encoded
+        array : :class:`np.ndarray`
+            The array to be encoded
+        dtype : type
+            The type the array will be encoded as
+        entity_kind : str, optional
+            :const:`SPECTRUM` or :const:`CHROMATOGRAM`, the kind of entity the array belongs to
+
+        Returns
+        -------
+        :class:`CodecChoice`
+        """
+        key = (entity_kind, array_type)
+        try:
+            choice = self.selected[key]
+        except KeyError:
+            pass
+        else:
+            if choice.compression in LOSSY_CODECS and not self._within_tolerance(
+                    key, choice, array, dtype):
+                self.fallbacks[key] = self.fallbacks.get(key, 0) + 1
+                return self._fallback(key)
+            return choice
+        self._measure(key, array, dtype)
+        self._observed_in_entity.add(key)
+        return DEFAULT_CODEC
+
+    def _measure(self, key, array, dtype):
+        array_type = key[1]
+        try:
+            statistics = self.statistics[key]
+        except KeyError:
+            statistics = self.statistics[key] = OrderedDict(
+                (candidate, _CodecStatistics()) for candidate in self.policy.candidates(array_type))
+        array = np.asarray(array, dtype=dtype)
+        tolerance = self.policy.error_tolerance(array_type)
+        for candidate, stats in statistics.items():
+            if not stats.acceptable:
+                continue
+            try:
+                if candidate.compression in LOSSY_CODECS and error_bound(
+                        array, candidate.compression) > tolerance:
+                    stats.acceptable = False
+                    continue
+                start = timer()
+                encoded = encode_array(
+                    array, compression=candidate.compression, dtype=dtype,
+                    compression_level=candidate.level)
+                elapsed = timer() - start
+            except ValueError:
+                stats.acceptable = False
+                continue
+            stats.time += elapsed
+            stats.raw_size += array.nbytes
+            stats.encoded_size += len(encoded)
+
+    def _within_tolerance(self, key, choice, array, dtype):
+        try:
+            bound = error_bound(np.asarray(array, dtype=dtype), choice.compression)
+        except ValueError:
+            return False
+        return bound <= self.policy.error_tolerance(key[1])
+
+    def _fallback(self, key):
+        # The smallest lossless method no slower than the lossy method chosen, or the
+        # fastest lossless method if none are
+        try:
+            return self._fallback_choices[key]
+        except KeyError:
+            pass
+        statistics = self.statistics[key]
+        limit = statistics[self.selected[key]].time
+        options = sorted(
+            (stats.time, stats.encoded_size, candidate) for candidate, stats in statistics.items()
+            if stats.acceptable and candidate.compression not in LOSSY_CODECS)
+        within = [option for option in options if option[0] <= limit]
+        if within:
+            choice = min(within, key=lambda option: option[1])[2]
+        elif options:
+            choice = options[0][2]
+        else:
+            choice = DEFAULT_CODEC
+        self._fallback_choices[key] = choice
+        return choice
+
+    def end_entity(self):
+        """Mark the end of a spectrum or chromatogram, and choose compression methods
+        for any array types which have been sampled sufficiently.
+        """
+        for key in self._observed_in_entity:
+            self._entities_sampled[key] += 1
+        self._observed_in_entity.clear()
+        ready = [key for key, count in self._entities_sampled.items()
+                 if count >= self.policy.sample_size and key not in self.selected]
+        for entity_kind in sorted(set(key[0] for key in ready)):
+            self._lock([key for key in ready if key[0] == entity_kind])
+
+    def _frontier(self, key):
+        samples = float(self._entities_sampled[key])
+        options = [
+            (stats.time / samples, stats.encoded_size / samples, candidate)
+            for candidate, stats in self.statistics[key].items() if stats.acceptable]
+        options.sort(key=lambda x: (x[0], x[1]))
+        # Keep only options which are smaller than every faster option
+        frontier = []
+        for option in options:
+            if not frontier or option[1] < frontier[-1][1]:
+                frontier.append(option)
+        return frontier
+
+    def _spent_time(self, entity_kind):
+        spent = 0.0
+        for key, choice in self.selected.items():
+            if key[0] != entity_kind:
+                continue
+            stats = self.statistics[key][choice]
+            spent += stats.time / self._entities_sampled[key]
+        return spent
+
+    def _lock(self, array_types):
+        # All of ``array_types`` are (entity_kind, array_type) keys of one kind of entity
+        frontiers = {array_type: self._frontier(array_type) for array_type in array_types}
+        position = {array_type: 0 for array_type in array_types}
+        budget = self.policy.max_time_per_spectrum
+        if budget is None:
+            budget = float('inf')
+        remaining = budget - self._spent_time(array_types[0][0]) - sum(
+            frontiers[t][0][0] for t in array_types)
+        while True:
+            best = None
+            for array_type in array_types:
+                i = position[array_type]
+                frontier = frontiers[array_type]
+                if i + 1 >= len(frontier):
+                    continue
+                extra_time = frontier[i + 1][0] - frontier[i][0]
+                saved = frontier[i][1] - frontier[i + 1][1]
+                if extra_time > remaining:
+                    continue
+                rate = saved / extra_time if extra_time > 0 else float('inf')
+                if best is None or rate > best[0]:
+                    best = (rate, array_type, extra_time)
+            if best is None:
+                break
+            _, array_type, extra_time = best
+            position[array_type] += 1
+            remaining -= extra_time
+        for array_type in array_types:
+            self.selected[array_type] = frontiers[array_type][position[array_type]][2]
+
+    def report(self):
+        """Summarize the measurements taken for each array type and candidate compression
+        method, which were selected, and how many arrays each was used for in place of a
+        lossy selection which could not encode them.
+
+        Returns
+        -------
+        list of :class:`CodecMeasurement`
+        """
+        results = []
+        for key, statistics in self.statistics.items():
+            entity_kind, array_type = key
+            samples = float(max(self._entities_sampled[key], 1))
+            for candidate, stats in statistics.items():
+                if not stats.acceptable:
+                    continue
+                fallbacks = self.fallbacks.get(key, 0) if self._fallback_choices.get(key) == candidate else 0
+                results.append(CodecMeasurement(
+                    array_type, candidate.compression, candidate.level, stats.ratio,
+                    stats.time / samples, self.selected.get(key) == candidate, entity_kind, fallbacks))
+        return results
+
+    def format_report(self):
+        """Render :meth:`report` as a human readable table
+
+        Returns
+        -------
+        str
+        """
+        lines = ["%-12s %-24s %-22s %5s %8s %12s %9s" % (
+            "entity", "array type", "compression", "level", "ratio", "ms/entity", "fallbacks")]
+        for row in self.report():
+            lines.append("%-12s %-24s %-22s %5s %8.3f %12.4f %9d%s" % (
+                row.entity_kind, row.array_type, row.compression, '-' if row.level is None else row.level,
+                row.ratio, row.time * 1000, row.fallbacks, " *" if row.selected else ""))
+        return '\n'.join(lines)
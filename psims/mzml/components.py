@@ -13,7 +13,8 @@ from ..document import (
     XMLBindingDispatcherBase,
     ParameterContainer,
     IDParameterContainer)
-from .binary_encoding import dtype_to_encoding, compression_map, encode_array
+from .binary_encoding import dtype_to_encoding, compression_map, encode_array, StreamingArrayEncoder
+from .index import report_offset
 from .utils import ensure_iterable, basestring
 
 
@@ -609,6 +610,10 @@ class Spectrum(ComponentBase):
                 raise ValueError(
                     "A spectrum without MS:100511 'ms level' and cannot be determined from other parameters")
 
+    def write(self, xml_file):
+        report_offset(xml_file, 'spectrum', self.element.id, self.index)
+        super(Spectrum, self).write(xml_file)
+
     def write_content(self, xml_file):
         self.write_params(xml_file)
         if (self.scan_list is not None):
@@ -711,6 +716,19 @@ class BinaryDataArray(ComponentBase):
     def array_type(self, value):
         self._array_type = value
 
+    def resolve(self):
+        """Wait for the encoding of :attr:`binary` to finish if it was deferred,
+        and fill in :attr:`encoded_length`.
+        """
+        if self.encoded_length is None:
+            self.binary.resolve()
+            self.encoded_length = len(self.binary.encoded_array)
+            self.element.attrs['encodedLength'] = self.encoded_length
+
+    def begin(self, xml_file=None, with_id=None):
+        self.resolve()
+        return super(BinaryDataArray, self).begin(xml_file, with_id)
+
     def write_content(self, xml_file):
         self.write_params(xml_file)
         self.binary.write(xml_file)
@@ -742,6 +760,13 @@ class BinaryDataArray(ComponentBase):
 
 
 class Binary(ComponentBase):
+    """Holds the encoded bytes of a binary data array.
+
+    ``encoded_array`` may also be a :class:`concurrent.futures.Future` which will
+    produce the encoded bytes, in which case it will be waited on when the element
+    is written or :meth:`resolve` is called, or a :class:`~.StreamingArrayEncoder`,
+    in which case the encoded bytes are produced and written piece by piece.
+    """
     requires_id = False
 
     def __init__(self, encoded_array, context=NullMap):
@@ -749,8 +774,26 @@ class Binary(ComponentBase):
         self.context = context
         self.element = _element('binary', text=encoded_array)
 
+    def is_resolved(self):
+        return not hasattr(self.encoded_array, 'result')
+
+    def resolve(self):
+        if not self.is_resolved():
+            self.encoded_array = self.encoded_array.result()
+            self.element.text = self.encoded_array
+        return self.encoded_array
+
     def write_content(self, xml_file):
-        xml_file.write(self.encoded_array)
+        encoded_array = self.resolve()
+        if isinstance(encoded_array, StreamingArrayEncoder):
+            write_text_chunks = getattr(xml_file, "write_text_chunks", None)
+            if write_text_chunks is not None:
+                write_text_chunks(encoded_array)
+            else:
+                for chunk in encoded_array:
+                    xml_file.write(chunk)
+        else:
+            xml_file.write(encoded_array)
 
 
 class ScanList(ComponentBase):
@@ -939,7 +982,8 @@ class Precursor(ComponentBase):
     def write_content(self, xml_file):
         if (self.isolation_window is not None):
             self.isolation_window.write(xml_file)
-        self.selected_ion_list.write(xml_file)
+        if (self.selected_ion_list is not None):
+            self.selected_ion_list.write(xml_file)
         if (self.activation is not None):
             self.activation.write(xml_file)
 
@@ -1063,6 +1107,10 @@ class Chromatogram(ComponentBase):
         self.context['Chromatogram'][id] = self.element.id
         self.params = params
 
+    def write(self, xml_file):
+        report_offset(xml_file, 'chromatogram', self.element.id, self.index)
+        super(Chromatogram, self).write(xml_file)
+
     def write_content(self, xml_file):
         self.write_params(xml_file)
         if (self.precursor is not None):
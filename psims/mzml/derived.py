@@ -0,0 +1,252 @@
+"""Chromatograms derived from the spectra of a run while they are written.
+
+A :class:`~.PlainMzMLWriter` given ``derived_chromatograms`` passes the time, m/z array and
+intensity array of every spectrum it builds to each :class:`ChromatogramAccumulator`, which
+reduces the spectrum to one point per trace and appends it to a :class:`GrowableArray`. The
+traces are written as chromatograms when the ``<chromatogramList>`` closes, so producing them
+does not need a second pass over the spectra.
+
+Start times given with a unit, like ``{"value": 90, "unit_name": "second"}``, are converted to
+minutes, the unit of the chromatograms' time arrays and of start times given as plain numbers.
+The writer adds the ``"name": "scan start time"`` such a mapping needs when it is left out.
+Spectra without a numeric ``scan_start_time``, and spectra of an MS level other than the one
+an accumulator follows, are skipped. Spectra rendered by :func:`~.write_spectrum_shards` are
+not seen by the coordinating writer, and do not contribute.
+"""
+import numbers
+
+import numpy as np
+
+try:
+    from collections import Mapping
+except ImportError:
+    from collections.abc import Mapping
+
+
+class GrowableArray(object):
+    """An array of rows which doubles its storage as rows are appended, so
+    that appending one row at a time takes amortized constant time.
+
+    Attributes
+    ----------
+    width : int or None
+        The number of values in each row, or :const:`None` for scalar rows
+    size : int
+        The number of rows appended so far
+    """
+
+    def __init__(self, width=None, dtype=np.float64, capacity=256):
+        self.width = width
+        self.size = 0
+        shape = (capacity, ) if width is None else (capacity, width)
+        self._storage = np.zeros(shape, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, row):
+        if self.size == len(self._storage):
+            storage = np.zeros((len(self._storage) * 2, ) + self._storage.shape[1:],
+                               dtype=self._storage.dtype)
+            storage[:self.size] = self._storage
+            self._storage = storage
+        self._storage[self.size] = row
+        self.size += 1
+
+    @property
+    def array(self):
+        """A view of the rows appended so far
+
+        Returns
+        -------
+        :class:`numpy.ndarray`
+        """
+        return self._storage[:self.size]
+
+
+def _ms_level(params):
+    for param in params or ():
+        if isinstance(param, Mapping):
+            if param.get('name') == 'ms level' or param.get('accession') == 'MS:1000511':
+                return param.get('value')
+            if 'ms level' in param:
+                return param['ms level']
+        elif isinstance(param, (tuple, list)) and len(param) == 2 and param[0] == 'ms level':
+            return param[1]
+    return None
+
+
+# The unit of the start times recorded from spectra
+TIME_UNIT = 'minute'
+
+# The number of each unit a start time may be given in per minute, by name and by accession
+_UNITS_PER_MINUTE = {
+    'minute': 1.0, 'UO:0000031': 1.0,
+    'second': 60.0, 'UO:0000010': 60.0,
+    'millisecond': 60000.0, 'UO:0000028': 60000.0,
+    'hour': 1 / 60.0, 'UO:0000032': 1 / 60.0,
+}
+
+
+def _start_time(scan_start_time):
+    """Get the start time of a spectrum in :const:`TIME_UNIT`, or :const:`None` if it
+    was not given as a number
+
+    Raises
+    ------
+    ValueError
+        If the start time is given in a unit which is not a unit of time
+    """
+    unit = None
+    if isinstance(scan_start_time, Mapping):
+        unit = (scan_start_time.get('unit_name') or scan_start_time.get('unitName') or
+                scan_start_time.get('unit_accession') or scan_start_time.get('unitAccession'))
+        scan_start_time = scan_start_time.get('value')
+    if not isinstance(scan_start_time, numbers.Number):
+        return None
+    if unit is None:
+        return scan_start_time
+    try:
+        return scan_start_time / _UNITS_PER_MINUTE[unit]
+    except KeyError:
+        raise ValueError("Cannot convert a scan start time in %r to %ss" % (unit, TIME_UNIT))
+
+
+class ChromatogramAccumulator(object):
+    """Reduces each spectrum of one MS level to a point on one or more traces.
+
+    Attributes
+    ----------
+    ids : list of str
+        The id of the chromatogram written for each trace
+    ms_level : int or None
+        The MS level of the spectra to include. Spectra without an ``"ms level"``
+        parameter are always included. If :const:`None`, all spectra are included.
+    times : :class:`GrowableArray`
+        The start time of each spectrum included, in :const:`TIME_UNIT`
+    values : :class:`GrowableArray`
+        The value of each trace for each spectrum included, one row per spectrum
+    """
+
+    chromatogram_type = None
+
+    def __init__(self, ids, ms_level=1):
+        self.ids = list(ids)
+        self.ms_level = ms_level
+        self.times = GrowableArray()
+        self.values = GrowableArray(len(self.ids))
+
+    def add(self, arguments):
+        """Add the spectrum described by the arguments of :meth:`~.PlainMzMLWriter.write_spectrum`
+
+        Parameters
+        ----------
+        arguments : dict
+        """
+        time = _start_time(arguments.get('scan_start_time'))
+        if time is None or arguments.get('mz_array') is None or arguments.get('intensity_array') is None:
+            return
+        if self.ms_level is not None:
+            ms_level = _ms_level(arguments.get('params'))
+            if ms_level is not None and int(ms_level) != self.ms_level:
+                return
+        self.times.append(time)
+        self.values.append(self.reduce(
+            np.asarray(arguments['mz_array']), np.asarray(arguments['intensity_array'])))
+
+    def reduce(self, mz_array, intensity_array):
+        """Compute the value of each trace for one spectrum
+
+        Parameters
+        ----------
+        mz_array : :class:`numpy.ndarray`
+        intensity_array : :class:`numpy.ndarray`
+
+        Returns
+        -------
+        :class:`numpy.ndarray` or float
+        """
+        raise NotImplementedError()
+
+    def chromatograms(self):
+        """Produce the arguments of :meth:`~.PlainMzMLWriter.write_chromatogram`
+        for each trace
+
+        Yields
+        ------
+        dict
+        """
+        times = self.times.array
+        values = self.values.array
+        for i, id in enumerate(self.ids):
+            yield dict(time_array=times, intensity_array=np.ascontiguousarray(values[:, i]),
+                       id=id, chromatogram_type=self.chromatogram_type, time_unit=TIME_UNIT)
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.ids!r}, {size} spectra)".format(
+            self=self, size=len(self.times))
+
+
+class TotalIonChromatogram(ChromatogramAccumulator):
+    """The summed intensity of each spectrum"""
+
+    chromatogram_type = "total ion current chromatogram"
+
+    def __init__(self, id="TIC", ms_level=1):
+        super(TotalIonChromatogram, self).__init__([id], ms_level)
+
+    def reduce(self, mz_array, intensity_array):
+        return intensity_array.sum()
+
+
+class BasePeakChromatogram(ChromatogramAccumulator):
+    """The most intense peak of each spectrum"""
+
+    chromatogram_type = "basepeak chromatogram"
+
+    def __init__(self, id="BPC", ms_level=1):
+        super(BasePeakChromatogram, self).__init__([id], ms_level)
+
+    def reduce(self, mz_array, intensity_array):
+        if len(intensity_array) == 0:
+            return 0.0
+        return intensity_array.max()
+
+
+class ExtractedIonChromatograms(ChromatogramAccumulator):
+    """The summed intensity of the peaks within ``ppm_tolerance`` of each of several
+    target m/z values.
+
+    All of the targets are extracted from a spectrum at once, by searching the cumulative
+    intensity of its peaks for the bounds of every target's window.
+
+    Attributes
+    ----------
+    targets : :class:`numpy.ndarray`
+        The target m/z values
+    ppm_tolerance : float
+        The half-width of each window, in parts-per-million of its target
+    """
+
+    chromatogram_type = "selected ion current chromatogram"
+
+    def __init__(self, targets, ppm_tolerance=20.0, ms_level=1, ids=None):
+        targets = np.asarray(targets, dtype=np.float64)
+        if ids is None:
+            ids = ["XIC mz=%0.4f" % target for target in targets]
+        super(ExtractedIonChromatograms, self).__init__(ids, ms_level)
+        self.targets = targets
+        self.ppm_tolerance = ppm_tolerance
+        width = targets * ppm_tolerance / 1e6
+        self._lower = targets - width
+        self._upper = targets + width
+
+    def reduce(self, mz_array, intensity_array):
+        if len(mz_array) > 1 and np.any(mz_array[1:] < mz_array[:-1]):
+            order = np.argsort(mz_array, kind='mergesort')
+            mz_array = mz_array[order]
+            intensity_array = intensity_array[order]
+        cumulative = np.concatenate(([0.0], np.cumsum(intensity_array, dtype=np.float64)))
+        lower = np.searchsorted(mz_array, self._lower, side='left')
+        upper = np.searchsorted(mz_array, self._upper, side='right')
+        return cumulative[upper] - cumulative[lower]
@@ -1,10 +1,12 @@
-import re
+import os
+import threading
 
 import io
 from io import BytesIO
 from collections import defaultdict, OrderedDict
 
 from six import string_types as basestring
+from six.moves import queue
 
 try:
     from collections import Sequence, Mapping
@@ -46,15 +48,19 @@ class Offset(object):
 
 
 class TagIndexerBase(object):
-    attr_pattern = re.compile(br"(\S+)=[\"']([^\"']+)[\"']")
+    """Records the byte offset of each element of one kind, by id, as the
+    writer reports them.
 
-    def __init__(self, name, pattern):
-        if isinstance(pattern, str):
-            pattern = pattern.encode("utf8")
-        if isinstance(pattern, bytes):
-            pattern = re.compile(pattern)
+    Attributes
+    ----------
+    name : str
+        The name of the elements indexed
+    index : :class:`OrderedDict`
+        The :class:`Offset` of each element, by id
+    """
+
+    def __init__(self, name):
         self.name = name
-        self.pattern = pattern
         self.index = OrderedDict()
 
     def __len__(self):
@@ -63,17 +69,19 @@ class TagIndexerBase(object):
     def __iter__(self):
         return iter(self.index.items())
 
-    def scan(self, data, distance):
-        is_match = self.pattern.search(data)
-        if is_match:
-            attrs = dict(self.attr_pattern.findall(data))
-            xid = attrs[b'id']
-            offset = Offset(distance + is_match.start(), attrs)
-            self.index[xid] = offset
-        return bool(is_match)
+    def add(self, id, offset, attrs=None):
+        """Record the offset of an element whose position is already known
 
-    def __call__(self, data, distance):
-        return self.scan(data, distance)
+        Parameters
+        ----------
+        id : str
+            The id of the element
+        offset : int
+            The position of the element's start tag
+        attrs : dict, optional
+            The attributes of the element
+        """
+        self.index[id] = Offset(offset, attrs if attrs is not None else {})
 
     def write(self, writer):
         writer.write("    <index name=\"{}\">\n".format(self.name).encode('utf-8'))
@@ -91,14 +99,12 @@ class TagIndexerBase(object):
 
 class SpectrumIndexer(TagIndexerBase):
     def __init__(self):
-        super(SpectrumIndexer, self).__init__(
-            'spectrum', re.compile(b"<spectrum "))
+        super(SpectrumIndexer, self).__init__('spectrum')
 
 
 class ChromatogramIndexer(TagIndexerBase):
     def __init__(self):
-        super(ChromatogramIndexer, self).__init__(
-            'chromatogram', re.compile(b"<chromatogram "))
+        super(ChromatogramIndexer, self).__init__('chromatogram')
 
 
 class IndexList(Sequence):
@@ -109,8 +115,8 @@ class IndexList(Sequence):
     Attributes
     ----------
     indexers : list
-        A list of :class:`TagIndexerBase`-derived objects to use when
-        extracting indices from XML
+        A list of :class:`TagIndexerBase`-derived objects which record
+        the offsets of the elements written
     """
 
     def __init__(self, indexers=None):
@@ -127,15 +133,6 @@ class IndexList(Sequence):
     def __iter__(self):
         return iter(self.indexers)
 
-    def test(self, data, distance):
-        for indexer in self:
-            if indexer(data, distance):
-                return True
-        return False
-
-    def __call__(self, data, distance):
-        return self.test(data, distance)
-
     def write_index_list_xml(self, writer, distance):
         offset = distance
         n = len(self)
@@ -149,25 +146,273 @@ class IndexList(Sequence):
     def add(self, indexer):
         self.indexers.append(indexer)
 
+    def get(self, name):
+        """Find the indexer for elements called ``name``
+
+        Returns
+        -------
+        :class:`TagIndexerBase` or None
+        """
+        for indexer in self:
+            if indexer.name == name:
+                return indexer
+        return None
+
+
+READBACK_CHUNK_SIZE = 2 ** 20
+HASH_QUEUE_SIZE = 16
+
+
+def _open_for_reading(stream):
+    """Get a readable handle on what has been written to ``stream``,
+    reopening it by name if it was opened write-only.
+
+    Returns
+    -------
+    file-like
+    """
+    try:
+        if stream.readable():
+            return stream
+    except AttributeError:
+        pass
+    try:
+        return open(stream.name, 'rb')
+    except (AttributeError, TypeError, IOError, OSError):
+        raise ValueError("Cannot read back from %r" % (stream, ))
+
+
+def is_patchable(stream):
+    """Check whether previously written bytes of ``stream`` can be overwritten
+    and read back
+
+    Streams which claim to be seekable are probed, as some, like a :class:`gzip.GzipFile`
+    opened for writing, can only seek forward, and reopening them by name does not read
+    back what was written to them.
+
+    Returns
+    -------
+    bool
+    """
+    try:
+        if not stream.seekable():
+            return False
+    except AttributeError:
+        return False
+    try:
+        stream.flush()
+        position = stream.tell()
+        if position > 0:
+            stream.seek(position - 1)
+            stream.seek(position)
+    except (AttributeError, ValueError, IOError, OSError):
+        return False
+    try:
+        reader = _open_for_reading(stream)
+    except ValueError:
+        return False
+    if reader is stream:
+        return True
+    # What is read back by name must be exactly what was written
+    try:
+        reader.seek(0, os.SEEK_END)
+        return reader.tell() == position
+    finally:
+        reader.close()
+
+
+class Placeholder(object):
+    """A fixed-width token written to a seekable stream, to be overwritten in place
+    once its value is known.
+
+    Attributes
+    ----------
+    stream : file-like
+        The stream the token is written to
+    token : bytes
+        The token, which must appear exactly once in the next :attr:`search_size`
+        bytes written after the placeholder is created
+    start : int
+        The position of the stream when the placeholder was created
+    """
+    search_size = 2 ** 16
+
+    def __init__(self, stream, token):
+        if isinstance(token, str):
+            token = token.encode('utf8')
+        self.stream = stream
+        self.token = token
+        stream.flush()
+        self.start = stream.tell()
+
+    def fill(self, value):
+        """Overwrite the token with ``value``, which must have the same width
+
+        Parameters
+        ----------
+        value : bytes or str
+        """
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        if len(value) != len(self.token):
+            raise ValueError("%r does not fit in a placeholder of width %d" % (value, len(self.token)))
+        self.stream.flush()
+        end = self.stream.tell()
+        reader = _open_for_reading(self.stream)
+        try:
+            reader.seek(self.start)
+            position = reader.read(min(self.search_size, end - self.start)).find(self.token)
+        finally:
+            if reader is not self.stream:
+                reader.close()
+        if position == -1:
+            raise ValueError("Placeholder %r was not written" % (self.token, ))
+        self.stream.seek(self.start + position)
+        self.stream.write(value)
+        self.stream.seek(end)
+
+
+_STOP_HASHING = None
+
 
 class HashingStream(object):
-    def __init__(self, stream):
+    """Wraps a writable stream, counting the bytes written and computing their SHA-1
+    checksum.
+
+    Small writes, like the fragments produced by the XML writer, may be collected into
+    blocks of ``buffer_size`` bytes before they are written to :attr:`stream` and added
+    to the checksum. The checksum may also be computed on a helper thread, which
+    :mod:`hashlib` allows to run alongside the writing thread for large blocks. Neither
+    changes :attr:`accumulator` or the checksum.
+
+    Attributes
+    ----------
+    stream : file-like
+        The stream written to
+    accumulator : int
+        The number of bytes written, including those still buffered
+    buffer_size : int
+        The number of bytes to collect before writing them to :attr:`stream`. If 0,
+        every write is passed through immediately.
+    threaded_checksum : bool
+        Whether the checksum is computed on a helper thread
+    """
+
+    def __init__(self, stream, buffer_size=0, threaded_checksum=False):
         if isinstance(stream, basestring):
-            stream = open(stream, 'wb')
+            stream = open(stream, 'w+b')
         self.stream = stream
         self._checksum = sha1()
+        self._held_at = None
         self.accumulator = 0
+        self.buffer_size = buffer_size
+        self.threaded_checksum = threaded_checksum
+        self._buffer = []
+        self._buffered = 0
+        self._hash_queue = None
+        self._hash_thread = None
 
     def write(self, b):
+        size = len(b)
+        self.accumulator += size
+        if not self.buffer_size:
+            self._write_through(b)
+            return size
+        if not isinstance(b, bytes):
+            # The block is written later, so it must not change in the meantime
+            b = bytes(b)
+        self._buffer.append(b)
+        self._buffered += size
+        if self._buffered >= self.buffer_size:
+            self._drain()
+        return size
+
+    def _write_through(self, b):
         self.stream.write(b)
-        self._checksum.update(b)
-        self.accumulator += len(b)
-        return len(b)
+        if self._held_at is None:
+            self._update_checksum(b)
+
+    def _drain(self):
+        if not self._buffer:
+            return
+        if len(self._buffer) == 1:
+            data = self._buffer[0]
+        else:
+            data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._write_through(data)
+
+    def _update_checksum(self, data):
+        if not self.threaded_checksum:
+            self._checksum.update(data)
+            return
+        if self._hash_queue is None:
+            self._hash_queue = queue.Queue(HASH_QUEUE_SIZE)
+            self._hash_thread = threading.Thread(target=self._hash_stage, name="psims-checksum")
+            self._hash_thread.daemon = True
+            self._hash_thread.start()
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self._hash_queue.put(data)
+
+    def _hash_stage(self):
+        while True:
+            data = self._hash_queue.get()
+            try:
+                if data is _STOP_HASHING:
+                    return
+                self._checksum.update(data)
+            finally:
+                self._hash_queue.task_done()
+
+    def _stop_checksum(self):
+        if self._hash_queue is not None:
+            self._hash_queue.put(_STOP_HASHING)
+            self._hash_thread.join()
+            self._hash_queue = self._hash_thread = None
+
+    def hold_checksum(self):
+        """Stop adding written bytes to the checksum, so that they may be changed in
+        place, like a :class:`Placeholder`, until :meth:`release_checksum` is called.
+        """
+        if self._held_at is not None:
+            raise ValueError("The checksum is already being held")
+        self.flush()
+        self._held_at = self.stream.tell()
+
+    def release_checksum(self):
+        """Read back everything written since :meth:`hold_checksum` was called
+        and add it to the checksum.
+        """
+        if self._held_at is None:
+            return
+        self.flush()
+        end = self.stream.tell()
+        remaining = end - self._held_at
+        reader = _open_for_reading(self.stream)
+        try:
+            reader.seek(self._held_at)
+            while remaining > 0:
+                chunk = reader.read(min(READBACK_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self._update_checksum(chunk)
+                remaining -= len(chunk)
+        finally:
+            if reader is self.stream:
+                self.stream.seek(end)
+            else:
+                reader.close()
+        self._held_at = None
 
     def flush(self):
+        self._drain()
         self.stream.flush()
 
     def close(self):
+        self._drain()
+        self._stop_checksum()
         self.stream.close()
 
     def writable(self):
@@ -178,46 +423,59 @@ class HashingStream(object):
         return self.stream.name
 
     def checksum(self):
+        self._drain()
+        # The helper thread is started again if anything more is written
+        self._stop_checksum()
         return self._checksum.hexdigest()
 
 
 class IndexingStream(HashingStream):
-    def __init__(self, stream):
-        super(IndexingStream, self).__init__(stream)
+    """A :class:`HashingStream` which records where each spectrum and chromatogram
+    starts, to write the index of an indexed mzML document.
+
+    The writer reports each element with :meth:`mark` just before writing it, after
+    flushing anything written before it, so the element's start tag is the first
+    ``<`` written afterwards. The rest of the document is passed through without
+    being searched.
+    """
+
+    def __init__(self, stream, buffer_size=0, threaded_checksum=False):
+        super(IndexingStream, self).__init__(stream, buffer_size, threaded_checksum)
         self.indices = IndexList()
         self.indices.add(SpectrumIndexer())
         self.indices.add(ChromatogramIndexer())
-
-    def tokenize(self, buff):
-        delim = b'<'
-        started_with_delim = buff.startswith(delim)
-        parts = buff.split(delim)
-        tail = parts[-1]
-        front = parts[:-1]
-        i = 0
-        for part in front:
-            i += 1
-            if part == b"":
-                continue
-            if i == 1:
-                if started_with_delim:
-                    yield delim + part
-                else:
-                    yield part
-            else:
-                yield delim + part
-        if tail.strip() and i > 0:
-            yield delim + tail
-        else:
-            yield tail
+        self.file_checksum = None
+        self._pending = None
+
+    def mark(self, name, id, index=None):
+        """Record that the next element written is the element called ``name``
+        with the given ``id``
+
+        Parameters
+        ----------
+        name : str
+            The name of the element, like ``"spectrum"`` or ``"chromatogram"``
+        id : str
+            The id of the element
+        index : int, optional
+            The index of the element
+        """
+        indexer = self.indices.get(name)
+        if indexer is None:
+            return
+        attrs = {b'id': str(id).encode('utf-8')}
+        if index is not None:
+            attrs[b'index'] = str(index).encode('utf-8')
+        self._pending = (indexer, id, attrs)
 
     def write(self, data):
-        for line in self.tokenize(data):
-            self.indices.test(line, self.accumulator)
-            super(IndexingStream, self).write(line)
-
-    def _raw_write(self, data):
-        super(IndexingStream, self).write(data)
+        if self._pending is not None:
+            position = data.find(b'<')
+            if position != -1:
+                indexer, id, attrs = self._pending
+                indexer.add(id, self.accumulator + position, attrs)
+                self._pending = None
+        return super(IndexingStream, self).write(data)
 
     def write_index(self, index, name):
         self.write("    <index name=\"{}\">\n".format(name).encode('utf-8'))
@@ -240,4 +498,27 @@ class IndexingStream(HashingStream):
         self.indices.write_index_list_xml(writer, offset)
         with writer.element("fileChecksum"):
             writer.flush()
-            writer.write(self.checksum())
+            self.file_checksum = self.checksum()
+            writer.write(self.file_checksum)
+
+
+def report_offset(xml_file, name, id, index=None):
+    """Tell the :class:`IndexingStream` beneath ``xml_file``, if there is one, that the
+    element called ``name`` is written next
+
+    Parameters
+    ----------
+    xml_file : :class:`~.XMLFormattingStreamWriter`
+        The writer the element will be written with
+    name : str
+        The name of the element
+    id : str
+        The id of the element
+    index : int, optional
+        The index of the element
+    """
+    mark = getattr(getattr(xml_file, 'stream', None), 'mark', None)
+    if mark is None:
+        return
+    xml_file.flush()
+    mark(name, id, index)
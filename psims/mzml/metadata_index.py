@@ -0,0 +1,240 @@
+"""A columnar index of the metadata of each spectrum, collected while the spectra are written.
+
+A :class:`~.PlainMzMLWriter` given a :class:`SpectrumMetadataIndex` as ``metadata_index`` passes
+the arguments of every spectrum it builds to :meth:`SpectrumMetadataIndex.add`, which records
+its start time in minutes, MS level, the m/z and charge of its first precursor, and the bounds of that
+precursor's isolation window. When the document is complete, the byte offset of each spectrum
+is filled in from the document's index, and the columns are saved beside the document as an
+uncompressed NumPy ``.npz`` file, so questions like "which MS2 spectra isolated a precursor
+between 500 and 510 m/z in the first ten minutes" are answered by :meth:`~.SpectrumMetadataIndex.query`
+without reading the mzML file.
+
+Start times given in other units, like ``{"value": 90, "unit_name": "second"}``, are converted
+to minutes, as they are for derived chromatograms, so that the ``scan_start_time`` column holds
+one unit throughout.
+Values which are not given are recorded as NaN, or 0 for charge and -1 for the MS level and
+offset. Only precursors given as a :class:`Mapping` are read, and, as with derived
+chromatograms, spectra rendered by :func:`~.write_spectrum_shards` are not seen.
+"""
+import numpy as np
+
+from six import string_types as basestring
+
+try:
+    from collections import Mapping
+except ImportError:
+    from collections.abc import Mapping
+
+from .derived import GrowableArray, _ms_level, _start_time
+
+
+METADATA_SUFFIX = '.meta.npz'
+
+COLUMNS = ('scan_start_time', 'ms_level', 'precursor_mz', 'charge',
+           'isolation_window_lower', 'isolation_window_upper', 'offset')
+
+_MISSING = {
+    'scan_start_time': np.nan,
+    'ms_level': -1,
+    'precursor_mz': np.nan,
+    'charge': 0,
+    'isolation_window_lower': np.nan,
+    'isolation_window_upper': np.nan,
+    'offset': -1,
+}
+
+
+def _first_precursor(precursor_information):
+    if isinstance(precursor_information, Mapping):
+        return precursor_information
+    if isinstance(precursor_information, (list, tuple)):
+        for precursor in precursor_information:
+            if isinstance(precursor, Mapping):
+                return precursor
+    return None
+
+
+def _number(value, missing):
+    if value is None:
+        return missing
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return missing
+
+
+def _in_range(column, bounds):
+    low, high = bounds
+    mask = np.ones(len(column), dtype=bool)
+    if low is not None:
+        mask &= column >= low
+    if high is not None:
+        mask &= column <= high
+    return mask
+
+
+class SpectrumMetadataIndex(object):
+    """The start time, MS level, precursor and byte offset of each spectrum of a document.
+
+    Attributes
+    ----------
+    path : str, file-like or None
+        Where to save the index once the document is complete
+    ids : list of str
+        The id of each spectrum, in the order they were written
+    columns : dict
+        The :class:`numpy.ndarray` of each of :const:`COLUMNS`, once the index
+        is complete or loaded. ``scan_start_time`` is in :const:`~.derived.TIME_UNIT`.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.ids = []
+        self.columns = None
+        self._rows = GrowableArray(len(COLUMNS))
+
+    def __len__(self):
+        if self.columns is not None:
+            return len(self.ids)
+        return len(self._rows)
+
+    def add(self, arguments):
+        """Add the spectrum described by the arguments of :meth:`~.PlainMzMLWriter.write_spectrum`
+
+        Parameters
+        ----------
+        arguments : dict
+        """
+        time = _start_time(arguments.get('scan_start_time'))
+        ms_level = _number(_ms_level(arguments.get('params')), _MISSING['ms_level'])
+        precursor = _first_precursor(arguments.get('precursor_information'))
+        precursor_mz = charge = lower = upper = None
+        if precursor is not None:
+            precursor_mz = precursor.get('mz')
+            charge = precursor.get('charge')
+            window = precursor.get('isolation_window_args') or {}
+            target = _number(window.get('target', precursor_mz), np.nan)
+            lower = target - _number(window.get('lower'), np.nan)
+            upper = target + _number(window.get('upper'), np.nan)
+        self.ids.append(str(arguments.get('id')))
+        self._rows.append((
+            _number(time, np.nan), ms_level, _number(precursor_mz, np.nan),
+            _number(charge, 0), _number(lower, np.nan), _number(upper, np.nan), -1))
+
+    def complete(self, offsets=None):
+        """Build the columns from the spectra added, and save them to :attr:`path`, if set
+
+        Parameters
+        ----------
+        offsets : :class:`Mapping`, optional
+            The byte offset of each spectrum by id, like the :attr:`~.TagIndexerBase.index`
+            of the document's spectra
+        """
+        rows = self._rows.array
+        columns = {}
+        for i, name in enumerate(COLUMNS):
+            dtype = np.float64 if isinstance(_MISSING[name], float) else np.int64
+            columns[name] = rows[:, i].astype(dtype)
+        if offsets:
+            columns['offset'] = np.array(
+                [int(offsets.get(id, -1)) for id in self.ids], dtype=np.int64)
+        self.columns = columns
+        if self.path is not None:
+            self.save(self.path)
+
+    def save(self, path):
+        """Save the index to ``path``, which may be a path or a writable binary file
+        """
+        arrays = dict(self.columns)
+        arrays['id'] = np.array(self.ids, dtype=np.str_)
+        if isinstance(path, basestring):
+            with open(path, 'wb') as handle:
+                np.savez(handle, **arrays)
+        else:
+            np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved by :meth:`save`
+
+        Parameters
+        ----------
+        path : str or file-like
+
+        Returns
+        -------
+        :class:`SpectrumMetadataIndex`
+        """
+        with np.load(path, allow_pickle=False) as archive:
+            inst = cls()
+            inst.ids = archive['id'].tolist()
+            inst.columns = {name: archive[name] for name in COLUMNS}
+        return inst
+
+    def _positions(self, scan_start_time):
+        times = self.columns['scan_start_time']
+        low, high = scan_start_time
+        start, end = 0, len(times)
+        # Spectra are usually written in the order they were acquired, in which case the
+        # range of times can be found by bisection
+        if len(times) > 1 and np.all(times[1:] >= times[:-1]):
+            if low is not None:
+                start = np.searchsorted(times, low, side='left')
+            if high is not None:
+                end = np.searchsorted(times, high, side='right')
+            return np.arange(start, end)
+        return np.flatnonzero(_in_range(times, scan_start_time))
+
+    def query(self, ms_level=None, scan_start_time=None, precursor_mz=None, charge=None,
+              isolated_mz=None):
+        """Find the spectra matching all of the given criteria
+
+        Parameters
+        ----------
+        ms_level : int, optional
+            The MS level of the spectra
+        scan_start_time : tuple, optional
+            The ``(low, high)`` bounds of the start time of the spectra, in minutes. Either
+            may be :const:`None`.
+        precursor_mz : tuple, optional
+            The ``(low, high)`` bounds of the m/z of the spectra's precursor
+        charge : int, optional
+            The charge of the spectra's precursor
+        isolated_mz : float, optional
+            An m/z which the isolation window of the spectra's precursor must include
+
+        Returns
+        -------
+        :class:`numpy.ndarray`
+            A structured array with the ``id`` and each of the :const:`COLUMNS` of the
+            matching spectra, in the order they were written
+        """
+        if self.columns is None:
+            self.complete()
+        columns = self.columns
+        if scan_start_time is not None:
+            positions = self._positions(scan_start_time)
+        else:
+            positions = np.arange(len(self))
+        mask = np.ones(len(positions), dtype=bool)
+        if ms_level is not None:
+            mask &= columns['ms_level'][positions] == ms_level
+        if precursor_mz is not None:
+            mask &= _in_range(columns['precursor_mz'][positions], precursor_mz)
+        if charge is not None:
+            mask &= columns['charge'][positions] == charge
+        if isolated_mz is not None:
+            mask &= (columns['isolation_window_lower'][positions] <= isolated_mz) & (
+                columns['isolation_window_upper'][positions] >= isolated_mz)
+        positions = positions[mask]
+        ids = [self.ids[i] for i in positions]
+        dtype = [('id', 'U%d' % max([len(id) for id in ids] or [1]))] + [
+            (name, columns[name].dtype) for name in COLUMNS]
+        result = np.empty(len(positions), dtype=dtype)
+        result['id'] = ids
+        for name in COLUMNS:
+            result[name] = columns[name][positions]
+        return result
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({size} spectra)".format(self=self, size=len(self))
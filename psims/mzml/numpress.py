@@ -0,0 +1,492 @@
+"""Vectorized NumPy implementations of the MS-Numpress compression
+schemes for mass spectrometry data arrays.
+
+The encodings produced here are byte-for-byte compatible with the reference
+C++ implementation (https://github.com/ms-numpress/ms-numpress), and follow
+the same conventions:
+
+- **linear prediction**: Values are scaled by a fixed point and rounded to
+  integers. The first two integers are stored verbatim, while each subsequent
+  value is stored as the residual from a linear extrapolation of the previous
+  two, written with a variable length half-byte integer code. Suitable for
+  monotonically increasing arrays like m/z and time arrays.
+- **positive integer compression (pic)**: Values are rounded to the nearest
+  positive integer and written with the variable length half-byte integer code.
+  Suitable for ion count arrays.
+- **short logged float (slof)**: Values are log-transformed, scaled by a fixed
+  point and stored as 16-bit unsigned integers. Suitable for intensity arrays.
+
+All three schemes are lossy, and each has an accompanying ``*_error_bound``
+function which reports the largest absolute error decoding could introduce
+for a given array.
+"""
+import numpy as np
+
+
+_FIXED_POINT_DTYPE = np.dtype(">f8")
+_FIRST_VALUE_DTYPE = np.dtype("<i4")
+_SLOF_DTYPE = np.dtype("<u2")
+
+_INT_MAX = 2 ** 31 - 1
+_INT_MIN = -2 ** 31
+
+_NIBBLE_SHIFTS = np.arange(0, 32, 4, dtype=np.uint32)
+
+
+def _as_float_array(data):
+    return np.ascontiguousarray(data, dtype=np.float64).reshape(-1)
+
+
+def _encode_fixed_point(fixed_point):
+    return np.array([fixed_point], dtype=_FIXED_POINT_DTYPE).tobytes()
+
+
+def _decode_fixed_point(data):
+    if len(data) < 8:
+        raise ValueError(
+            "Corrupt input data: not enough bytes to read fixed point")
+    return float(np.frombuffer(data, dtype=_FIXED_POINT_DTYPE, count=1)[0])
+
+
+def _encode_ints(values):
+    """Encode 32-bit integers as a packed stream of half bytes.
+
+    Each integer is written as a header half byte followed by its
+    significant half bytes, least significant first. A header value
+    ``h <= 8`` denotes ``h`` leading zero half bytes, while ``h > 8``
+    denotes ``h - 8`` leading ``0xf`` half bytes.
+
+    Parameters
+    ----------
+    values : :class:`np.ndarray`
+        The integers to encode, interpreted as unsigned 32-bit values
+
+    Returns
+    -------
+    bytes
+    """
+    values = np.asarray(values).astype(np.uint32)
+    n = len(values)
+    if n == 0:
+        return b''
+    nibbles = ((values[:, None] >> _NIBBLE_SHIFTS[None, :]) & 0xf).astype(np.uint8)
+    top = nibbles[:, 7]
+
+    # The number of half bytes below the highest one which differs from the
+    # leading fill value, for both zero and 0xf filled integers.
+    significant_zero = np.zeros(n, dtype=np.intp)
+    significant_ones = np.zeros(n, dtype=np.intp)
+    for i in range(8):
+        significant_zero[nibbles[:, i] != 0] = i + 1
+        significant_ones[nibbles[:, i] != 0xf] = i + 1
+
+    leading_zero = top == 0
+    leading_ones = top == 0xf
+
+    header = np.zeros(n, dtype=np.uint8)
+    count = np.full(n, 8, dtype=np.intp)
+
+    header[leading_zero] = 8 - significant_zero[leading_zero]
+    count[leading_zero] = significant_zero[leading_zero]
+
+    # The reference implementation always writes at least one half byte
+    # for integers with leading ones, even for -1.
+    fill = np.minimum(8 - significant_ones[leading_ones], 7)
+    header[leading_ones] = fill + 8
+    count[leading_ones] = 8 - fill
+
+    stream = np.empty((n, 9), dtype=np.uint8)
+    stream[:, 0] = header
+    stream[:, 1:] = nibbles
+    mask = np.arange(9)[None, :] <= count[:, None]
+    stream = stream[mask]
+    if len(stream) % 2:
+        stream = np.append(stream, np.uint8(0))
+    return ((stream[0::2] << 4) | stream[1::2]).astype(np.uint8).tobytes()
+
+
+def _decode_ints(data):
+    """Decode a packed stream of half bytes written by :func:`_encode_ints`.
+
+    The positions of the header half bytes form a chain where each
+    header determines the position of the next one. Rather than walk
+    the chain one integer at a time, the successor of every position is
+    computed at once and the chain is recovered by repeated pointer doubling,
+    keeping the whole decoding step vectorized.
+
+    Parameters
+    ----------
+    data : bytes
+
+    Returns
+    -------
+    :class:`np.ndarray`
+        The decoded integers as unsigned 32-bit values
+    """
+    packed = np.frombuffer(data, dtype=np.uint8)
+    if len(packed) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    nibbles = np.empty(len(packed) * 2, dtype=np.uint8)
+    nibbles[0::2] = packed >> 4
+    nibbles[1::2] = packed & 0xf
+    n = len(nibbles)
+
+    fill = np.where(nibbles <= 8, nibbles, nibbles - 8).astype(np.intp)
+    successor = np.arange(n + 1, dtype=np.intp)
+    successor[:n] += 9 - fill
+    np.minimum(successor, n, out=successor)
+
+    is_header = np.zeros(n + 1, dtype=bool)
+    is_header[0] = True
+    jump = successor
+    while True:
+        reached = jump[is_header]
+        if is_header[reached].all():
+            break
+        is_header[reached] = True
+        jump = jump[jump]
+    headers = np.flatnonzero(is_header[:n])
+    # A zero header in the last half byte is padding
+    if len(headers) and headers[-1] == n - 1 and nibbles[-1] == 0:
+        headers = headers[:-1]
+
+    head = nibbles[headers]
+    fill = fill[headers]
+    count = 8 - fill
+    if len(headers) and headers[-1] + count[-1] >= n:
+        raise ValueError("Corrupt input data: integer extends past end of data")
+
+    values = np.zeros(len(headers), dtype=np.uint64)
+    for i in range(8):
+        present = count > i
+        positions = headers[present] + 1 + i
+        values[present] |= nibbles[positions].astype(np.uint64) << np.uint64(4 * i)
+    negative = head > 8
+    values[negative] |= (np.uint64(0xffffffff) << (
+        4 * count[negative]).astype(np.uint64)) & np.uint64(0xffffffff)
+    return values.astype(np.uint32)
+
+
+def optimal_linear_fixed_point(data):
+    """Compute the largest fixed point which can be used to encode
+    ``data`` with :func:`encode_linear` without overflowing the 32-bit
+    residuals.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+
+    Returns
+    -------
+    float
+    """
+    data = _as_float_array(data)
+    if len(data) == 0:
+        return 0.
+    if len(data) == 1:
+        return float(np.floor(_INT_MAX / data[0]))
+    max_double = max(data[0], data[1])
+    if len(data) > 2:
+        extrapolated = data[1:-1] + (data[1:-1] - data[:-2])
+        diff = data[2:] - extrapolated
+        max_double = max(max_double, np.ceil(np.abs(diff) + 1).max())
+    return float(np.floor(_INT_MAX / max_double))
+
+
+def optimal_linear_fixed_point_mass(data, mass_accuracy):
+    """Compute the fixed point needed to encode ``data`` with :func:`encode_linear`
+    while guaranteeing an absolute error no greater than ``mass_accuracy``.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+    mass_accuracy : float
+        The largest tolerable absolute error
+
+    Returns
+    -------
+    float
+        The fixed point, or -1 if the requested accuracy cannot be achieved
+        without overflow.
+    """
+    data = _as_float_array(data)
+    if len(data) < 3:
+        return 0.
+    fixed_point = 0.5 / mass_accuracy
+    if fixed_point > optimal_linear_fixed_point(data):
+        return -1.
+    return fixed_point
+
+
+def encode_linear(data, fixed_point=None):
+    """Encode ``data`` using MS-Numpress linear prediction compression.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+        The values to encode
+    fixed_point : float, optional
+        The scaling factor to apply before rounding. If not provided,
+        :func:`optimal_linear_fixed_point` is used.
+
+    Returns
+    -------
+    bytes
+
+    Raises
+    ------
+    ValueError
+        If the residuals cannot be represented as 32-bit integers
+    """
+    data = _as_float_array(data)
+    if fixed_point is None:
+        fixed_point = optimal_linear_fixed_point(data)
+    header = _encode_fixed_point(fixed_point)
+    if len(data) == 0:
+        return header
+    ints = (data * fixed_point + 0.5).astype(np.int64)
+    first = (ints[:2] & 0xffffffff).astype("<u4").tobytes()
+    if len(data) <= 2:
+        return header + first
+    residuals = ints[2:] - 2 * ints[1:-1] + ints[:-2]
+    if residuals.max() > _INT_MAX or residuals.min() < _INT_MIN:
+        raise ValueError(
+            "Cannot encode a number that exceeds the bounds of [-INT_MAX, INT_MAX]")
+    return header + first + _encode_ints(residuals & 0xffffffff)
+
+
+def decode_linear(data):
+    """Decode a byte string produced by :func:`encode_linear`.
+
+    Parameters
+    ----------
+    data : bytes
+
+    Returns
+    -------
+    :class:`np.ndarray`
+        The decoded values as 64-bit floats
+    """
+    data = bytes(data)
+    fixed_point = _decode_fixed_point(data)
+    if len(data) == 8:
+        return np.zeros(0, dtype=np.float64)
+    if len(data) < 12:
+        raise ValueError(
+            "Corrupt input data: not enough bytes to read first value")
+    if len(data) == 12:
+        first = np.frombuffer(data, dtype=_FIRST_VALUE_DTYPE, count=1, offset=8)
+        return first.astype(np.int64) / fixed_point
+    if len(data) < 16:
+        raise ValueError(
+            "Corrupt input data: not enough bytes to read second value")
+    first = np.frombuffer(data, dtype=_FIRST_VALUE_DTYPE, count=2, offset=8).astype(np.int64)
+    residuals = _decode_ints(data[16:]).view(np.int32).astype(np.int64)
+    # Invert the second order differencing: the first differences are the
+    # running sum of the residuals, and the values the running sum of those.
+    steps = np.empty(len(residuals) + 1, dtype=np.int64)
+    steps[0] = first[1] - first[0]
+    steps[1:] = residuals
+    np.cumsum(steps, out=steps)
+    ints = np.empty(len(residuals) + 2, dtype=np.int64)
+    ints[0] = first[0]
+    ints[1:] = steps
+    np.cumsum(ints, out=ints)
+    return ints / fixed_point
+
+
+def linear_error_bound(data, fixed_point=None):
+    """The largest absolute error :func:`encode_linear` can introduce
+    when encoding ``data``.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+    fixed_point : float, optional
+
+    Returns
+    -------
+    float
+    """
+    data = _as_float_array(data)
+    if len(data) == 0:
+        return 0.
+    if fixed_point is None:
+        fixed_point = optimal_linear_fixed_point(data)
+    # Rounding is done by truncating toward zero after adding 0.5, which rounds
+    # positive values, but moves negative values by up to one and a half units.
+    if data.min() < 0:
+        return 1.5 / fixed_point
+    return 0.5 / fixed_point
+
+
+def encode_pic(data):
+    """Encode ``data`` using MS-Numpress positive integer compression.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+        The values to encode. Must be in the range [0, INT_MAX]
+
+    Returns
+    -------
+    bytes
+
+    Raises
+    ------
+    ValueError
+        If any value is negative or too large to encode
+    """
+    data = _as_float_array(data)
+    if len(data) == 0:
+        return b''
+    if data.min() < -0.5 or data.max() + 0.5 > _INT_MAX:
+        raise ValueError(
+            "Cannot use Pic to encode a number larger than INT_MAX or smaller than 0")
+    return _encode_ints((data + 0.5).astype(np.uint32))
+
+
+def decode_pic(data):
+    """Decode a byte string produced by :func:`encode_pic`.
+
+    Parameters
+    ----------
+    data : bytes
+
+    Returns
+    -------
+    :class:`np.ndarray`
+        The decoded values as 64-bit floats
+    """
+    return _decode_ints(bytes(data)).astype(np.float64)
+
+
+def pic_error_bound(data):
+    """The largest absolute error :func:`encode_pic` can introduce
+    when encoding ``data``.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+
+    Returns
+    -------
+    float
+
+    Raises
+    ------
+    ValueError
+        If :func:`encode_pic` cannot encode ``data``
+    """
+    data = _as_float_array(data)
+    if len(data) == 0:
+        return 0.
+    if data.min() < -0.5 or data.max() + 0.5 > _INT_MAX:
+        raise ValueError(
+            "Cannot use Pic to encode a number larger than INT_MAX or smaller than 0")
+    return 0.5
+
+
+def optimal_slof_fixed_point(data):
+    """Compute the largest fixed point which can be used to encode
+    ``data`` with :func:`encode_slof` without overflowing 16-bit integers.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+
+    Returns
+    -------
+    float
+    """
+    data = _as_float_array(data)
+    if len(data) == 0:
+        return 0.
+    max_double = max(1., np.log(data + 1).max())
+    return float(np.floor(0xffff / max_double))
+
+
+def encode_slof(data, fixed_point=None):
+    """Encode ``data`` using MS-Numpress short logged float compression.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+        The values to encode. Must be non-negative.
+    fixed_point : float, optional
+        The scaling factor to apply to the log-transformed values. If not provided,
+        :func:`optimal_slof_fixed_point` is used.
+
+    Returns
+    -------
+    bytes
+
+    Raises
+    ------
+    ValueError
+        If any value is too large to encode with ``fixed_point``
+    """
+    data = _as_float_array(data)
+    if fixed_point is None:
+        fixed_point = optimal_slof_fixed_point(data)
+    header = _encode_fixed_point(fixed_point)
+    if len(data) == 0:
+        return header
+    scaled = np.log(data + 1) * fixed_point
+    if scaled.max() > 0xffff:
+        raise ValueError(
+            "Cannot encode a number that overflows USHRT_MAX")
+    return header + (scaled + 0.5).astype(np.uint16).astype(_SLOF_DTYPE).tobytes()
+
+
+def decode_slof(data):
+    """Decode a byte string produced by :func:`encode_slof`.
+
+    Parameters
+    ----------
+    data : bytes
+
+    Returns
+    -------
+    :class:`np.ndarray`
+        The decoded values as 64-bit floats
+    """
+    data = bytes(data)
+    fixed_point = _decode_fixed_point(data)
+    if (len(data) - 8) % 2:
+        raise ValueError(
+            "Corrupt input data: number of bytes needs to be a multiple of 2")
+    ints = np.frombuffer(data, dtype=_SLOF_DTYPE, offset=8)
+    return np.exp(ints / fixed_point) - 1
+
+
+def slof_error_bound(data, fixed_point=None):
+    """The largest absolute error :func:`encode_slof` can introduce
+    when encoding ``data``.
+
+    The log-transformed values are rounded to the nearest multiple of
+    ``1 / fixed_point``, so the relative error of ``x + 1`` is bounded by
+    ``exp(0.5 / fixed_point) - 1``.
+
+    Parameters
+    ----------
+    data : :class:`np.ndarray`
+    fixed_point : float, optional
+
+    Returns
+    -------
+    float
+
+    Raises
+    ------
+    ValueError
+        If ``data`` has negative values, which :func:`encode_slof` cannot represent
+    """
+    data = _as_float_array(data)
+    if len(data) == 0:
+        return 0.
+    if data.min() < 0:
+        raise ValueError("Cannot use Slof to encode a negative number")
+    if fixed_point is None:
+        fixed_point = optimal_slof_fixed_point(data)
+    return float((data.max() + 1) * np.expm1(0.5 / fixed_point))
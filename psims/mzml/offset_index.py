@@ -0,0 +1,354 @@
+"""A compact binary copy of an indexed mzML document's offset index, written beside it.
+
+Reading the ``<indexList>`` of a large indexed mzML file means parsing XML with an entry for
+every spectrum each time the file is opened. An :class:`OffsetIndex` holds the same offsets,
+along with the ``index`` of each element, in flat arrays and a hash table over the ids, laid
+out so that the file can be memory-mapped and queried without reading it in full.
+
+The file starts with a header, followed by a table describing each section, like
+``"spectrum"`` or ``"chromatogram"``, and then the arrays of each section, each aligned to
+8 bytes. All integers are little-endian.
+
+The header holds :const:`MAGIC`, the uint32 :const:`FORMAT_VERSION`, the uint32 number of
+sections, the uint64 size of the mzML document, and its 40 character ``<fileChecksum>``,
+padded with zeros if it is not known.
+
+Each section holds its 16 byte name, padded with zeros, the uint64 number of elements and
+of slots in its hash table, and the uint64 positions of its arrays: the int64 byte offset
+and the int64 ``index`` of each element, the int64 bounds of each element's id, the UTF-8
+ids one after another, and the int64 slots of the hash table.
+
+Elements are stored in the order they appear in the document. Each slot of the hash table
+holds the position of an element, or -1, and an id is found by probing linearly from the
+slot given by the CRC-32 of its UTF-8 bytes.
+"""
+import io
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from six import string_types as basestring
+
+
+MAGIC = b'PSIMSIDX'
+FORMAT_VERSION = 1
+SIDECAR_SUFFIX = '.idx'
+
+_HEADER = struct.Struct('<8sIIQ40s')
+_SECTION = struct.Struct('<16s7Q')
+_EMPTY_SLOT = -1
+
+
+def _id_bytes(id):
+    if isinstance(id, bytes):
+        return id
+    return str(id).encode('utf-8')
+
+
+def _slot(id, table_size):
+    return (zlib.crc32(id) & 0xffffffff) & (table_size - 1)
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+class SectionIndex(object):
+    """The ids, indices and offsets of one kind of element.
+
+    Attributes
+    ----------
+    name : str
+        The name of the element, like ``"spectrum"``
+    offsets : :class:`numpy.ndarray`
+        The byte offset of each element
+    indices : :class:`numpy.ndarray`
+        The ``index`` attribute of each element
+    """
+
+    def __init__(self, name, offsets, indices, id_bounds, ids, table):
+        self.name = name
+        self.offsets = offsets
+        self.indices = indices
+        self._id_bounds = id_bounds
+        self._ids = ids
+        self._table = table
+
+    @classmethod
+    def build(cls, name, ids, offsets, indices=None):
+        """Build the index of a section from its elements
+
+        Parameters
+        ----------
+        name : str
+            The name of the element
+        ids : :class:`Iterable` of str
+            The id of each element, in document order
+        offsets : :class:`Iterable` of int
+            The byte offset of each element
+        indices : :class:`Iterable` of int, optional
+            The ``index`` attribute of each element. Defaults to the position of each element.
+
+        Returns
+        -------
+        :class:`SectionIndex`
+        """
+        ids = [_id_bytes(id) for id in ids]
+        offsets = np.asarray(offsets, dtype='<i8').reshape(-1)
+        if indices is None:
+            indices = np.arange(len(ids), dtype='<i8')
+        indices = np.asarray(indices, dtype='<i8').reshape(-1)
+        id_bounds = np.zeros(len(ids) + 1, dtype='<i8')
+        np.cumsum([len(id) for id in ids], out=id_bounds[1:])
+        table_size = 1
+        while table_size < 2 * len(ids):
+            table_size *= 2
+        table = [_EMPTY_SLOT] * table_size
+        mask = table_size - 1
+        for i, id in enumerate(ids):
+            slot = _slot(id, table_size)
+            while table[slot] != _EMPTY_SLOT:
+                slot = (slot + 1) & mask
+            table[slot] = i
+        return cls(name, offsets, indices, id_bounds, np.frombuffer(b''.join(ids), dtype=np.uint8),
+                   np.array(table, dtype='<i8'))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def id_at(self, position):
+        """Get the id of the element at ``position`` in the document order
+
+        Returns
+        -------
+        str
+        """
+        start, end = self._id_bounds[position], self._id_bounds[position + 1]
+        return self._ids[start:end].tobytes().decode('utf-8')
+
+    def ids(self):
+        """Get the id of every element, in document order
+
+        Returns
+        -------
+        list of str
+        """
+        return [self.id_at(i) for i in range(len(self))]
+
+    def find(self, id):
+        """Find the position of the element with ``id`` in the document order
+
+        Returns
+        -------
+        int or None
+        """
+        id = _id_bytes(id)
+        table = self._table
+        mask = len(table) - 1
+        slot = _slot(id, len(table))
+        while True:
+            position = table[slot]
+            if position == _EMPTY_SLOT:
+                return None
+            start, end = self._id_bounds[position], self._id_bounds[position + 1]
+            if end - start == len(id) and self._ids[start:end].tobytes() == id:
+                return int(position)
+            slot = (slot + 1) & mask
+
+    def offset_of(self, id):
+        """Get the byte offset of the element with ``id``
+
+        Raises
+        ------
+        KeyError
+            If there is no such element
+        """
+        position = self.find(id)
+        if position is None:
+            raise KeyError(id)
+        return int(self.offsets[position])
+
+    def position_of_index(self, index):
+        """Find the position of the element whose ``index`` attribute is ``index``
+
+        Returns
+        -------
+        int or None
+        """
+        # Elements are normally numbered in document order, from 0
+        if 0 <= index < len(self) and self.indices[index] == index:
+            return index
+        matches = np.flatnonzero(self.indices == index)
+        if len(matches) == 0:
+            return None
+        return int(matches[0])
+
+    def offset_at(self, index):
+        """Get the byte offset of the element whose ``index`` attribute is ``index``
+
+        Raises
+        ------
+        IndexError
+            If there is no such element
+        """
+        position = self.position_of_index(index)
+        if position is None:
+            raise IndexError(index)
+        return int(self.offsets[position])
+
+    def __contains__(self, id):
+        return self.find(id) is not None
+
+    def __getitem__(self, id):
+        return self.offset_of(id)
+
+    def _arrays(self):
+        return [self.offsets, self.indices, self._id_bounds, self._ids, self._table]
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.name!r}, {size} entries)".format(
+            self=self, size=len(self))
+
+
+class OffsetIndex(object):
+    """The offsets of the elements of an indexed mzML document, in a form which can be
+    memory-mapped.
+
+    Attributes
+    ----------
+    sections : dict
+        The :class:`SectionIndex` of each kind of element, by name
+    document_size : int
+        The size in bytes of the document the offsets belong to
+    checksum : str or None
+        The ``<fileChecksum>`` of the document the offsets belong to
+    """
+
+    def __init__(self, sections, document_size=0, checksum=None):
+        self.sections = dict((section.name, section) for section in sections)
+        self.document_size = document_size
+        self.checksum = checksum
+        self._buffer = None
+
+    @classmethod
+    def from_indexing_stream(cls, stream, checksum=None):
+        """Collect the offsets recorded by an :class:`~.IndexingStream`
+
+        Returns
+        -------
+        :class:`OffsetIndex`
+        """
+        sections = []
+        for indexer in stream.indices:
+            ids = []
+            offsets = []
+            indices = []
+            for i, (xid, offset) in enumerate(indexer):
+                ids.append(xid)
+                offsets.append(int(offset))
+                indices.append(int(offset.attrs.get(b'index', i)))
+            sections.append(SectionIndex.build(indexer.name, ids, offsets, indices))
+        return cls(sections, stream.accumulator, checksum)
+
+    @property
+    def spectrum(self):
+        return self.sections.get('spectrum')
+
+    @property
+    def chromatogram(self):
+        return self.sections.get('chromatogram')
+
+    def __getitem__(self, name):
+        return self.sections[name]
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def write(self, path):
+        """Write the index to ``path``, which may be a path or a writable binary file
+        """
+        if isinstance(path, basestring):
+            with open(path, 'wb') as handle:
+                return self.write(handle)
+        sections = [self.sections[name] for name in sorted(self.sections)]
+        position = _align(_HEADER.size + _SECTION.size * len(sections))
+        layout = []
+        for section in sections:
+            positions = []
+            for array in section._arrays():
+                positions.append(position)
+                position = _align(position + array.nbytes)
+            layout.append(positions)
+        checksum = (self.checksum or '').encode('ascii')
+        path.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections), self.document_size, checksum))
+        for section, positions in zip(sections, layout):
+            path.write(_SECTION.pack(
+                section.name.encode('ascii'), len(section), len(section._table), *positions))
+        written = _HEADER.size + _SECTION.size * len(sections)
+        for section, positions in zip(sections, layout):
+            for array, position in zip(section._arrays(), positions):
+                path.write(b'\0' * (position - written))
+                path.write(np.ascontiguousarray(array).tobytes())
+                written = position + array.nbytes
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map the index written to ``path``
+
+        Parameters
+        ----------
+        path : str or file-like
+            The path to the index, or an open binary file. Files which cannot be
+            memory-mapped are read into memory.
+
+        Returns
+        -------
+        :class:`OffsetIndex`
+        """
+        if isinstance(path, basestring):
+            with open(path, 'rb') as handle:
+                return cls.load(handle)
+        try:
+            buffer = mmap.mmap(path.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, OSError, io.UnsupportedOperation):
+            buffer = path.read()
+        return cls.from_buffer(buffer)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Read an index from the bytes of an index file, without copying its arrays
+
+        Returns
+        -------
+        :class:`OffsetIndex`
+        """
+        if len(buffer) < _HEADER.size:
+            raise ValueError("Not an offset index: too short")
+        magic, version, section_count, document_size, checksum = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not an offset index: bad magic number %r" % (magic, ))
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported offset index version %d" % (version, ))
+        sections = []
+        for i in range(section_count):
+            name, count, table_size, offsets, indices, id_bounds, ids, table = _SECTION.unpack_from(
+                buffer, _HEADER.size + _SECTION.size * i)
+
+            def view(dtype, position, size):
+                return np.frombuffer(buffer, dtype=dtype, count=size, offset=position)
+
+            id_bounds = view('<i8', id_bounds, count + 1)
+            sections.append(SectionIndex(
+                name.rstrip(b'\0').decode('ascii'),
+                view('<i8', offsets, count), view('<i8', indices, count), id_bounds,
+                view(np.uint8, ids, int(id_bounds[-1])), view('<i8', table, table_size)))
+        checksum = checksum.rstrip(b'\0').decode('ascii') or None
+        inst = cls(sections, document_size, checksum)
+        inst._buffer = buffer
+        return inst
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({sections})".format(
+            self=self, sections=", ".join(repr(self.sections[name]) for name in sorted(self.sections)))
@@ -0,0 +1,220 @@
+"""Factor the parameters repeated by many spectra into ``<referenceableParamGroup>`` elements.
+
+A :class:`ParamGroupFactorer` is shown a sample of spectra, such as the first few spectra to
+be written or a single spectrum declaring their common shape, and collects the parameters
+which recur in enough of them into one group for each place parameters are written. Each
+spectrum written afterwards which carries every parameter of a group refers to the group
+with a ``<referenceableParamGroupRef>`` in place of repeating them.
+
+The ``"ms level"`` parameter and the spectrum type it implies are never factored out, as they
+must be written on each spectrum.
+"""
+from six import string_types as basestring
+
+try:
+    from collections import Mapping
+except ImportError:
+    from collections.abc import Mapping
+
+
+# The parameters of the spectrum itself
+SPECTRUM_PARAMS = 'params'
+# The parameters of the spectrum's scan
+SCAN_PARAMS = 'scan_params'
+
+_UNFACTORED_NAMES = frozenset(('ms level', 'MS1 spectrum', 'MSn spectrum'))
+_UNFACTORED_ACCESSIONS = frozenset(('MS:1000511', 'MS:1000579', 'MS:1000580'))
+
+
+def param_key(param):
+    """Get a hashable key which identifies ``param`` with its value, or
+    :const:`None` if it cannot be factored
+
+    Parameters
+    ----------
+    param : object
+        A parameter in any of the forms accepted by :meth:`~.VocabularyResolver.param`
+
+    Returns
+    -------
+    tuple or None
+    """
+    if isinstance(param, Mapping):
+        if 'name' in param or 'accession' in param:
+            name, accession = param.get('name'), param.get('accession')
+        elif len(param) == 1 and 'ref' not in param:
+            name, accession = list(param)[0], None
+        else:
+            return None
+        key = ('mapping', tuple(sorted(param.items())))
+    elif isinstance(param, (tuple, list)) and len(param) == 2:
+        name, accession = param[0], None
+        key = ('pair', tuple(param))
+    elif isinstance(param, basestring):
+        name, accession = param, None
+        key = ('name', param)
+    else:
+        return None
+    if name in _UNFACTORED_NAMES or name in _UNFACTORED_ACCESSIONS or accession in _UNFACTORED_ACCESSIONS:
+        return None
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class ParamGroup(object):
+    """A set of parameters written once in the ``<referenceableParamGroupList>``
+    and referred to by the spectra which carry all of them.
+
+    Attributes
+    ----------
+    id : str
+        The id of the ``<referenceableParamGroup>``
+    params : list
+        The parameters of the group, in the order they were first seen
+    keys : frozenset
+        The :func:`param_key` of each parameter
+    """
+
+    def __init__(self, id, params):
+        self.id = id
+        self.params = list(params)
+        self.keys = frozenset(param_key(param) for param in self.params)
+
+    def to_dict(self):
+        return {"id": self.id, "params": list(self.params)}
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.id!r}, {self.params!r})".format(self=self)
+
+
+class ParamGroupFactorer(object):
+    """Detects the parameters which recur across a sample of spectra and
+    replaces them with a reference to a :class:`ParamGroup`.
+
+    Attributes
+    ----------
+    min_size : int
+        The fewest parameters worth grouping
+    min_fraction : float
+        The fraction of sampled spectra a parameter must appear in to be grouped
+    groups : dict
+        The :class:`ParamGroup` of each place parameters are written, like
+        :const:`SPECTRUM_PARAMS` or :const:`SCAN_PARAMS`
+    """
+
+    group_ids = {
+        SPECTRUM_PARAMS: "CommonSpectrumParams",
+        SCAN_PARAMS: "CommonScanParams",
+    }
+
+    def __init__(self, min_size=2, min_fraction=1.0):
+        self.min_size = min_size
+        self.min_fraction = min_fraction
+        self.groups = {}
+        self._counts = {}
+        self._params = {}
+        self._samples = 0
+
+    def observe(self, sites):
+        """Count the parameters of one sampled spectrum
+
+        Parameters
+        ----------
+        sites : dict
+            The list of parameters the spectrum writes in each place
+        """
+        self._samples += 1
+        for site, params in sites.items():
+            counts = self._counts.setdefault(site, {})
+            first_seen = self._params.setdefault(site, {})
+            seen = set()
+            for param in params or ():
+                key = param_key(param)
+                if key is None or key in seen:
+                    continue
+                seen.add(key)
+                counts[key] = counts.get(key, 0) + 1
+                if key not in first_seen:
+                    first_seen[key] = (len(first_seen), param)
+
+    def _unique_id(self, site, reserved_ids):
+        group_id = base_id = self.group_ids.get(site, "Common_%s" % site)
+        i = 1
+        while group_id in reserved_ids:
+            group_id = "%s_%d" % (base_id, i)
+            i += 1
+        return group_id
+
+    def build(self, reserved_ids=()):
+        """Group the parameters seen often enough
+
+        Parameters
+        ----------
+        reserved_ids : iterable of str, optional
+            The ids of other ``<referenceableParamGroup>`` elements in the same
+            document. A group whose id in :attr:`group_ids` is taken is given a
+            numbered suffix instead.
+
+        Returns
+        -------
+        list of :class:`ParamGroup`
+        """
+        threshold = self._samples * self.min_fraction
+        reserved_ids = set(reserved_ids)
+        self.groups = {}
+        for site in sorted(self._counts):
+            counts = self._counts[site]
+            recurring = sorted(
+                (self._params[site][key] for key, count in counts.items() if count >= threshold),
+                key=lambda item: item[0])
+            if self._samples and len(recurring) >= self.min_size:
+                group_id = self._unique_id(site, reserved_ids)
+                reserved_ids.add(group_id)
+                self.groups[site] = ParamGroup(group_id, [param for _, param in recurring])
+        return [self.groups[site] for site in sorted(self.groups)]
+
+    def apply(self, site, params):
+        """Replace the parameters of ``site``'s group with a reference to it, if
+        ``params`` carries all of them
+
+        Parameters
+        ----------
+        site : str
+        params : list
+
+        Returns
+        -------
+        list or None
+            The parameters left over, preceded by the reference, or :const:`None`
+            if the group does not apply
+        """
+        group = self.groups.get(site)
+        if group is None:
+            return None
+        keys = [param_key(param) for param in params]
+        if not group.keys.issubset(keys):
+            return None
+        remaining = [param for key, param in zip(keys, params) if key not in group.keys]
+        return [{"ref": group.id}] + remaining
+
+    def covers(self, params, param):
+        """Check whether a group referenced from ``params`` includes ``param``
+
+        Parameters
+        ----------
+        params : list
+        param : object
+
+        Returns
+        -------
+        bool
+        """
+        key = param_key(param)
+        for group in self.groups.values():
+            if key in group.keys and {"ref": group.id} in params:
+                return True
+        return False
+
@@ -0,0 +1,566 @@
+"""Random access to the spectra and chromatograms of an indexed mzML document.
+
+An :class:`MzMLReader` memory-maps the document and reads the byte offset of each element from
+the ``<indexList>`` found through the ``<indexListOffset>`` at the end of the file, or from the
+:class:`~.OffsetIndex` written beside it, when that sidecar matches the document. Fetching an
+element slices its bytes out of the map and parses only those, so the cost of reading a spectrum
+depends on the size of that spectrum rather than on the size of the file.
+
+The :class:`ElementRecord` returned for each element defers parsing its XML until a parameter or
+an array is asked for, and decodes each binary data array with :func:`~.decode_array` the first
+time it is read. Parameters referenced through ``<referenceableParamGroupRef>`` are resolved
+from the ``<referenceableParamGroupList>`` of the document's header.
+
+Documents without an index are located by scanning the file once for the start of each
+element, which is much slower to open but reads them the same way afterwards.
+"""
+import io
+import mmap
+import os
+import re
+
+from xml.sax.saxutils import unescape
+
+from lxml import etree
+
+from six import string_types as basestring
+
+try:
+    from collections import Mapping
+except ImportError:
+    from collections.abc import Mapping
+
+from .binary_encoding import (
+    decode_array, compression_map, encoding_map, COMPRESSION_NONE, COMPRESSION_ZLIB)
+from .offset_index import OffsetIndex, SectionIndex, SIDECAR_SUFFIX
+from .writer import NON_STANDARD_ARRAY
+
+
+# The ``<indexListOffset>`` is written within the last few hundred bytes of the document
+TAIL_SIZE = 4096
+
+_INDEX_LIST_OFFSET = re.compile(br'<indexListOffset>\s*(\d+)\s*</indexListOffset>')
+_FILE_CHECKSUM = re.compile(br'<fileChecksum>\s*(\w+)\s*</fileChecksum>')
+_INDEX = re.compile(br'<index\s+name="([^"]+)"\s*>(.*?)</index>', re.DOTALL)
+_OFFSET = re.compile(br'<offset\s+idRef="([^"]*)"[^>]*>\s*(\d+)\s*</offset>')
+_ELEMENT_START = re.compile(br'<(spectrum|chromatogram)\s[^>]*?\bid="([^"]*)"')
+_ATTRIBUTE = re.compile(br'([\w:]+)\s*=\s*"([^"]*)"')
+
+_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+# The names of the compression parameters, mapped back to the compression methods they describe.
+# Truncated arrays are read as the compression applied after truncation.
+_compression_by_name = dict(
+    (name, compression) for compression, name in compression_map.items()
+    if isinstance(compression, basestring))
+_compression_by_name['no compression'] = COMPRESSION_NONE
+_compression_by_name['zlib compression'] = COMPRESSION_ZLIB
+
+
+def _text(value):
+    return unescape(value.decode('utf-8'), _ENTITIES)
+
+
+def _coerce(value):
+    if value is None:
+        return None
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            continue
+    return value
+
+
+class Param(object):
+    """A ``<cvParam>`` or ``<userParam>`` of an element.
+
+    Attributes
+    ----------
+    name : str
+    value : object
+        The value, converted to a number where it is one
+    accession : str or None
+    unit_name : str or None
+    """
+    __slots__ = ('name', 'value', 'accession', 'unit_name')
+
+    def __init__(self, name, value, accession=None, unit_name=None):
+        self.name = name
+        self.value = value
+        self.accession = accession
+        self.unit_name = unit_name
+
+    @classmethod
+    def from_element(cls, element):
+        return cls(element.get('name'), _coerce(element.get('value')),
+                   element.get('accession'), element.get('unitName'))
+
+    def matches(self, key):
+        return self.name == key or (self.accession is not None and self.accession == key)
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.name!r}, {self.value!r})".format(self=self)
+
+
+def _params_of(element, groups):
+    """The parameters written directly on ``element``, in order, with any parameter
+    groups it refers to expanded in place
+    """
+    params = []
+    for child in element:
+        tag = child.tag
+        if tag == 'cvParam' or tag == 'userParam':
+            params.append(Param.from_element(child))
+        elif tag == 'referenceableParamGroupRef':
+            params.extend(groups.get(child.get('ref'), ()))
+    return params
+
+
+class BinaryArray(object):
+    """An encoded ``<binaryDataArray>``, decoded on demand.
+
+    Attributes
+    ----------
+    name : str
+        The array type, like ``"m/z array"``, or the name of a non-standard array
+    compression : str
+        The compression method, a key of :data:`~.compression_map`
+    dtype : type
+        The type the values were encoded as
+    params : list of :class:`Param`
+    """
+
+    def __init__(self, element, groups):
+        self.params = _params_of(element, groups)
+        self.name = None
+        self.compression = COMPRESSION_NONE
+        self.dtype = None
+        non_standard = None
+        for param in self.params:
+            if param.name in _compression_by_name:
+                self.compression = _compression_by_name[param.name]
+            elif param.name in encoding_map:
+                self.dtype = encoding_map[param.name]
+            elif param.name == NON_STANDARD_ARRAY:
+                non_standard = param.value or None
+            elif self.name is None and param.name and param.name.endswith(' array'):
+                self.name = param.name
+        if self.name is None:
+            self.name = non_standard
+        if self.name is None:
+            user_params = [child.get('name') for child in element if child.tag == 'userParam']
+            self.name = user_params[0] if user_params else NON_STANDARD_ARRAY
+        binary = element.find('binary')
+        self.encoded = (binary.text or '').strip() if binary is not None else ''
+
+    def decode(self):
+        """Decode the array
+
+        Returns
+        -------
+        :class:`numpy.ndarray`
+        """
+        return decode_array(self.encoded, self.compression, self.dtype or encoding_map[None])
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.name!r}, {self.compression!r}, {dtype})".format(
+            self=self, dtype=getattr(self.dtype, '__name__', self.dtype))
+
+
+class ArrayMap(Mapping):
+    """The binary data arrays of an element by name, each decoded when it is first read
+    """
+
+    def __init__(self, arrays):
+        self.encoded = dict((array.name, array) for array in arrays)
+        self._decoded = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._decoded[name]
+        except KeyError:
+            array = self._decoded[name] = self.encoded[name].decode()
+            return array
+
+    def __iter__(self):
+        return iter(self.encoded)
+
+    def __len__(self):
+        return len(self.encoded)
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({names})".format(
+            self=self, names=list(self.encoded))
+
+
+class ElementRecord(object):
+    """A spectrum or chromatogram read from an :class:`MzMLReader`.
+
+    Only the bytes of the element are held. They are parsed the first time a parameter
+    or an array is read, and each array is decoded the first time it is read.
+
+    Attributes
+    ----------
+    kind : str
+        ``"spectrum"`` or ``"chromatogram"``
+    id : str
+    offset : int
+        The byte offset of the element in the document
+    raw : bytes
+        The XML of the element
+    """
+
+    def __init__(self, kind, id, offset, raw, param_groups=None):
+        self.kind = kind
+        self.id = id
+        self.offset = offset
+        self.raw = raw
+        self._param_groups = param_groups or {}
+        self._attrib = None
+        self._element = None
+        self._params = None
+        self._all_params = None
+        self._arrays = None
+
+    @property
+    def attrib(self):
+        """The attributes of the element's start tag, read without parsing the element
+        """
+        if self._attrib is None:
+            start_tag = self.raw[:self.raw.find(b'>') + 1]
+            self._attrib = dict(
+                (name.decode('utf-8'), _text(value)) for name, value in _ATTRIBUTE.findall(start_tag))
+        return self._attrib
+
+    @property
+    def index(self):
+        return int(self.attrib['index'])
+
+    @property
+    def default_array_length(self):
+        return int(self.attrib['defaultArrayLength'])
+
+    @property
+    def element(self):
+        """The element, parsed with :mod:`lxml`
+
+        Returns
+        -------
+        :class:`lxml.etree._Element`
+        """
+        if self._element is None:
+            self._element = etree.fromstring(self.raw)
+        return self._element
+
+    @property
+    def params(self):
+        """The parameters written directly on the element
+
+        Returns
+        -------
+        list of :class:`Param`
+        """
+        if self._params is None:
+            self._params = _params_of(self.element, self._param_groups)
+        return self._params
+
+    def iter_params(self):
+        """Iterate over every parameter of the element and its descendants, such as
+        its scans and precursors, in document order, except those of its arrays
+
+        Yields
+        ------
+        :class:`Param`
+        """
+        if self._all_params is None:
+            self._all_params = []
+            pending = [self.element]
+            while pending:
+                element = pending.pop()
+                self._all_params.extend(_params_of(element, self._param_groups))
+                pending.extend(reversed([
+                    child for child in element
+                    if isinstance(child.tag, basestring) and child.tag != 'binaryDataArrayList']))
+        return iter(self._all_params)
+
+    def find_param(self, key):
+        """Find the first parameter named ``key``, or with accession ``key``, anywhere in
+        the element
+
+        Returns
+        -------
+        :class:`Param` or None
+        """
+        for param in self.iter_params():
+            if param.matches(key):
+                return param
+        return None
+
+    def get(self, key, default=None):
+        """Get the value of the parameter named ``key``, or with accession ``key``, anywhere
+        in the element, or the array named ``key``
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @property
+    def arrays(self):
+        """The element's binary data arrays by name, decoded when read
+
+        Returns
+        -------
+        :class:`ArrayMap`
+        """
+        if self._arrays is None:
+            self._arrays = ArrayMap(
+                BinaryArray(element, self._param_groups)
+                for element in self.element.iterfind('binaryDataArrayList/binaryDataArray'))
+        return self._arrays
+
+    def __getitem__(self, key):
+        if key in self.arrays:
+            return self.arrays[key]
+        param = self.find_param(key)
+        if param is None:
+            raise KeyError(key)
+        return param.value
+
+    def __contains__(self, key):
+        return key in self.arrays or self.find_param(key) is not None
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.kind!r}, {self.id!r})".format(self=self)
+
+
+class MzMLReader(object):
+    """Reads the spectra and chromatograms of an indexed mzML document by id or index,
+    without parsing the rest of the document.
+
+    Parameters
+    ----------
+    source : str or file-like
+        The path to the document, or an open binary file. Files which cannot be
+        memory-mapped are read into memory.
+    offset_index : :class:`~.OffsetIndex`, str, bool or None, optional
+        The offset index to read the offsets from. A path is loaded with :meth:`~.OffsetIndex.load`.
+        If :const:`None`, the sidecar written beside ``source`` by :class:`~.IndexedMzMLWriter`
+        is used if it exists and describes this document. If :const:`False`, the offsets are
+        always read from the document.
+
+    Attributes
+    ----------
+    sections : dict
+        The :class:`~.SectionIndex` of each kind of element, by name
+    checksum : str or None
+        The ``<fileChecksum>`` of the document
+    """
+
+    def __init__(self, source, offset_index=None):
+        self._handle = None
+        if isinstance(source, basestring):
+            self.path = source
+            source = self._handle = open(source, 'rb')
+        else:
+            self.path = getattr(source, 'name', None)
+        self.buffer = self._map(source)
+        self.checksum = None
+        self.sections = self._load_sections(offset_index)
+        self._param_groups = None
+
+    @staticmethod
+    def _map(handle):
+        try:
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, OSError, io.UnsupportedOperation):
+            handle.seek(0)
+            return handle.read()
+
+    def _read_tail(self):
+        tail = self.buffer[max(0, len(self.buffer) - TAIL_SIZE):]
+        checksum = _FILE_CHECKSUM.search(tail)
+        if checksum is not None:
+            self.checksum = checksum.group(1).decode('ascii')
+        offset = None
+        for match in _INDEX_LIST_OFFSET.finditer(tail):
+            offset = int(match.group(1))
+        return offset
+
+    def _sidecar(self, offset_index):
+        if offset_index is None:
+            if not isinstance(self.path, basestring) or not os.path.exists(self.path + SIDECAR_SUFFIX):
+                return None
+            try:
+                offset_index = OffsetIndex.load(self.path + SIDECAR_SUFFIX)
+            except (ValueError, IOError, OSError):
+                return None
+        elif isinstance(offset_index, basestring) or hasattr(offset_index, 'read'):
+            offset_index = OffsetIndex.load(offset_index)
+        # A sidecar left behind by an earlier version of the document is ignored
+        if offset_index.document_size != len(self.buffer):
+            return None
+        if self.checksum and offset_index.checksum and offset_index.checksum != self.checksum:
+            return None
+        return offset_index
+
+    def _load_sections(self, offset_index):
+        index_list_offset = self._read_tail()
+        if offset_index is not False:
+            offset_index = self._sidecar(offset_index)
+            if offset_index is not None:
+                return dict(offset_index.sections)
+        if index_list_offset is not None:
+            return self._parse_index_list(index_list_offset)
+        return self._scan_elements()
+
+    def _parse_index_list(self, index_list_offset):
+        end = self.buffer.find(b'</indexList>', index_list_offset)
+        if end == -1:
+            raise ValueError("No <indexList> found at offset %d" % (index_list_offset, ))
+        sections = {}
+        for name, body in _INDEX.findall(self.buffer[index_list_offset:end]):
+            name = name.decode('ascii')
+            pairs = _OFFSET.findall(body)
+            sections[name] = SectionIndex.build(
+                name, [_text(id) for id, _ in pairs], [int(offset) for _, offset in pairs])
+        return sections
+
+    def _scan_elements(self):
+        found = {}
+        for match in _ELEMENT_START.finditer(self.buffer):
+            ids, offsets = found.setdefault(match.group(1).decode('ascii'), ([], []))
+            ids.append(_text(match.group(2)))
+            offsets.append(match.start())
+        return dict((name, SectionIndex.build(name, ids, offsets)) for name, (ids, offsets) in found.items())
+
+    @property
+    def param_groups(self):
+        """The parameters of each ``<referenceableParamGroup>`` of the document, by id
+        """
+        if self._param_groups is None:
+            self._param_groups = {}
+            end = self.buffer.find(b'<run ')
+            if end == -1:
+                end = len(self.buffer)
+            start = self.buffer.find(b'<referenceableParamGroupList', 0, end)
+            if start != -1:
+                stop = self.buffer.find(b'</referenceableParamGroupList>', start, end)
+                group_list = etree.fromstring(
+                    self.buffer[start:stop + len(b'</referenceableParamGroupList>')])
+                for group in group_list.iterfind('referenceableParamGroup'):
+                    self._param_groups[group.get('id')] = _params_of(group, {})
+        return self._param_groups
+
+    @property
+    def spectra(self):
+        return self.sections.get('spectrum')
+
+    @property
+    def chromatograms(self):
+        return self.sections.get('chromatogram')
+
+    def _section(self, kind):
+        section = self.sections.get(kind)
+        if section is None:
+            raise KeyError("The document has no %s index" % (kind, ))
+        return section
+
+    def _read(self, kind, position):
+        section = self._section(kind)
+        offset = int(section.offsets[position])
+        closing = ('</%s>' % kind).encode('ascii')
+        end = self.buffer.find(closing, offset)
+        if end == -1:
+            raise ValueError("The %s at offset %d is not closed" % (kind, offset))
+        return ElementRecord(
+            kind, section.id_at(position), offset, self.buffer[offset:end + len(closing)],
+            self.param_groups)
+
+    def get_by_id(self, id, kind='spectrum'):
+        """Read the element with ``id``
+
+        Parameters
+        ----------
+        id : str
+        kind : str, optional
+            ``"spectrum"`` or ``"chromatogram"``
+
+        Returns
+        -------
+        :class:`ElementRecord`
+
+        Raises
+        ------
+        KeyError
+            If there is no such element
+        """
+        position = self._section(kind).find(id)
+        if position is None:
+            raise KeyError(id)
+        return self._read(kind, position)
+
+    def get_by_index(self, index, kind='spectrum'):
+        """Read the element whose ``index`` attribute is ``index``
+
+        Raises
+        ------
+        IndexError
+            If there is no such element
+        """
+        section = self._section(kind)
+        if index < 0:
+            index += len(section)
+        position = section.position_of_index(index)
+        if position is None:
+            raise IndexError(index)
+        return self._read(kind, position)
+
+    def get_spectrum(self, id):
+        return self.get_by_id(id, 'spectrum')
+
+    def get_chromatogram(self, id):
+        return self.get_by_id(id, 'chromatogram')
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self.get_by_id(key)
+        return self.get_by_index(key)
+
+    def __len__(self):
+        spectra = self.spectra
+        return len(spectra) if spectra is not None else 0
+
+    def __iter__(self):
+        return self.iter_elements('spectrum')
+
+    def iter_elements(self, kind='spectrum'):
+        """Iterate over the elements of ``kind`` in document order
+
+        Yields
+        ------
+        :class:`ElementRecord`
+        """
+        section = self.sections.get(kind)
+        if section is None:
+            return
+        for position in range(len(section)):
+            yield self._read(kind, position)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.path!r}, {sections})".format(
+            self=self, sections=", ".join(repr(self.sections[name]) for name in sorted(self.sections)))
@@ -0,0 +1,253 @@
+"""Render the spectra of a single mzML file in several processes at once.
+
+Each worker process renders a contiguous range of spectra with a :class:`SpectrumShardWriter`,
+which writes them through the same components as :class:`~.MzMLWriter` but into memory, and
+returns the rendered bytes along with the offset of each spectrum within them as a
+:class:`SpectrumShard`. The coordinating :class:`~.IndexedMzMLWriter` then appends the shards
+to its output in order with :func:`write_spectrum_shards`, renumbering the ``index`` attribute
+of each spectrum, translating the offsets into its :class:`~.SpectrumIndexer`, and adding the
+bytes to its running checksum, without parsing the shards again.
+
+Because the shards are rendered independently, references from a spectrum to spectra in other
+shards, such as precursor scans, are not checked, and ``compression='auto'`` chooses compression
+methods separately for each shard.
+"""
+import re
+
+from io import BytesIO
+
+try:
+    from multiprocessing import Pool
+except ImportError:
+    Pool = None
+
+from psims.document import SpecializedContextCache, id_maker
+from psims.xml import _element
+
+from .index import IndexingStream, SpectrumIndexer, Offset
+from .writer import PlainMzMLWriter
+
+
+INDEX_ATTRIBUTE_PATTERN = re.compile(br'\sindex="(\d+)"')
+
+
+class SpectrumShard(object):
+    """A contiguous run of rendered spectra.
+
+    Attributes
+    ----------
+    data : bytes
+        The rendered spectra, formatted to be written directly inside a ``<spectrumList>``
+    offsets : list
+        The ``(id, offset, attributes)`` of each spectrum, where ``offset`` is relative to the
+        start of :attr:`data`, as indexed by :class:`~.SpectrumIndexer`
+    references : list
+        The ``(key, id)`` pairs registered for each spectrum, to resolve references to them
+    """
+
+    def __init__(self, data, offsets, references):
+        self.data = data
+        self.offsets = offsets
+        self.references = references
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({size} bytes, {count} spectra)".format(
+            self=self, size=len(self.data), count=len(self))
+
+
+class _ShardReferenceCache(SpecializedContextCache):
+    # Spectra may refer to spectra rendered by other workers, which
+    # cannot be checked until the shards are combined
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            if key is None:
+                return None
+            if isinstance(key, int):
+                return id_maker(self.type_name, key)
+            return str(key)
+
+
+class SpectrumShardWriter(PlainMzMLWriter):
+    """Renders spectra into memory as they would be written inside the ``<spectrumList>``
+    of another writer, for :func:`write_spectrum_shards`.
+
+    The writer begins in the ``spectrum_list`` state, so only :meth:`write_spectrum` may be used.
+
+    Parameters
+    ----------
+    indent_level : int
+        The indentation level of the coordinating writer's ``<spectrumList>`` contents
+    references : :class:`Mapping`
+        The coordinating writer's reference stores, mapping component type name to
+        a list of ``(key, id)`` pairs
+    **kwargs
+        Forwarded to :class:`~.PlainMzMLWriter`
+    """
+
+    def __init__(self, indent_level, references=None, **kwargs):
+        self._stream = IndexingStream(BytesIO())
+        super(SpectrumShardWriter, self).__init__(self._stream, close=False, **kwargs)
+        self.shard_indent_level = indent_level
+        self.context['Spectrum'] = _ShardReferenceCache('Spectrum')
+        for type_name, items in (references or {}).items():
+            store = self.context[type_name]
+            for key, value in items:
+                store[key] = value
+        self._preloaded = set(dict.keys(self.context['Spectrum']))
+        self._start = None
+
+    def toplevel_tag(self):
+        return _element("spectrumShard")
+
+    def begin(self):
+        super(SpectrumShardWriter, self).begin()
+        self.state_machine.current_state = 'spectrum_list'
+        self.writer.indent_level = self.shard_indent_level
+        self.writer.flush()
+        self._start = self._stream.accumulator
+
+    def shard(self):
+        """Finish rendering, and collect the spectra written
+
+        Returns
+        -------
+        :class:`SpectrumShard`
+        """
+        self._flush_write_queue()
+        self.writer.flush()
+        self._stream.flush()
+        data = self._stream.stream.getvalue()[self._start:self._stream.accumulator]
+        indexer = [ix for ix in self._stream.indices if isinstance(ix, SpectrumIndexer)][0]
+        offsets = [(xid, int(offset) - self._start, dict(offset.attrs)) for xid, offset in indexer]
+        references = [(key, value) for key, value in self.context['Spectrum'].items()
+                      if key not in self._preloaded]
+        return SpectrumShard(data, offsets, references)
+
+
+def render_spectrum_shard(render, start, stop, indent_level, references=None, **writer_options):
+    """Render the spectra in ``[start, stop)`` with a :class:`SpectrumShardWriter`
+
+    Parameters
+    ----------
+    render : Callable
+        Called as ``render(writer, start, stop)`` to write the spectra in the range
+        with :meth:`~.PlainMzMLWriter.write_spectrum`. Must be picklable to be used
+        in a worker process.
+    start : int
+        The first spectrum of the range
+    stop : int
+        The end of the range
+    indent_level : int
+        The indentation level to render at
+    references : :class:`Mapping`, optional
+        The reference stores to resolve against
+    **writer_options
+        Forwarded to :class:`SpectrumShardWriter`
+
+    Returns
+    -------
+    :class:`SpectrumShard`
+    """
+    writer = SpectrumShardWriter(indent_level, references, **writer_options)
+    with writer:
+        render(writer, start, stop)
+        shard = writer.shard()
+    return shard
+
+
+def _render_spectrum_shard_task(task):
+    render, start, stop, indent_level, references, writer_options = task
+    return render_spectrum_shard(render, start, stop, indent_level, references, **writer_options)
+
+
+def append_spectrum_shard(writer, shard):
+    """Write ``shard`` to the end of the ``<spectrumList>`` being written by ``writer``,
+    continuing its spectrum numbering, index, and checksum.
+
+    Parameters
+    ----------
+    writer : :class:`~.IndexedMzMLWriter`
+        The coordinating writer, inside its :meth:`~.PlainMzMLWriter.spectrum_list`
+    shard : :class:`SpectrumShard`
+        The spectra to write
+    """
+    writer.state_machine.expects_state("spectrum_list")
+    stream = writer.index_builder
+    indexer = [ix for ix in stream.indices if isinstance(ix, SpectrumIndexer)][0]
+    writer.writer.flush()
+    base = stream.accumulator
+    data = shard.data
+    pieces = []
+    last = 0
+    shift = 0
+    for xid, offset, attrs in shard.offsets:
+        match = INDEX_ATTRIBUTE_PATTERN.search(data, offset)
+        index = str(writer.spectrum_count).encode('utf-8')
+        pieces.append(data[last:match.start(1)])
+        pieces.append(index)
+        last = match.end(1)
+        attrs[b'index'] = index
+        indexer.index[xid] = Offset(base + offset + shift, attrs)
+        shift += len(index) - (match.end(1) - match.start(1))
+        writer.spectrum_count += 1
+    pieces.append(data[last:])
+    stream.write(b''.join(pieces))
+    references = writer.context['Spectrum']
+    for key, value in shard.references:
+        references[key] = value
+
+
+def write_spectrum_shards(writer, render, ranges, processes=None, **writer_options):
+    """Render ranges of spectra in parallel worker processes and write them with ``writer``.
+
+    Shards are appended in the order of ``ranges`` as soon as each is ready, so at most
+    a few shards are held in memory at once.
+
+    Parameters
+    ----------
+    writer : :class:`~.IndexedMzMLWriter`
+        The coordinating writer, inside its :meth:`~.PlainMzMLWriter.spectrum_list`
+    render : Callable
+        Called as ``render(writer, start, stop)`` in a worker process to write the spectra
+        in each range with :meth:`~.PlainMzMLWriter.write_spectrum`. Must be picklable.
+    ranges : :class:`Iterable` of tuple
+        The ``(start, stop)`` bounds of each shard, in the order they should be written
+    processes : int, optional
+        The number of worker processes to use. If 0, the shards are rendered in this
+        process, one after the other. If :const:`None`, one process is used per CPU.
+    **writer_options
+        Forwarded to the :class:`SpectrumShardWriter` of each shard
+
+    Returns
+    -------
+    int
+        The number of spectra written
+    """
+    writer.state_machine.expects_state("spectrum_list")
+    writer._flush_write_queue()
+    indent_level = writer.writer.indent_level
+    references = {type_name: list(store.items()) for type_name, store in writer.context.items()}
+    tasks = [(render, start, stop, indent_level, references, writer_options) for start, stop in ranges]
+    count = 0
+    if processes == 0:
+        shards = (_render_spectrum_shard_task(task) for task in tasks)
+        for shard in shards:
+            append_spectrum_shard(writer, shard)
+            count += len(shard)
+        return count
+    if Pool is None:
+        raise ImportError("multiprocessing is required to render shards in parallel")
+    pool = Pool(processes)
+    try:
+        for shard in pool.imap(_render_spectrum_shard_task, tasks):
+            append_spectrum_shard(writer, shard)
+            count += len(shard)
+    finally:
+        pool.terminate()
+        pool.join()
+    return count
@@ -0,0 +1,561 @@
+"""Compiled serialization templates for spectra.
+
+Writing a spectrum through the component graph builds a tree of components and parameters,
+resolves every parameter against the controlled vocabularies, and writes each element through
+:mod:`lxml`'s incremental writer. For spectra with few points, this costs more than encoding
+their arrays.
+
+Most spectra in a file share a small number of *shapes*: the same parameter names and units,
+the same arrays with the same encodings, and the same optional sections, differing only in
+their values. A :class:`SpectrumTemplate` is compiled once per shape by rendering a spectrum
+whose values have been replaced by unique sentinels through the component graph, and splitting
+the rendered markup at each sentinel. Later spectra of the same shape are rendered by filling
+their values into the gaps.
+
+Chromatograms are templated the same way, with their arguments described by a
+:class:`ChromatogramShape`.
+"""
+import numbers
+
+from io import BytesIO
+
+from six import string_types as basestring, text_type
+
+try:
+    from collections import Mapping, Iterable
+except ImportError:
+    from collections.abc import Mapping, Iterable
+
+from psims.xml import XMLFormattingStreamWriter, attrencode
+
+from .binary_encoding import StreamingArrayEncoder
+from .index import report_offset
+
+
+# A value rendered as an attribute
+SLOT_VALUE = 'value'
+# A value rendered as an attribute, which must be a number while the template is compiled
+SLOT_NUMBER = 'number'
+# A reference to another spectrum's id, rendered as an attribute
+SLOT_REFERENCE = 'reference'
+# The encoded bytes of an array
+SLOT_ARRAY = 'array'
+# The encoded length of the preceding array
+SLOT_ENCODED_LENGTH = 'encoded length'
+# The number of elements in an array
+SLOT_ARRAY_LENGTH = 'array length'
+
+_NUMERIC_SLOTS = frozenset((SLOT_NUMBER, SLOT_ENCODED_LENGTH, SLOT_ARRAY_LENGTH))
+
+
+class UnsupportedShape(Exception):
+    """Raised when a spectrum cannot be described by a template, and must be
+    written through the component graph instead.
+    """
+
+
+def _escape_attribute(text):
+    # Matches the escaping libxml2 applies to attribute values
+    return text.replace(
+        u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;").replace(
+        u'"', u"&quot;").replace(u"\n", u"&#10;").replace(u"\r", u"&#13;").replace(u"\t", u"&#9;")
+
+
+def _is_ms_level(name, accession):
+    # The MS level determines the spectrum type written alongside it, so
+    # it is part of a spectrum's structure rather than one of its values
+    return name == 'ms level' or name == 'MS:1000511' or accession == 'MS:1000511'
+
+
+def render_attribute(value):
+    return _escape_attribute(attrencode(value)).encode('utf-8')
+
+
+class ArraySlot(object):
+    """Stands in for a binary data array while a template is being compiled.
+
+    Attributes
+    ----------
+    binary : bytes
+        The sentinel to write in place of the encoded array
+    encoded_length : int
+        The sentinel to write in place of the encoded length
+    length : int
+        The sentinel to write in place of the array's length
+    encoding : tuple
+        The ``(dtype, compression, significant_bits)`` the writer resolved for this array
+    """
+
+    def __init__(self, binary, encoded_length, length):
+        self.binary = binary
+        self.encoded_length = encoded_length
+        self.length = length
+        self.encoding = None
+
+    def __len__(self):
+        return self.length
+
+
+class SpectrumShape(object):
+    """Separates the arguments of :meth:`~.PlainMzMLWriter.write_spectrum` into the
+    structure which determines a template and the values which fill it in.
+
+    Attributes
+    ----------
+    key : tuple
+        A hashable description of the structure of the spectrum
+    values : list
+        The value of each slot, in the order they were encountered
+    kinds : list
+        The kind of each slot
+    arguments : dict
+        The arguments, with each value replaced by the result of :meth:`slot`
+    arrays : list
+        The arrays in the order they are written, or their :class:`ArraySlot` when
+        building sentinels
+    index : int
+        The index of the spectrum, or its sentinel
+    """
+
+    def __init__(self, arguments, sentinels=False):
+        self.sentinels = sentinels
+        self.values = []
+        self.kinds = []
+        self._key = []
+        self.arrays = []
+        self.arguments = self._walk(arguments)
+        self.key = tuple(self._key)
+
+    def token(self, *parts):
+        self._key.append(parts)
+
+    def sentinel(self, index, kind):
+        if kind in _NUMERIC_SLOTS:
+            return 900000000000000000 + index
+        return "psimsslot%05dz" % index
+
+    def slot(self, value, kind=SLOT_VALUE):
+        index = len(self.values)
+        self.values.append(value)
+        self.kinds.append(kind)
+        if self.sentinels:
+            return self.sentinel(index, kind)
+        return value
+
+    def _hashable(self, value):
+        try:
+            hash(value)
+        except TypeError:
+            raise UnsupportedShape("Unhashable structural value %r" % (value,))
+        return value
+
+    def _array(self, array, default_length=None):
+        if array is None:
+            self.token('no array')
+            return None
+        length = len(array)
+        matches_default = default_length is not None and length == default_length
+        self.token('array', matches_default)
+        binary = self.slot(array, SLOT_ARRAY)
+        encoded_length = self.slot(None, SLOT_ENCODED_LENGTH)
+        array_length = self.slot(length, SLOT_ARRAY_LENGTH)
+        if self.sentinels:
+            if matches_default:
+                array_length = self._default_length_sentinel
+            array = ArraySlot(binary.encode('ascii'), encoded_length, array_length)
+        self.arrays.append(array)
+        return array
+
+    def _param(self, param):
+        if isinstance(param, basestring):
+            self.token('param', param)
+            return param
+        elif isinstance(param, (tuple, list)) and len(param) == 2:
+            name, value = param
+            if _is_ms_level(name, None):
+                self.token('pair', self._hashable(name), self._hashable(value))
+                return param
+            self.token('pair', self._hashable(name), value is None)
+            if value is None:
+                return param
+            return (name, self.slot(value))
+        elif isinstance(param, Mapping):
+            param = dict(param)
+            if 'name' not in param and 'accession' not in param:
+                if len(param) != 1 or 'ref' in param:
+                    self.token('mapping', self._hashable(tuple(sorted(param.items()))))
+                    return param
+                (name, value), = param.items()
+                if _is_ms_level(name, None):
+                    self.token('single', self._hashable(name), self._hashable(value))
+                    return param
+                self.token('single', self._hashable(name), value is None)
+                if value is not None:
+                    param[name] = self.slot(value)
+                return param
+            value = param.get('value')
+            structure = tuple(sorted((k, v) for k, v in param.items() if k != 'value'))
+            if _is_ms_level(param.get('name'), param.get('accession')):
+                self.token('mapping', self._hashable(structure), self._hashable(value))
+                return param
+            self.token('mapping', self._hashable(structure), value is None)
+            if value is not None:
+                param['value'] = self.slot(value)
+            return param
+        raise UnsupportedShape("Cannot describe parameter %r" % (param,))
+
+    def _params(self, params):
+        if params is None:
+            self.token('no params')
+            return None
+        self.token('params', len(params))
+        return [self._param(param) for param in params]
+
+    def _optional_value(self, name, value, kind=SLOT_VALUE):
+        self.token(name, value is None)
+        if value is None:
+            return None
+        return self.slot(value, kind)
+
+    def _reference(self, reference):
+        if not reference:
+            self.token('reference', self._hashable(reference))
+            return reference
+        if not isinstance(reference, basestring):
+            raise UnsupportedShape("Non-string spectrum reference %r" % (reference,))
+        self.token('reference', True)
+        return self.slot(reference, SLOT_REFERENCE)
+
+    def _isolation_window(self, isolation_window):
+        if not isolation_window:
+            self.token('no isolation window')
+            return isolation_window
+        if not isinstance(isolation_window, Mapping) or not {
+                'lower', 'target', 'upper', 'params'}.issuperset(isolation_window):
+            raise UnsupportedShape("Cannot describe isolation window %r" % (isolation_window,))
+        isolation_window = dict(isolation_window)
+        for key in ('lower', 'target', 'upper'):
+            isolation_window[key] = self._optional_value(key, isolation_window.get(key))
+        isolation_window['params'] = self._params(isolation_window.get('params'))
+        return isolation_window
+
+    def _precursor(self, precursor):
+        if precursor is None:
+            self.token('no precursor')
+            return None
+        if not isinstance(precursor, Mapping):
+            raise UnsupportedShape("Cannot describe precursor %r" % (precursor,))
+        known = {'mz', 'intensity', 'charge', 'scan_id', 'spectrum_reference', 'activation',
+                 'isolation_window_args', 'params'}
+        if not known.issuperset(precursor):
+            raise UnsupportedShape("Cannot describe precursor keys %r" % (sorted(precursor),))
+        precursor = dict(precursor)
+        self.token('precursor', tuple(sorted(precursor)))
+        precursor['mz'] = self._optional_value('mz', precursor.get('mz'))
+        precursor['intensity'] = self._optional_value('intensity', precursor.get('intensity'))
+        charge = precursor.get('charge')
+        if charge is None:
+            self.token('charge', None)
+        elif isinstance(charge, numbers.Number):
+            self.token('charge', 'number')
+            if not self.sentinels:
+                charge = int(charge)
+            precursor['charge'] = self.slot(charge, SLOT_NUMBER)
+        elif isinstance(charge, Iterable) and not isinstance(charge, basestring):
+            charge = list(charge)
+            self.token('charge', len(charge))
+            precursor['charge'] = [self.slot(c) for c in charge]
+        else:
+            raise UnsupportedShape("Cannot describe charge %r" % (charge,))
+        if precursor.get('scan_id') is not None:
+            precursor['scan_id'] = self._reference(precursor['scan_id'])
+        else:
+            self.token('no scan id')
+            if 'spectrum_reference' in precursor:
+                precursor['spectrum_reference'] = self._reference(precursor['spectrum_reference'])
+        activation = precursor.get('activation')
+        if activation:
+            if not isinstance(activation, (list, tuple)):
+                raise UnsupportedShape("Cannot describe activation %r" % (activation,))
+            precursor['activation'] = self._params(list(activation))
+        else:
+            self.token('no activation')
+        precursor['isolation_window_args'] = self._isolation_window(precursor.get('isolation_window_args'))
+        precursor['params'] = self._params(precursor.get('params'))
+        return precursor
+
+    def _scan_window(self, window):
+        if isinstance(window, (tuple, list)) and len(window) in (2, 3):
+            lower, upper = window[:2]
+            params = window[2] if len(window) == 3 else None
+        elif isinstance(window, Mapping) and {'lower', 'upper', 'params'}.issuperset(window):
+            lower, upper, params = window.get('lower'), window.get('upper'), window.get('params')
+        else:
+            raise UnsupportedShape("Cannot describe scan window %r" % (window,))
+        self.token('scan window')
+        return {"lower": self.slot(lower), "upper": self.slot(upper), "params": self._params(params)}
+
+    def _array_options(self, arguments):
+        for key in ('encoding', 'compression'):
+            value = arguments.get(key)
+            # Tables resolved once for a batch of spectra describe the value they were built from
+            value = getattr(value, 'source', value)
+            if isinstance(value, Mapping):
+                value = tuple(sorted(value.items()))
+            self.token(key, self._hashable(value))
+
+    def _walk(self, arguments):
+        arguments = dict(arguments)
+        self.index = self.slot(arguments.pop('index'), SLOT_NUMBER)
+        spectrum_id = arguments.get('id')
+        if not isinstance(spectrum_id, basestring):
+            raise UnsupportedShape("Non-string spectrum id %r" % (spectrum_id,))
+        arguments['id'] = self.slot(spectrum_id)
+        for key in ('polarity', 'centroided', 'intensity_unit', 'instrument_configuration_id'):
+            self.token(key, self._hashable(arguments.get(key)))
+        self._array_options(arguments)
+
+        mz_array = arguments.get('mz_array')
+        if mz_array is None:
+            raise UnsupportedShape("A spectrum requires an m/z array")
+        default_length = len(mz_array)
+        self._default_length_sentinel = self.sentinel(len(self.values) + 2, SLOT_ARRAY_LENGTH)
+        arguments['mz_array'] = self._array(mz_array)
+        arguments['intensity_array'] = self._array(arguments.get('intensity_array'))
+        arguments['charge_array'] = self._array(arguments.get('charge_array'))
+        other_arrays = []
+        for array_type, array in arguments.get('other_arrays') or ():
+            self.token('other array', self._hashable(array_type))
+            other_arrays.append((array_type, self._array(array, default_length)))
+        arguments['other_arrays'] = other_arrays
+
+        scan_start_time = arguments.get('scan_start_time')
+        if isinstance(scan_start_time, numbers.Number):
+            self.token('scan start time', 'number')
+            arguments['scan_start_time'] = self.slot(scan_start_time, SLOT_NUMBER)
+        elif scan_start_time is None:
+            self.token('scan start time', None)
+        else:
+            self.token('scan start time', 'param')
+            arguments['scan_start_time'] = self._param(scan_start_time)
+        arguments['params'] = self._params(arguments.get('params'))
+        arguments['scan_params'] = self._params(arguments.get('scan_params'))
+        scan_window_list = arguments.get('scan_window_list')
+        if scan_window_list:
+            self.token('scan windows', len(scan_window_list))
+            arguments['scan_window_list'] = [self._scan_window(window) for window in scan_window_list]
+        else:
+            self.token('no scan windows')
+        arguments['precursor_information'] = self._precursor(arguments.get('precursor_information'))
+        return arguments
+
+
+class ChromatogramShape(SpectrumShape):
+    """Separates the arguments of :meth:`~.PlainMzMLWriter.write_chromatogram` into the
+    structure which determines a template and the values which fill it in.
+    """
+
+    def _product(self, product):
+        if product is None:
+            self.token('no product')
+            return None
+        if not isinstance(product, Mapping) or set(product) != {'isolation_window_args'}:
+            raise UnsupportedShape("Cannot describe product %r" % (product,))
+        self.token('product')
+        return {'isolation_window_args': self._isolation_window(product['isolation_window_args'])}
+
+    def _walk(self, arguments):
+        arguments = dict(arguments)
+        self.index = self.slot(arguments.pop('index'), SLOT_NUMBER)
+        chromatogram_id = arguments.get('id')
+        if not isinstance(chromatogram_id, basestring):
+            raise UnsupportedShape("Non-string chromatogram id %r" % (chromatogram_id,))
+        arguments['id'] = self.slot(chromatogram_id)
+        for key in ('chromatogram_type', 'intensity_unit', 'time_unit'):
+            self.token(key, self._hashable(arguments.get(key)))
+        self._array_options(arguments)
+
+        time_array = arguments.get('time_array')
+        if time_array is None:
+            raise UnsupportedShape("A chromatogram requires a time array")
+        default_length = len(time_array)
+        self._default_length_sentinel = self.sentinel(len(self.values) + 2, SLOT_ARRAY_LENGTH)
+        arguments['time_array'] = self._array(time_array)
+        arguments['intensity_array'] = self._array(arguments.get('intensity_array'))
+        other_arrays = []
+        for array_type, array in arguments.get('other_arrays') or ():
+            self.token('other array', self._hashable(array_type))
+            other_arrays.append((array_type, self._array(array, default_length)))
+        arguments['other_arrays'] = other_arrays
+
+        arguments['params'] = self._params(arguments.get('params'))
+        arguments['precursor_information'] = self._precursor(arguments.get('precursor_information'))
+        arguments['product_information'] = self._product(arguments.get('product_information'))
+        return arguments
+
+
+def render_component(component, indent_level, encoding='utf-8'):
+    """Render ``component`` as it would be written by a writer at ``indent_level``
+
+    Parameters
+    ----------
+    component : :class:`~.ComponentBase`
+        The component to render
+    indent_level : int
+        The indentation level of the element the component will be written in
+
+    Returns
+    -------
+    bytes
+    """
+    buffer = BytesIO()
+    with XMLFormattingStreamWriter(buffer, encoding=encoding) as writer:
+        with writer.element("template"):
+            writer.indent_level = indent_level
+            writer.flush()
+            start = len(buffer.getvalue())
+            component.write(writer)
+            writer.flush()
+            end = len(buffer.getvalue())
+            writer.indent_level = 1
+    return buffer.getvalue()[start:end]
+
+
+class SpectrumTemplate(object):
+    """The rendered markup of a spectrum shape, split at each value.
+
+    Attributes
+    ----------
+    fragments : list of bytes
+        The markup between consecutive slots
+    slots : list of int
+        The index of the value written after the corresponding fragment
+    kinds : list
+        The kind of each value
+    arrays : list of tuple
+        The ``(dtype, compression, significant_bits)`` to encode each array with
+    """
+
+    def __init__(self, fragments, slots, kinds, arrays):
+        self.fragments = fragments
+        self.slots = slots
+        self.kinds = kinds
+        self.arrays = arrays
+
+    @classmethod
+    def compile(cls, rendered, shape):
+        """Build a template from the markup ``rendered`` for the sentinel values
+        of ``shape``.
+
+        Raises
+        ------
+        UnsupportedShape
+            If a sentinel does not appear exactly once
+        """
+        positions = []
+        for index, kind in enumerate(shape.kinds):
+            sentinel = shape.sentinel(index, kind)
+            if kind == SLOT_ARRAY:
+                sentinel = sentinel.encode('ascii')
+            else:
+                sentinel = render_attribute(sentinel)
+            count = rendered.count(sentinel)
+            if count > 1:
+                raise UnsupportedShape("Value %d was rendered %d times" % (index, count))
+            elif count == 1:
+                positions.append((rendered.index(sentinel), len(sentinel), index))
+            elif kind not in (SLOT_ARRAY_LENGTH, SLOT_ENCODED_LENGTH):
+                raise UnsupportedShape("Value %d was not rendered" % (index, ))
+        positions.sort()
+        fragments = []
+        slots = []
+        last = 0
+        for position, size, index in positions:
+            fragments.append(rendered[last:position])
+            slots.append(index)
+            last = position + size
+        fragments.append(rendered[last:])
+        arrays = [array.encoding for array in shape.arrays]
+        return cls(fragments, slots, list(shape.kinds), arrays)
+
+    def resolve(self, values):
+        """Wait for any arrays still being encoded, and fill in their encoded lengths"""
+        values = list(values)
+        for i, kind in enumerate(self.kinds):
+            if kind == SLOT_ARRAY:
+                value = values[i]
+                if hasattr(value, 'result'):
+                    value = values[i] = value.result()
+                values[i + 1] = len(value)
+        return values
+
+    def render(self, values):
+        """Fill ``values`` into the template.
+
+        Consecutive pieces are joined so that each start tag is produced whole, except around
+        arrays being streamed with a :class:`~.StreamingArrayEncoder`.
+
+        Parameters
+        ----------
+        values : list
+            The value of each slot, after :meth:`resolve`
+
+        Yields
+        ------
+        bytes
+        """
+        pieces = []
+        fragments = self.fragments
+        for i, index in enumerate(self.slots):
+            pieces.append(fragments[i])
+            value = values[index]
+            if self.kinds[index] == SLOT_ARRAY:
+                if isinstance(value, StreamingArrayEncoder):
+                    pieces.append(b'')
+                    yield b''.join(pieces)
+                    pieces = []
+                    for chunk in value:
+                        yield chunk
+                    continue
+                if isinstance(value, text_type):
+                    value = value.encode('ascii')
+                pieces.append(value)
+            else:
+                pieces.append(render_attribute(value))
+        pieces.append(fragments[-1])
+        yield b''.join(pieces)
+
+
+class TemplatedSpectrum(object):
+    """A spectrum or chromatogram to be written by filling in a :class:`SpectrumTemplate`,
+    standing in for a :class:`~.Spectrum` or :class:`~.Chromatogram` component in the
+    writer's queue.
+
+    Attributes
+    ----------
+    template : :class:`SpectrumTemplate`
+        The template to fill in
+    values : list
+        The value of each slot
+    name : str or None
+        The name of the element written, reported to the index with its :attr:`id`
+        and :attr:`index`
+    id : str or None
+    index : int or None
+    """
+
+    def __init__(self, template, values, name=None, id=None, index=None):
+        self.template = template
+        self.values = values
+        self.name = name
+        self.id = id
+        self.index = index
+
+    def render(self):
+        return self.template.render(self.template.resolve(self.values))
+
+    def write(self, xml_file):
+        if self.name is not None:
+            report_offset(xml_file, self.name, self.id, self.index)
+        for piece in self.render():
+            xml_file.write_raw(piece)
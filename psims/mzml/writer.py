@@ -1,14 +1,25 @@
+import functools
+import logging
 import numbers
+import sys
+import threading
 import warnings
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 try:
     from collections import Mapping
 except ImportError:
     from collections.abc import Mapping
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 import numpy as np
+import six
+from six.moves import queue
 
 from psims.xml import XMLWriterMixin, XMLDocumentWriter
 from psims.utils import TableStateMachine
@@ -18,14 +29,29 @@ from .components import (
     default_cv_list, MzML, InstrumentConfiguration, IndexedMzML)
 
 from .binary_encoding import (
-    encode_array, COMPRESSION_ZLIB,
-    encoding_map, compression_map, dtype_to_encoding)
+    encode_array, COMPRESSION_ZLIB, NUMPRESS_DTYPE,
+    encoding_map, compression_map, dtype_to_encoding,
+    numpress_codecs, truncation_codecs, DEFAULT_SIGNIFICANT_BITS,
+    TRUNCATION_PARAM, auto_encodings, narrowest_lossless_dtype,
+    StreamingArrayEncoder, streamable_compressions, EncodingCache)
+
+from .codec_selection import AdaptiveCompressionSelector, COMPRESSION_AUTO, SPECTRUM, CHROMATOGRAM
+
+from .template import (
+    ArraySlot, SpectrumShape, ChromatogramShape, SpectrumTemplate, TemplatedSpectrum, UnsupportedShape,
+    render_component, SLOT_ARRAY, SLOT_REFERENCE)
 
 from .utils import ensure_iterable
 
-from .index import IndexingStream
+from .param_groups import ParamGroupFactorer, SPECTRUM_PARAMS, SCAN_PARAMS
+
+from .index import IndexingStream, HashingStream, Placeholder, is_patchable
+from .offset_index import OffsetIndex, SIDECAR_SUFFIX
+from .metadata_index import SpectrumMetadataIndex, METADATA_SUFFIX
 
 
+logger = logging.getLogger(__name__)
+
 MZ_ARRAY = 'm/z array'
 INTENSITY_ARRAY = 'intensity array'
 DEFAULT_INTENSITY_UNIT = "number of detector counts"
@@ -34,6 +60,9 @@ TIME_ARRAY = "time array"
 DEFAULT_TIME_UNIT = "minute"
 NON_STANDARD_ARRAY = 'non-standard data array'
 
+# The number of bytes an indexed document collects before writing them to its file
+DEFAULT_WRITE_BUFFER_SIZE = 2 ** 16
+
 ARRAY_TYPES = [
     'm/z array',
     'intensity array',
@@ -50,6 +79,156 @@ ARRAY_TYPES = [
     'baseline array'
 ]
 
+SPECTRUM_ARGUMENT_DEFAULTS = {
+    'mz_array': None, 'intensity_array': None, 'charge_array': None, 'id': None,
+    'polarity': 'positive scan', 'centroided': True, 'precursor_information': None,
+    'scan_start_time': None, 'params': None, 'compression': COMPRESSION_ZLIB,
+    'encoding': None, 'other_arrays': None, 'scan_params': None, 'scan_window_list': None,
+    'instrument_configuration_id': None, 'intensity_unit': DEFAULT_INTENSITY_UNIT,
+}
+
+SRM_CHROMATOGRAM = "selected reaction monitoring chromatogram"
+DEFAULT_ACTIVATION = "collision-induced dissociation"
+
+COUNT_PLACEHOLDER_WIDTH = 10
+
+
+class ArrayParameterTable(defaultdict):
+    """Maps each array type to the encoding or compression to use for it, remembering
+    the value it was built from so that it can stand in for that value.
+
+    Attributes
+    ----------
+    source : object
+        The mapping or single value the table was built from
+    """
+
+    def __init__(self, default, source):
+        if isinstance(source, Mapping):
+            super(ArrayParameterTable, self).__init__(lambda: default, source)
+        else:
+            super(ArrayParameterTable, self).__init__(lambda: source)
+        self.source = source
+
+    @classmethod
+    def resolve(cls, value, default):
+        """Build a table from ``value``, unless it is already one
+
+        Parameters
+        ----------
+        value : object
+            A mapping from array type to value, or a single value for all array types
+        default : object
+            The value of array types missing from a mapping
+
+        Returns
+        -------
+        :class:`ArrayParameterTable`
+        """
+        if isinstance(value, cls):
+            return value
+        return cls(default, value)
+
+
+_polarity_cache = {}
+
+
+def resolve_polarity(polarity):
+    """Get the polarity parameter named by ``polarity``
+
+    Parameters
+    ----------
+    polarity : int, str or None
+        A signed number or a string containing "positive" or "negative"
+
+    Returns
+    -------
+    str or None
+    """
+    try:
+        return _polarity_cache[polarity]
+    except (KeyError, TypeError):
+        pass
+    resolved = None
+    if polarity is None:
+        pass
+    elif isinstance(polarity, numbers.Number):
+        if polarity > 0:
+            resolved = 'positive scan'
+        elif polarity < 0:
+            resolved = 'negative scan'
+    elif 'positive' in polarity:
+        resolved = 'positive scan'
+    elif 'negative' in polarity:
+        resolved = 'negative scan'
+    try:
+        _polarity_cache[polarity] = resolved
+    except TypeError:
+        pass
+    return resolved
+
+
+class SharedArray(object):
+    """An array written by every entity of a batch, like the time axis shared by the
+    chromatograms passed to :meth:`~.PlainMzMLWriter.write_chromatograms`, with its
+    encodings, so that it is only encoded once.
+
+    Attributes
+    ----------
+    array : :class:`numpy.ndarray`
+        The shared array, recognized by identity
+    encodings : dict
+        The encoding of the array for each ``(dtype, compression, significant_bits)``
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.encodings = {}
+
+
+class DeferredCount(object):
+    """Stands in for the ``count`` attribute of a list section whose size is not known
+    when it is opened, and fills it in when the section closes.
+
+    The count is written as a zero-padded placeholder and overwritten in place, so the
+    output must be seekable, and readable or reopenable by name. The checksum of an
+    indexed document is held while the section is written, and the section is read back
+    to update it once the count has been filled in.
+    """
+
+    def __init__(self, writer, counter):
+        self.writer = writer
+        self.counter = counter
+        self.initial = counter()
+        stream = writer.outfile
+        self.hashing_stream = None
+        if isinstance(stream, HashingStream):
+            self.hashing_stream = stream
+            stream = stream.stream
+        if not is_patchable(stream):
+            raise ValueError(
+                "A count of None requires a seekable output which can be read back, not %r" % (stream, ))
+        writer.writer.flush()
+        if self.hashing_stream is not None:
+            self.hashing_stream.hold_checksum()
+        self.placeholder = Placeholder(stream, self._render(0))
+
+    @staticmethod
+    def _render(count):
+        return 'count="%0*d"' % (COUNT_PLACEHOLDER_WIDTH, count)
+
+    @property
+    def value(self):
+        return '0' * COUNT_PLACEHOLDER_WIDTH
+
+    def fill(self):
+        self.writer.writer.flush()
+        if self.hashing_stream is not None:
+            self.hashing_stream.flush()
+        self.placeholder.fill(self._render(self.counter() - self.initial))
+        if self.hashing_stream is not None:
+            self.hashing_stream.release_checksum()
+
 
 class DocumentSection(ComponentDispatcher, XMLWriterMixin):
 
@@ -61,6 +240,17 @@ class DocumentSection(ComponentDispatcher, XMLWriterMixin):
         self.section = section
         self.writer = writer
         self.section_args = section_args
+        self._before_exit_queue = []
+
+    def before_exit(self, callback):
+        """Register a callable to be invoked just before the section's
+        closing tag is written.
+
+        Parameters
+        ----------
+        callback : Callable
+        """
+        self._before_exit_queue.append(callback)
 
     def __enter__(self):
         self.toplevel = element(self.writer, self.section, **self.section_args)
@@ -68,6 +258,8 @@ class DocumentSection(ComponentDispatcher, XMLWriterMixin):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        for callback in self._before_exit_queue:
+            callback()
         self.toplevel.__exit__(exc_type, exc_value, traceback)
         self.writer.flush()
 
@@ -173,19 +365,75 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
     attribute and access to all `Component` objects pre-bound to that context with attribute-access
     notation.
 
+    When ``encoding_workers`` is greater than zero, binary data arrays are encoded on a
+    pool of that many threads. Arrays are submitted for encoding as soon as :meth:`write_spectrum`
+    or :meth:`write_chromatogram` is called, and up to ``encoding_lookahead`` spectra or chromatograms
+    are held in a queue while their arrays encode, so that the arrays of one entity and those of the
+    entities queued behind it can be encoded concurrently. Entities are always written in the order
+    they were submitted, and the queue is drained when the enclosing list section closes.
+
     Attributes
     ----------
     chromatogram_count : int
         A count of the number of chromatograms written
     spectrum_count : int
         A count of the number of spectra written
+    encoding_workers : int
+        The number of threads used to encode binary data arrays. If 0, arrays
+        are encoded serially on the calling thread.
+    encoding_lookahead : int
+        The maximum number of spectra or chromatograms to hold in the queue
+        waiting for their binary data arrays to be encoded
+    compression_selector : :class:`~.AdaptiveCompressionSelector`
+        Chooses the compression method for arrays written with ``compression='auto'``,
+        subject to the :class:`~.CompressionPolicy` passed as ``compression_policy``.
+        See :meth:`compression_report` for the choices made, which are also logged
+        at the ``INFO`` level when the document ends.
+    significant_bits : int or :class:`Mapping`
+        The number of explicit mantissa bits kept for arrays written with
+        ``compression='truncate zlib'`` or ``compression='truncate'``, optionally
+        a mapping from array type to number of bits. The number of bits kept is
+        recorded on each truncated array with a ``userParam``.
+    streaming_threshold : int or None
+        The size in bytes above which an array is encoded incrementally with a
+        :class:`~.StreamingArrayEncoder` while it is written, rather than all at once
+        when it is passed in. Streamed arrays are read when they are written, so they
+        must not be modified until then, and are not encoded by the ``encoding_workers``.
+        If :const:`None`, arrays are never streamed.
+    encoding_cache : :class:`~.EncodingCache` or None
+        Remembers the encodings of recently written arrays so that arrays which repeat
+        exactly, like the m/z arrays of profile spectra on a fixed grid, are only encoded
+        once. Enabled by passing the maximum number of encodings to keep, or an
+        :class:`~.EncodingCache`, as ``encoding_cache``.
+    spectrum_templates : bool
+        Whether to write spectra passed to :meth:`write_spectrum` by filling in a
+        :class:`~.SpectrumTemplate` compiled for each distinct spectrum shape, rather than
+        building and writing their components. The output is unchanged. Shapes which
+        cannot be templated are written normally.
+    derived_chromatograms : list of :class:`~.ChromatogramAccumulator`
+        Chromatograms, like a :class:`~.TotalIonChromatogram`, accumulated from each
+        spectrum as it is written, and written when the ``<chromatogramList>`` closes.
+        A ``count`` passed to :meth:`chromatogram_list` need not include them.
+    param_groups : :class:`~.ParamGroupFactorer` or None
+        Replaces the parameters spectra share with references to the parameter groups
+        detected by :meth:`reference_param_group_list` from a sample of spectra
+    metadata_index : :class:`~.SpectrumMetadataIndex` or None
+        Records the start time, MS level, precursor and offset of each spectrum written,
+        to be queried without reading the document. A path or binary file passed as
+        ``metadata_index`` creates one which is saved there when the document is complete,
+        and ``metadata_index=True`` saves it beside the output file, with
+        :const:`~.METADATA_SUFFIX` appended to its name.
     """
 
     DEFAULT_TIME_UNIT = DEFAULT_TIME_UNIT
     DEFAULT_INTENSITY_UNIT = DEFAULT_INTENSITY_UNIT
 
     def __init__(self, outfile, close=False, vocabularies=None, missing_reference_is_error=False,
-                 vocabulary_resolver=None, id=None, accession=None, **kwargs):
+                 vocabulary_resolver=None, id=None, accession=None, encoding_workers=0,
+                 encoding_lookahead=None, compression_policy=None,
+                 significant_bits=DEFAULT_SIGNIFICANT_BITS, streaming_threshold=None,
+                 encoding_cache=None, spectrum_templates=False, derived_chromatograms=None,
+                 metadata_index=None, **kwargs):
         if vocabularies is None:
             vocabularies = []
         vocabularies = list(default_cv_list) + list(vocabularies)
@@ -200,6 +448,45 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
         self.spectrum_count = 0
         self.chromatogram_count = 0
         self.default_instrument_configuration = None
+        self.encoding_workers = encoding_workers or 0
+        if encoding_lookahead is None:
+            encoding_lookahead = self.encoding_workers
+        self.encoding_lookahead = encoding_lookahead
+        self._encoding_executor = None
+        if self.encoding_workers > 0:
+            if ThreadPoolExecutor is None:
+                raise ImportError(
+                    "concurrent.futures is required to use encoding_workers")
+            self._encoding_executor = ThreadPoolExecutor(self.encoding_workers)
+        self._write_queue = deque()
+        self.compression_selector = AdaptiveCompressionSelector(compression_policy)
+        if isinstance(significant_bits, Mapping):
+            significant_bits = defaultdict(lambda: DEFAULT_SIGNIFICANT_BITS, significant_bits)
+        else:
+            _significant_bits = significant_bits
+            significant_bits = defaultdict(lambda: _significant_bits)
+        self.significant_bits = significant_bits
+        self.streaming_threshold = streaming_threshold
+        if isinstance(encoding_cache, numbers.Integral):
+            encoding_cache = EncodingCache(encoding_cache) if encoding_cache > 0 else None
+        self.encoding_cache = encoding_cache
+        # Templates are rendered as UTF-8 and written directly to the output stream
+        can_template = self.encoding.lower().replace('-', '') == 'utf8' and hasattr(
+            self.xmlfile.stream, 'write')
+        self._spectrum_templates = {} if spectrum_templates and can_template else None
+        self._chromatogram_templates = {} if can_template else None
+        self.derived_chromatograms = list(derived_chromatograms or ())
+        self._derived_chromatograms_written = False
+        if metadata_index is True:
+            try:
+                metadata_index = getattr(self.outfile, 'name', self.outfile) + METADATA_SUFFIX
+            except TypeError:
+                raise ValueError(
+                    "metadata_index=True requires an output file with a name, not %r" % (self.outfile, ))
+        if metadata_index is not None and not isinstance(metadata_index, SpectrumMetadataIndex):
+            metadata_index = SpectrumMetadataIndex(metadata_index)
+        self.metadata_index = metadata_index
+        self.param_groups = None
         self.state_machine = TableStateMachine([
             ("start", ['controlled_vocabularies', ]),
             ("controlled_vocabularies", ['file_description', ]),
@@ -308,19 +595,40 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
             self.DataProcessing.ensure(dp) for dp in ensure_iterable(data_processing)]
         self.DataProcessingList(methods).write(self)
 
-    def reference_param_group_list(self, groups):
+    def reference_param_group_list(self, groups, sample_spectra=None, param_group_factorer=None):
         """Writes the ``<referenceableParamGroupList>`` section of the document.
 
+        If ``sample_spectra`` are given, the parameters which recur across them are
+        grouped by a :class:`~.ParamGroupFactorer`, and the groups are written after
+        ``groups``, renamed if their ids are already used by ``groups``. Every spectrum
+        written afterwards which carries all of the parameters of a group refers to the
+        group instead of repeating them.
+
         Parameters
         ----------
         groups : list
             A list or other iterable of :class:`dict` or :class:`~.ReferenceableParamGroup`-like
             objects
-
+        sample_spectra : iterable of :class:`dict`, optional
+            The :meth:`write_spectrum` arguments of representative spectra, like the first
+            few spectra to be written, or a single spectrum declaring their shape
+        param_group_factorer : :class:`~.ParamGroupFactorer`, optional
+            Detects the recurring parameters of ``sample_spectra``, with its default
+            settings if not given
         """
         self.state_machine.transition("reference_param_group_list")
+        groups = list(ensure_iterable(groups or []))
+        if sample_spectra is not None:
+            if param_group_factorer is None:
+                param_group_factorer = ParamGroupFactorer()
+            for spectrum in sample_spectra:
+                param_group_factorer.observe(self._param_sites(spectrum))
+            reserved_ids = [
+                g.get('id') if isinstance(g, Mapping) else getattr(g, 'id', None) for g in groups]
+            groups.extend(group.to_dict() for group in param_group_factorer.build(reserved_ids))
+            self.param_groups = param_group_factorer
         groups = [
-            self.ReferenceableParamGroup.ensure(g) for g in ensure_iterable(groups)]
+            self.ReferenceableParamGroup.ensure(g) for g in groups]
         self.ReferenceableParamGroupList(groups).write(self)
 
     def sample_list(self, samples):
@@ -398,6 +706,20 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
             sample=sample, **kwargs)
 
     def spectrum_list(self, count, data_processing_method=None):
+        """Open the ``<spectrumList>`` section
+
+        Parameters
+        ----------
+        count : int or None
+            The number of spectra which will be written. If :const:`None`, the count is
+            filled in when the section closes, which requires a seekable output.
+        data_processing_method : object, optional
+            The default data processing method of the spectra
+
+        Returns
+        -------
+        :class:`SpectrumListSection`
+        """
         self.state_machine.transition('spectrum_list')
         if data_processing_method is None:
             dp_map = self.context['DataProcessing']
@@ -407,11 +729,34 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
                 warnings.warn(
                     "No Data Processing method found. mzML file may not be fully standard-compliant",
                     stacklevel=2)
-        return SpectrumListSection(
+        deferred_count = None
+        if count is None:
+            deferred_count = DeferredCount(self, lambda: self.spectrum_count)
+            count = deferred_count.value
+        section = SpectrumListSection(
             self.writer, self.context, count=count,
             data_processing_method=data_processing_method)
+        section.before_exit(self._flush_write_queue)
+        if deferred_count is not None:
+            section.before_exit(deferred_count.fill)
+        return section
 
     def chromatogram_list(self, count, data_processing_method=None):
+        """Open the ``<chromatogramList>`` section
+
+        Parameters
+        ----------
+        count : int or None
+            The number of chromatograms which will be written, not counting any
+            :attr:`derived_chromatograms`. If :const:`None`, the count is filled in when
+            the section closes, which requires a seekable output.
+        data_processing_method : object, optional
+            The default data processing method of the chromatograms
+
+        Returns
+        -------
+        :class:`ChromatogramListSection`
+        """
         self.state_machine.transition('chromatogram_list')
         if data_processing_method is None:
             dp_map = self.context['DataProcessing']
@@ -421,9 +766,21 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
                 warnings.warn(
                     "No Data Processing method found. mzML file may not be fully standard-compliant",
                     stacklevel=2)
-        return ChromatogramListSection(
+        deferred_count = None
+        if count is None:
+            deferred_count = DeferredCount(self, lambda: self.chromatogram_count)
+            count = deferred_count.value
+        else:
+            count += sum(len(derived.ids) for derived in self.derived_chromatograms)
+        section = ChromatogramListSection(
             self.writer, self.context, count=count,
             data_processing_method=data_processing_method)
+        if self.derived_chromatograms:
+            section.before_exit(self._write_derived_chromatograms)
+        section.before_exit(self._flush_write_queue)
+        if deferred_count is not None:
+            section.before_exit(deferred_count.fill)
+        return section
 
     def spectrum(self, mz_array=None, intensity_array=None, charge_array=None, id=None,
                  polarity='positive scan', centroided=True, precursor_information=None,
@@ -431,6 +788,21 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
                  encoding=None, other_arrays=None, scan_params=None, scan_window_list=None,
                  instrument_configuration_id=None, intensity_unit=DEFAULT_INTENSITY_UNIT):
         self.state_machine.expects_state("spectrum_list")
+        return self._spectrum(
+            mz_array=mz_array, intensity_array=intensity_array, charge_array=charge_array,
+            id=id, polarity=polarity, centroided=centroided, precursor_information=precursor_information,
+            scan_start_time=scan_start_time, params=params, compression=compression,
+            encoding=encoding, other_arrays=other_arrays, scan_params=scan_params,
+            scan_window_list=scan_window_list,
+            instrument_configuration_id=instrument_configuration_id,
+            intensity_unit=intensity_unit)
+
+    def _spectrum(self, mz_array=None, intensity_array=None, charge_array=None, id=None,
+                  polarity='positive scan', centroided=True, precursor_information=None,
+                  scan_start_time=None, params=None, compression=COMPRESSION_ZLIB,
+                  encoding=None, other_arrays=None, scan_params=None, scan_window_list=None,
+                  instrument_configuration_id=None, intensity_unit=DEFAULT_INTENSITY_UNIT):
+        # Builds a spectrum without checking the state, which the public entry points do once
         if encoding is None:
             {MZ_ARRAY: np.float64}
         if params is None:
@@ -448,62 +820,43 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
         else:
             scan_window_list = list(scan_window_list)
 
-        if isinstance(encoding, Mapping):
-            encoding = defaultdict(lambda: np.float32, encoding)
-        else:
-            # create new variable to capture in closure
-            _encoding = encoding
-            encoding = defaultdict(lambda: _encoding)
-        if polarity is not None:
-            if isinstance(polarity, int):
-                if polarity > 0:
-                    polarity = 'positive scan'
-                elif polarity < 0:
-                    polarity = 'negative scan'
-                else:
-                    polarity = None
-            elif 'positive' in polarity:
-                polarity = 'positive scan'
-            elif 'negative' in polarity:
-                polarity = 'negative scan'
-            else:
-                polarity = None
-
-            if polarity not in params and polarity is not None:
-                params.append(polarity)
-
-        if centroided:
-            peak_mode = "centroid spectrum"
-        else:
-            peak_mode = 'profile spectrum'
-        params.append(peak_mode)
+        encoding = ArrayParameterTable.resolve(encoding, np.float32)
+        compression = ArrayParameterTable.resolve(compression, COMPRESSION_ZLIB)
+        for param in self._implicit_spectrum_params(polarity, centroided):
+            if param in params:
+                continue
+            # Already written by a referenced parameter group
+            if self.param_groups is not None and self.param_groups.covers(params, param):
+                continue
+            params.append(param)
 
         array_list = []
         default_array_length = len(mz_array)
         if mz_array is not None:
             mz_array_tag = self._prepare_array(
-                mz_array, encoding=encoding[MZ_ARRAY], compression=compression, array_type=MZ_ARRAY)
+                mz_array, encoding=encoding[MZ_ARRAY], compression=compression[MZ_ARRAY], array_type=MZ_ARRAY)
             array_list.append(mz_array_tag)
 
         if intensity_array is not None:
             intensity_array_tag = self._prepare_array(
-                intensity_array, encoding=encoding[INTENSITY_ARRAY], compression=compression,
+                intensity_array, encoding=encoding[INTENSITY_ARRAY], compression=compression[INTENSITY_ARRAY],
                 array_type={"name": INTENSITY_ARRAY, "unit_name": intensity_unit})
             array_list.append(intensity_array_tag)
 
         if charge_array is not None:
             charge_array_tag = self._prepare_array(
-                charge_array, encoding=encoding[CHARGE_ARRAY], compression=compression,
+                charge_array, encoding=encoding[CHARGE_ARRAY], compression=compression[CHARGE_ARRAY],
                 array_type=CHARGE_ARRAY)
             array_list.append(charge_array_tag)
         for array_type, array in other_arrays:
             if array_type is None:
                 raise ValueError("array type can't be None")
             array_tag = self._prepare_array(
-                array, encoding=encoding[array_type], compression=compression, array_type=array_type,
+                array, encoding=encoding[array_type], compression=compression[array_type], array_type=array_type,
                 default_array_length=default_array_length)
             array_list.append(array_tag)
         array_list_tag = self.BinaryDataArrayList(array_list)
+        self.compression_selector.end_entity()
 
         if precursor_information is not None:
             precursor_list = self._prepare_precursor_list(
@@ -516,6 +869,9 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
                 scan_params.append({"name": "scan start time",
                                     "value": scan_start_time,
                                     "unitName": DEFAULT_TIME_UNIT})
+            elif isinstance(scan_start_time, Mapping) and not (
+                    'name' in scan_start_time or 'accession' in scan_start_time):
+                scan_params.append(dict(scan_start_time, name="scan start time"))
             else:
                 scan_params.append(scan_start_time)
         # The spec says this is optional, but the validator calls this a must
@@ -538,7 +894,7 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
                        scan_start_time=None, params=None, compression=COMPRESSION_ZLIB,
                        encoding=None, other_arrays=None, scan_params=None, scan_window_list=None,
                        instrument_configuration_id=None, intensity_unit=DEFAULT_INTENSITY_UNIT):
-        spectrum = self.spectrum(
+        arguments = dict(
             mz_array=mz_array, intensity_array=intensity_array, charge_array=charge_array,
             id=id, polarity=polarity, centroided=centroided, precursor_information=precursor_information,
             scan_start_time=scan_start_time, params=params, compression=compression,
@@ -546,25 +902,200 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
             scan_window_list=scan_window_list,
             instrument_configuration_id=instrument_configuration_id,
             intensity_unit=intensity_unit)
-        spectrum.write(self.writer)
+        self.state_machine.expects_state("spectrum_list")
+        self._write_entity(self._build_spectrum, arguments)
+
+    def write_spectra(self, spectra, **kwargs):
+        """Write many spectra at once.
+
+        This does the work which :meth:`write_spectrum` repeats for every spectrum,
+        like checking the writer's state and resolving the keyword arguments shared
+        by all of the spectra, once for the whole batch.
+
+        Parameters
+        ----------
+        spectra : iterable of :class:`dict` or :class:`~.SpectrumBatch`
+            The spectra to write, each a mapping of :meth:`write_spectrum` keyword
+            arguments. A :class:`~.SpectrumBatch` supplies them from columnar arrays.
+        **kwargs
+            Keyword arguments of :meth:`write_spectrum` used for every spectrum which
+            does not give its own value
+
+        Returns
+        -------
+        int
+            The number of spectra written
+        """
+        self.state_machine.expects_state("spectrum_list")
+        unknown = set(kwargs) - set(SPECTRUM_ARGUMENT_DEFAULTS)
+        if unknown:
+            raise TypeError("Unexpected keyword arguments %s" % (', '.join(sorted(unknown)), ))
+        shared = dict(SPECTRUM_ARGUMENT_DEFAULTS, **kwargs)
+        shared['encoding'] = ArrayParameterTable.resolve(shared['encoding'], np.float32)
+        shared['compression'] = ArrayParameterTable.resolve(shared['compression'], COMPRESSION_ZLIB)
+        shared['polarity'] = resolve_polarity(shared['polarity'])
+        n = 0
+        for spectrum in spectra:
+            arguments = dict(shared)
+            arguments.update(spectrum)
+            self._write_entity(self._build_spectrum, arguments)
+            n += 1
+        return n
+
+    def _build_spectrum(self, arguments):
+        for derived in self.derived_chromatograms:
+            derived.add(arguments)
+        if self.metadata_index is not None:
+            self.metadata_index.add(arguments)
+        if self.param_groups is not None:
+            arguments = self._factor_params(arguments)
+        spectrum = None
+        if self._spectrum_templates is not None:
+            spectrum = self._templated_spectrum(arguments)
+        if spectrum is None:
+            spectrum = self._spectrum(**arguments)
+        return spectrum
+
+    def _implicit_spectrum_params(self, polarity, centroided):
+        params = []
+        polarity = resolve_polarity(polarity)
+        if polarity is not None:
+            params.append(polarity)
+        if centroided:
+            params.append("centroid spectrum")
+        else:
+            params.append('profile spectrum')
+        return params
+
+    def _param_sites(self, arguments):
+        # The parameters each place of a spectrum would be written with
+        params = list(arguments.get('params') or ())
+        implicit = self._implicit_spectrum_params(
+            arguments.get('polarity', 'positive scan'), arguments.get('centroided', True))
+        return {
+            SPECTRUM_PARAMS: params + [param for param in implicit if param not in params],
+            SCAN_PARAMS: list(arguments.get('scan_params') or ()),
+        }
+
+    def _factor_params(self, arguments):
+        arguments = dict(arguments)
+        for site, params in self._param_sites(arguments).items():
+            factored = self.param_groups.apply(site, params)
+            if factored is not None:
+                # The implicit parameters which were not grouped are added back when the
+                # spectrum is built
+                given = arguments.get(site) or ()
+                arguments[site] = factored[:1] + [param for param in factored[1:] if param in given]
+        return arguments
+
+    def _templated_spectrum(self, arguments):
+        try:
+            shape = SpectrumShape(dict(arguments, index=self.spectrum_count))
+        except UnsupportedShape:
+            return None
+        return self._templated_entity(
+            shape, arguments, self._spectrum_templates, self._spectrum, 'spectrum_count', 'Spectrum')
+
+    def _templated_entity(self, shape, arguments, templates, build, count_name, entity_type,
+                          shared_array=None):
+        try:
+            template = templates[shape.key]
+        except KeyError:
+            # The first entity of each shape is written normally, and used to
+            # check the template compiled for the shape
+            entity = build(**arguments)
+            templates[shape.key] = self._compile_template(shape, entity, build, count_name, entity_type)
+            return entity
+        if template is None:
+            return None
+        values = shape.values
+        references = self.context['Spectrum']
+        arrays = iter(template.arrays)
+        for i, kind in enumerate(shape.kinds):
+            if kind == SLOT_ARRAY:
+                dtype, compression, significant_bits = next(arrays)
+                if shared_array is None or values[i] is not shared_array.array:
+                    _, values[i], _ = self._encode_array_data(
+                        values[i], dtype, compression, significant_bits=significant_bits)
+                    continue
+                # The array shared by a batch of entities is encoded once
+                key = (dtype, compression, significant_bits)
+                try:
+                    values[i] = shared_array.encodings[key]
+                except KeyError:
+                    _, values[i], _ = self._encode_array_data(
+                        values[i], dtype, compression, significant_bits=significant_bits)
+                    shared_array.encodings[key] = values[i]
+        for i, kind in enumerate(shape.kinds):
+            if kind == SLOT_REFERENCE:
+                values[i] = references[values[i]]
+        self.context[entity_type][arguments['id']] = arguments['id']
+        index = getattr(self, count_name)
+        setattr(self, count_name, index + 1)
+        return TemplatedSpectrum(template, values, entity_type.lower(), arguments['id'], index)
+
+    def _compile_template(self, shape, entity, build, count_name, entity_type):
+        sentinels = shape.__class__(dict(shape.arguments, index=None), sentinels=True)
+        references = self.context['Spectrum']
+        registered = [(self.context[entity_type], sentinels.arguments['id'])]
+        for i, kind in enumerate(sentinels.kinds):
+            if kind == SLOT_REFERENCE:
+                registered.append((references, sentinels.sentinel(i, kind)))
+                references[registered[-1][1]] = registered[-1][1]
+        count = getattr(self, count_name)
+        setattr(self, count_name, sentinels.index)
+        try:
+            prototype = build(**sentinels.arguments)
+            indent_level = self._entity_indent_level()
+            template = SpectrumTemplate.compile(render_component(prototype, indent_level), sentinels)
+        except Exception:
+            # Anything the sentinels cannot stand in for makes the shape untemplatable
+            return None
+        finally:
+            setattr(self, count_name, count)
+            for registry, key in registered:
+                registry.pop(key, None)
+                registry.bijection.pop(key, None)
+        # Check the template reproduces the entity written through the components
+        values = list(shape.values)
+        binaries = iter(entity.binary_data_list)
+        for i, kind in enumerate(shape.kinds):
+            if kind == SLOT_ARRAY:
+                values[i] = next(binaries).binary.resolve()
+            elif kind == SLOT_REFERENCE:
+                values[i] = references[values[i]]
+        expected = render_component(entity, indent_level)
+        if b''.join(template.render(template.resolve(values))) != expected:
+            return None
+        return template
 
     def chromatogram(self, time_array, intensity_array, id=None,
                      chromatogram_type="selected ion current",
                      precursor_information=None, params=None,
                      compression=COMPRESSION_ZLIB, encoding=32, other_arrays=None,
-                     intensity_unit=DEFAULT_INTENSITY_UNIT, time_unit=DEFAULT_TIME_UNIT):
+                     intensity_unit=DEFAULT_INTENSITY_UNIT, time_unit=DEFAULT_TIME_UNIT,
+                     product_information=None):
         self.state_machine.expects_state("chromatogram_list")
+        return self._chromatogram(
+            time_array, intensity_array, id=id, chromatogram_type=chromatogram_type,
+            precursor_information=precursor_information, params=params,
+            compression=compression, encoding=encoding, other_arrays=other_arrays,
+            intensity_unit=intensity_unit, time_unit=time_unit,
+            product_information=product_information)
+
+    def _chromatogram(self, time_array, intensity_array, id=None,
+                      chromatogram_type="selected ion current",
+                      precursor_information=None, params=None,
+                      compression=COMPRESSION_ZLIB, encoding=32, other_arrays=None,
+                      intensity_unit=DEFAULT_INTENSITY_UNIT, time_unit=DEFAULT_TIME_UNIT,
+                      product_information=None):
         if params is None:
             params = []
         else:
             params = list(params)
 
-        if isinstance(encoding, Mapping):
-            encoding = defaultdict(lambda: np.float32, encoding)
-        else:
-            # create new variable to capture in closure
-            _encoding = encoding
-            encoding = defaultdict(lambda: _encoding)
+        encoding = ArrayParameterTable.resolve(encoding, np.float32)
+        compression = ArrayParameterTable.resolve(compression, COMPRESSION_ZLIB)
 
         if other_arrays is None:
             other_arrays = []
@@ -576,31 +1107,37 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
         else:
             precursor = None
 
+        if product_information is not None:
+            product = self._prepare_product_information(**product_information)
+        else:
+            product = None
+
         default_array_length = len(time_array)
         if time_array is not None:
             time_array_tag = self._prepare_array(
-                time_array, encoding=encoding[TIME_ARRAY], compression=compression,
-                array_type={"name": TIME_ARRAY, "unit_name": time_unit})
+                time_array, encoding=encoding[TIME_ARRAY], compression=compression[TIME_ARRAY],
+                array_type={"name": TIME_ARRAY, "unit_name": time_unit}, entity_kind=CHROMATOGRAM)
             array_list.append(time_array_tag)
 
         if intensity_array is not None:
             intensity_array_tag = self._prepare_array(
-                intensity_array, encoding=encoding[INTENSITY_ARRAY], compression=compression,
-                array_type={"name": INTENSITY_ARRAY, "unit_name": intensity_unit})
+                intensity_array, encoding=encoding[INTENSITY_ARRAY], compression=compression[INTENSITY_ARRAY],
+                array_type={"name": INTENSITY_ARRAY, "unit_name": intensity_unit}, entity_kind=CHROMATOGRAM)
             array_list.append(intensity_array_tag)
 
         for array_type, array in other_arrays:
             array_tag = self._prepare_array(
-                array, encoding=encoding[array_type], compression=compression, array_type=array_type,
-                default_array_length=default_array_length)
+                array, encoding=encoding[array_type], compression=compression[array_type], array_type=array_type,
+                default_array_length=default_array_length, entity_kind=CHROMATOGRAM)
             array_list.append(array_tag)
         params.append(chromatogram_type)
         array_list_tag = self.BinaryDataArrayList(array_list)
+        self.compression_selector.end_entity()
         index = self.chromatogram_count
         self.chromatogram_count += 1
         chromatogram = self.Chromatogram(
             index=index, binary_data_list=array_list_tag,
-            precursor=precursor,
+            precursor=precursor, product=product,
             default_array_length=default_array_length,
             id=id, params=params)
         return chromatogram
@@ -609,24 +1146,277 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
                            chromatogram_type="selected ion current",
                            precursor_information=None, params=None,
                            compression=COMPRESSION_ZLIB, encoding=32, other_arrays=None,
-                           intensity_unit=DEFAULT_INTENSITY_UNIT, time_unit=DEFAULT_TIME_UNIT):
-        chromatogram = self.chromatogram(
+                           intensity_unit=DEFAULT_INTENSITY_UNIT, time_unit=DEFAULT_TIME_UNIT,
+                           product_information=None):
+        arguments = dict(
             time_array=time_array, intensity_array=intensity_array, id=id,
             chromatogram_type=chromatogram_type, precursor_information=precursor_information,
             params=params, compression=compression, encoding=encoding,
-            other_arrays=other_arrays, intensity_unit=intensity_unit, time_unit=time_unit)
-        chromatogram.write(self.writer)
+            other_arrays=other_arrays, intensity_unit=intensity_unit, time_unit=time_unit,
+            product_information=product_information)
+        self.state_machine.expects_state("chromatogram_list")
+        self._write_entity(self._build_chromatogram, arguments)
+
+    def write_chromatograms(self, time_array, intensity_array, transitions,
+                            chromatogram_type=SRM_CHROMATOGRAM, activation=DEFAULT_ACTIVATION,
+                            compression=COMPRESSION_ZLIB, encoding=32,
+                            intensity_unit=DEFAULT_INTENSITY_UNIT, time_unit=DEFAULT_TIME_UNIT):
+        """Write the chromatograms of many SRM/MRM transitions at once.
+
+        The chromatograms share one structure, so all but the first are written by filling
+        in a template rather than building their components, and a time axis shared by all
+        of them is only encoded once.
+
+        Parameters
+        ----------
+        time_array : :class:`numpy.ndarray` or list of arrays
+            The time axis shared by all of the chromatograms, or a separate time array
+            for each transition
+        intensity_array : :class:`numpy.ndarray` or list of arrays
+            A 2-D array with a row for each transition, or a separate intensity array
+            for each transition
+        transitions : :class:`numpy.ndarray` or iterable of :class:`dict`
+            A structured array or mappings with ``precursor_mz`` and ``product_mz``, and
+            optionally ``collision_energy`` and ``id``, for each transition. Without an
+            ``id``, one is made from the precursor and product m/z and the collision energy.
+        chromatogram_type : str
+            The type of chromatogram written
+        activation : str or None
+            The dissociation method written with the collision energy
+        compression, encoding, intensity_unit, time_unit : object
+            As for :meth:`write_chromatogram`
+
+        Returns
+        -------
+        int
+            The number of chromatograms written
+
+        Raises
+        ------
+        ValueError
+            If two of the transitions have the same id
+        """
+        self.state_machine.expects_state("chromatogram_list")
+        if isinstance(transitions, np.ndarray):
+            columns = {name: transitions[name].tolist() for name in transitions.dtype.names}
+            transitions = [dict(zip(columns, row)) for row in zip(*columns.values())]
+        else:
+            transitions = [dict(transition) for transition in transitions]
+        seen = set()
+        for transition in transitions:
+            transition['id'] = transition_id = self._transition_id(transition)
+            if transition_id in seen:
+                raise ValueError("More than one transition has the id %r" % (transition_id, ))
+            seen.add(transition_id)
+        if len(intensity_array) != len(transitions):
+            raise ValueError("Expected %d intensity arrays for %d transitions, got %d" % (
+                len(transitions), len(transitions), len(intensity_array)))
+        shared_time = len(time_array) == 0 or np.isscalar(time_array[0])
+        if shared_time:
+            time_array = np.asarray(time_array)
+        elif len(time_array) != len(transitions):
+            raise ValueError("Expected %d time arrays for %d transitions, got %d" % (
+                len(transitions), len(transitions), len(time_array)))
+        encoding = ArrayParameterTable.resolve(encoding, np.float32)
+        compression = ArrayParameterTable.resolve(compression, COMPRESSION_ZLIB)
+        if isinstance(intensity_array, np.ndarray) and intensity_array.ndim == 2:
+            # Convert the whole matrix at once, rather than each row as it is encoded
+            intensity_encoding = encoding[INTENSITY_ARRAY]
+            if isinstance(intensity_encoding, numbers.Number):
+                intensity_encoding = int(intensity_encoding)
+            dtype = encoding_map.get(intensity_encoding)
+            if dtype is not None and compression[INTENSITY_ARRAY] not in numpress_codecs:
+                intensity_array = np.ascontiguousarray(intensity_array, dtype=dtype)
+        build = functools.partial(
+            self._build_transition_chromatogram, SharedArray(time_array) if shared_time else None)
+        for i, transition in enumerate(transitions):
+            self._write_entity(build, self._transition_arguments(
+                time_array if shared_time else time_array[i], intensity_array[i], transition,
+                chromatogram_type=chromatogram_type, activation=activation,
+                compression=compression, encoding=encoding,
+                intensity_unit=intensity_unit, time_unit=time_unit))
+        return len(transitions)
+
+    def _transition_id(self, transition):
+        transition_id = transition.get('id')
+        if transition_id is None:
+            transition_id = "SRM SIC Q1=%0.4f Q3=%0.4f" % (transition['precursor_mz'], transition['product_mz'])
+            if transition.get('collision_energy') is not None:
+                transition_id += " CE=%0.2f" % (transition['collision_energy'], )
+        elif isinstance(transition_id, bytes):
+            transition_id = transition_id.decode('utf8')
+        return transition_id
+
+    def _transition_arguments(self, time_array, intensity_array, transition, activation, **kwargs):
+        precursor_mz = transition['precursor_mz']
+        product_mz = transition['product_mz']
+        transition_id = transition['id']
+        activation_params = []
+        if activation is not None:
+            activation_params.append(activation)
+        if transition.get('collision_energy') is not None:
+            activation_params.append({
+                "name": "collision energy", "value": transition['collision_energy'],
+                "unit_name": "electronvolt"})
+        precursor_information = {
+            "isolation_window_args": {"target": precursor_mz},
+            "activation": activation_params}
+        product_information = {"isolation_window_args": {"target": product_mz}}
+        return dict(
+            time_array=time_array, intensity_array=intensity_array, id=transition_id,
+            precursor_information=precursor_information, product_information=product_information,
+            params=None, other_arrays=None, **kwargs)
+
+    def _write_derived_chromatograms(self):
+        # Every spectrum has been built once the spectrum list has closed
+        self._derived_chromatograms_written = True
+        for derived in self.derived_chromatograms:
+            for arguments in derived.chromatograms():
+                self.write_chromatogram(**arguments)
+
+    def _build_chromatogram(self, arguments):
+        return self._chromatogram(**arguments)
+
+    def _build_transition_chromatogram(self, shared_array, arguments):
+        chromatogram = None
+        if self._chromatogram_templates is not None:
+            try:
+                shape = ChromatogramShape(dict(arguments, index=self.chromatogram_count))
+            except UnsupportedShape:
+                shape = None
+            if shape is not None:
+                chromatogram = self._templated_entity(
+                    shape, arguments, self._chromatogram_templates, self._chromatogram,
+                    'chromatogram_count', 'Chromatogram', shared_array)
+        if chromatogram is None:
+            chromatogram = self._chromatogram(**arguments)
+        return chromatogram
+
+    def _write_entity(self, build, arguments):
+        self._write_component(build(arguments))
+
+    def _entity_indent_level(self):
+        # The indentation spectra and chromatograms are written at
+        return self.writer.indent_level
+
+    def _write_component(self, component):
+        if self._encoding_executor is None:
+            component.write(self.writer)
+            return
+        self._write_queue.append(component)
+        while len(self._write_queue) > self.encoding_lookahead:
+            self._write_queue.popleft().write(self.writer)
+
+    def _flush_write_queue(self):
+        while self._write_queue:
+            self._write_queue.popleft().write(self.writer)
+
+    def compression_report(self):
+        """Summarize the compression methods measured and chosen for each
+        array type written with ``compression='auto'``.
+
+        Returns
+        -------
+        list of :class:`~.CodecMeasurement`
+        """
+        return self.compression_selector.report()
+
+    def end(self, exc_type=None, exc_value=None, traceback=None):
+        if exc_type is None and not self._derived_chromatograms_written and any(
+                len(derived.times) for derived in self.derived_chromatograms):
+            warnings.warn(
+                "Derived chromatograms were collected but not written, as no <chromatogramList> "
+                "was opened", stacklevel=2)
+        if exc_type is None and self.compression_selector.statistics:
+            logger.info("Compression methods chosen for compression='auto':\n%s",
+                        self.compression_selector.format_report())
+        try:
+            if exc_type is None:
+                self._flush_write_queue()
+            super(PlainMzMLWriter, self).end(exc_type, exc_value, traceback)
+        finally:
+            if self._encoding_executor is not None:
+                self._encoding_executor.shutdown()
+        if exc_type is None and self.metadata_index is not None:
+            self.metadata_index.complete(self._spectrum_offsets())
+
+    def _spectrum_offsets(self):
+        # The byte offset of each spectrum by id, if they were recorded
+        return None
+
+    def _encode_array_data(self, array, dtype, compression, compression_level=None,
+                           significant_bits=DEFAULT_SIGNIFICANT_BITS):
+        if (self.streaming_threshold is not None and compression in streamable_compressions and
+                np.size(array) * np.dtype(dtype).itemsize > self.streaming_threshold):
+            # Read the array in chunks as it is written, without converting it up front
+            encoded_binary = StreamingArrayEncoder(
+                array, compression=compression, dtype=dtype,
+                compression_level=compression_level, significant_bits=significant_bits)
+            array = encoded_binary.array
+            encoded_length = None
+        else:
+            # Avoid copying the caller's array if it is already of the right type
+            source = array
+            array = np.asarray(array, dtype=dtype)
+            encoded_binary = cache_key = None
+            if self.encoding_cache is not None:
+                cache_key = self.encoding_cache.make_key(
+                    array, dtype, compression, compression_level, significant_bits)
+                encoded_binary = self.encoding_cache.get(cache_key)
+            if encoded_binary is None:
+                if self._encoding_executor is not None:
+                    # The caller may reuse their array before encoding finishes, so encode
+                    # from a private copy, and fill in the encoded length when it is written.
+                    # np.asarray may return a new view of the caller's memory, such as for
+                    # ndarray subclasses and memory maps, so test for sharing, not identity
+                    if np.may_share_memory(array, source):
+                        array = np.array(array, dtype=dtype)
+                    encoded_binary = self._encoding_executor.submit(
+                        encode_array, array, compression=compression, dtype=dtype,
+                        compression_level=compression_level, significant_bits=significant_bits)
+                else:
+                    encoded_binary = encode_array(
+                        array, compression=compression, dtype=dtype,
+                        compression_level=compression_level, significant_bits=significant_bits)
+                if cache_key is not None:
+                    self.encoding_cache.put(cache_key, encoded_binary)
+            if hasattr(encoded_binary, 'result'):
+                encoded_length = None
+            else:
+                encoded_length = len(encoded_binary)
+        return array, encoded_binary, encoded_length
 
     def _prepare_array(self, array, encoding=32, compression=COMPRESSION_ZLIB,
-                       array_type=None, default_array_length=None):
+                       array_type=None, default_array_length=None, entity_kind=SPECTRUM):
         if isinstance(encoding, numbers.Number):
             _encoding = int(encoding)
         else:
             _encoding = encoding
-        dtype = encoding_map[_encoding]
-        array = np.array(array, dtype=dtype)
-        encoded_binary = encode_array(
-            array, compression=compression, dtype=dtype)
+        is_template_slot = isinstance(array, ArraySlot)
+        if is_template_slot and (_encoding in auto_encodings or compression == COMPRESSION_AUTO):
+            raise UnsupportedShape("Array encodings chosen per spectrum cannot be templated")
+        if _encoding in auto_encodings:
+            dtype = narrowest_lossless_dtype(array, auto_encodings[_encoding])
+        else:
+            dtype = encoding_map[_encoding]
+        if isinstance(array_type, Mapping):
+            array_type_ = array_type['name']
+        else:
+            array_type_ = array_type
+        compression_level = None
+        if compression == COMPRESSION_AUTO:
+            compression, compression_level = self.compression_selector.select(
+                array_type_, array, dtype, entity_kind)
+        if compression in numpress_codecs:
+            dtype = NUMPRESS_DTYPE
+        significant_bits = self.significant_bits[array_type_]
+        if is_template_slot:
+            # Compiling a spectrum template, so record how the array would be encoded
+            array.encoding = (dtype, compression, significant_bits)
+            encoded_binary, encoded_length = array.binary, array.encoded_length
+        else:
+            array, encoded_binary, encoded_length = self._encode_array_data(
+                array, dtype, compression, compression_level, significant_bits)
         binary = self.Binary(encoded_binary)
         if default_array_length is not None and len(array) != default_array_length:
             override_length = True
@@ -635,15 +1425,12 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
         params = []
         if array_type is not None:
             params.append(array_type)
-            if isinstance(array_type, Mapping):
-                array_type_ = array_type['name']
-            else:
-                array_type_ = array_type
             if array_type_ not in ARRAY_TYPES:
                 params.append(NON_STANDARD_ARRAY)
         params.append(compression_map[compression])
         params.append(dtype_to_encoding[dtype])
-        encoded_length = len(encoded_binary)
+        if compression in truncation_codecs:
+            params.append({"name": TRUNCATION_PARAM, "value": significant_bits})
         return self.BinaryDataArray(
             binary, encoded_length,
             array_length=(len(array) if override_length else None),
@@ -663,8 +1450,8 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
                 for p in ensure_iterable(precursors)])
         return precursors
 
-    def _prepare_precursor_information(self, mz, intensity, charge, spectrum_reference=None, activation=None,
-                                       isolation_window_args=None, params=None,
+    def _prepare_precursor_information(self, mz=None, intensity=None, charge=None, spectrum_reference=None,
+                                       activation=None, isolation_window_args=None, params=None,
                                        intensity_unit=DEFAULT_INTENSITY_UNIT, scan_id=None):
         if scan_id is not None:
             spectrum_reference = scan_id
@@ -672,8 +1459,12 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
             params = []
         if activation:
             activation = self.Activation(activation)
-        ion = self.SelectedIon(mz, intensity, charge, params=params)
-        ion_list = self.SelectedIonList([ion])
+        if mz is None and intensity is None and charge is None and not params:
+            # The precursor of a transition is only described by its isolation window
+            ion_list = None
+        else:
+            ion = self.SelectedIon(mz, intensity, charge, params=params)
+            ion_list = self.SelectedIonList([ion])
         if isolation_window_args:
             isolation_window_tag = self.IsolationWindow(**isolation_window_args)
         else:
@@ -686,13 +1477,56 @@ class PlainMzMLWriter(ComponentDispatcher, XMLDocumentWriter):
         return precursor
 
 
+    def _prepare_product_information(self, isolation_window_args=None):
+        if isolation_window_args:
+            isolation_window_tag = self.IsolationWindow(**isolation_window_args)
+        else:
+            isolation_window_tag = None
+        return self.Product(isolation_window=isolation_window_tag)
+
+
 class IndexedMzMLWriter(PlainMzMLWriter):
+    """A :class:`PlainMzMLWriter` which writes an ``<indexedmzML>`` document, with the
+    offset of each spectrum and chromatogram and the checksum of the document.
+
+    Output passes through an :class:`~.IndexingStream`, which collects it into blocks of
+    ``write_buffer_size`` bytes before writing it to ``outfile``, so the file sees a few
+    large writes instead of one for each fragment of markup. With ``threaded_checksum``,
+    the checksum of each block is computed on a helper thread.
+
+    Attributes
+    ----------
+    index_builder : :class:`~.IndexingStream`
+        The stream the document is written through
+    offset_index : str, file-like or None
+        Where to write an :class:`~.OffsetIndex` of the document once it is complete, which
+        can be memory-mapped to look up offsets without parsing the ``<indexList>``. If
+        ``offset_index=True`` is passed, the index is written beside the output file, with
+        :const:`~.SIDECAR_SUFFIX` appended to its name.
+    """
+
     def __init__(self, outfile, close=False, vocabularies=None, missing_reference_is_error=False,
-                 vocabulary_resolver=None, id=None, accession=None, **kwargs):
-        outfile = IndexingStream(outfile)
+                 vocabulary_resolver=None, id=None, accession=None, encoding_workers=0,
+                 encoding_lookahead=None, compression_policy=None,
+                 significant_bits=DEFAULT_SIGNIFICANT_BITS, streaming_threshold=None,
+                 encoding_cache=None, spectrum_templates=False, derived_chromatograms=None,
+                 write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE, threaded_checksum=False,
+                 offset_index=None, **kwargs):
+        outfile = IndexingStream(outfile, write_buffer_size, threaded_checksum)
+        if offset_index is True:
+            try:
+                offset_index = outfile.name + SIDECAR_SUFFIX
+            except (AttributeError, TypeError):
+                raise ValueError(
+                    "offset_index=True requires an output file with a name, not %r" % (outfile.stream, ))
+        self.offset_index = offset_index or None
         super(IndexedMzMLWriter, self).__init__(
             outfile, close, vocabularies, missing_reference_is_error, vocabulary_resolver,
-            id, accession, **kwargs)
+            id, accession, encoding_workers=encoding_workers, encoding_lookahead=encoding_lookahead,
+            compression_policy=compression_policy, significant_bits=significant_bits,
+            streaming_threshold=streaming_threshold, encoding_cache=encoding_cache,
+            spectrum_templates=spectrum_templates,
+            derived_chromatograms=derived_chromatograms, **kwargs)
         self.index_builder = outfile
 
     def toplevel_tag(self):
@@ -700,9 +1534,170 @@ class IndexedMzMLWriter(PlainMzMLWriter):
             self.writer, self.context, id=self.id, accession=self.accession,
             indexer=self.index_builder)
 
+    def build_offset_index(self):
+        """Collect the offsets of the spectra and chromatograms written so far
+
+        Returns
+        -------
+        :class:`~.OffsetIndex`
+        """
+        return OffsetIndex.from_indexing_stream(self.index_builder, self.index_builder.file_checksum)
+
+    def _spectrum_offsets(self):
+        return self.index_builder.indices.get('spectrum').index
+
+    def end(self, exc_type=None, exc_value=None, traceback=None):
+        super(IndexedMzMLWriter, self).end(exc_type, exc_value, traceback)
+        if exc_type is None and self.offset_index is not None:
+            self.build_offset_index().write(self.offset_index)
+
     def format(self, *args, **kwargs):
         return
 
 
+_STOP_PIPELINE = object()
+
+
+class PipelinedMzMLWriter(IndexedMzMLWriter):
+    """An :class:`IndexedMzMLWriter` which builds and writes spectra and chromatograms on
+    background threads, so that the thread calling :meth:`write_spectrum` and
+    :meth:`write_chromatogram` does not wait on compression or on the output file.
+
+    Each call only places its arguments in a queue of at most ``queue_size`` entities. An
+    encoding thread takes them from this queue in order, resolves their parameters and encodes
+    their binary data arrays, and passes the built components through a second queue of the
+    same size to an output thread, which writes them to the :class:`~.IndexingStream`. When
+    either stage falls behind and its queue fills, the caller waits for room, which bounds
+    the memory the pipeline uses. The output is identical to that of :class:`IndexedMzMLWriter`.
+
+    The pipeline is drained when the enclosing list section closes, so everything outside of
+    the spectrum and chromatogram lists is written on the calling thread as usual. An exception
+    raised on either background thread stops the pipeline, and is raised again by the next call
+    to :meth:`write_spectrum` or :meth:`write_chromatogram`, or when the list section closes.
+
+    Attributes
+    ----------
+    queue_size : int
+        The maximum number of spectra or chromatograms waiting for each stage
+    copy_arrays : bool
+        Whether arrays are copied when they are queued, so that the caller may reuse them
+        immediately. Memory-mapped arrays are never copied. If :const:`False`, arrays must
+        not be modified until they are written.
+    """
+
+    def __init__(self, outfile, close=False, queue_size=64, copy_arrays=True, **kwargs):
+        super(PipelinedMzMLWriter, self).__init__(outfile, close, **kwargs)
+        self.queue_size = queue_size
+        self.copy_arrays = copy_arrays
+        self._encode_queue = None
+        self._output_queue = None
+        self._pipeline_threads = []
+        self._pipeline_error = None
+        self._pipeline_cancelled = False
+        self._pipeline_indent_level = None
+
+    def _start_pipeline(self):
+        self._encode_queue = queue.Queue(self.queue_size)
+        self._output_queue = queue.Queue(self.queue_size)
+        self._pipeline_threads = [
+            threading.Thread(target=self._encode_stage, name="psims-encode"),
+            threading.Thread(target=self._output_stage, name="psims-output"),
+        ]
+        for thread in self._pipeline_threads:
+            thread.daemon = True
+            thread.start()
+
+    def _stop_pipeline(self):
+        if self._encode_queue is None:
+            return
+        self._encode_queue.put(_STOP_PIPELINE)
+        for thread in self._pipeline_threads:
+            thread.join()
+        self._encode_queue = self._output_queue = None
+        self._pipeline_threads = []
+
+    def _pipeline_running(self):
+        return self._pipeline_error is None and not self._pipeline_cancelled
+
+    def _encode_stage(self):
+        while True:
+            item = self._encode_queue.get()
+            try:
+                if item is _STOP_PIPELINE:
+                    self._output_queue.put(item)
+                    return
+                if self._pipeline_running():
+                    build, arguments = item
+                    try:
+                        self._output_queue.put(build(arguments))
+                    except Exception:
+                        self._pipeline_error = sys.exc_info()
+            finally:
+                # Only counted once the component is in the output queue, so that
+                # joining the two queues in order drains the whole pipeline
+                self._encode_queue.task_done()
+
+    def _output_stage(self):
+        while True:
+            component = self._output_queue.get()
+            try:
+                if component is _STOP_PIPELINE:
+                    return
+                if self._pipeline_running():
+                    try:
+                        component.write(self.writer)
+                    except Exception:
+                        self._pipeline_error = sys.exc_info()
+            finally:
+                self._output_queue.task_done()
+
+    def _raise_pipeline_error(self):
+        if self._pipeline_error is not None:
+            six.reraise(*self._pipeline_error)
+
+    def _copy_arrays(self, arguments):
+        arguments = dict(arguments)
+        for key, value in arguments.items():
+            if key.endswith("_array") and value is not None and not isinstance(value, np.memmap):
+                arguments[key] = np.array(value)
+        if arguments.get("other_arrays"):
+            arguments['other_arrays'] = [
+                (array_type, array if isinstance(array, np.memmap) else np.array(array))
+                for array_type, array in arguments['other_arrays']]
+        return arguments
+
+    def _write_entity(self, build, arguments):
+        self._raise_pipeline_error()
+        if self._encode_queue is None:
+            self._start_pipeline()
+        if self._pipeline_indent_level is None:
+            # The pipeline is empty, so the writer is positioned where entities are written
+            self._pipeline_indent_level = self.writer.indent_level
+        if self.copy_arrays:
+            arguments = self._copy_arrays(arguments)
+        self._encode_queue.put((build, arguments))
+
+    def _entity_indent_level(self):
+        if self._pipeline_indent_level is None:
+            return self.writer.indent_level
+        return self._pipeline_indent_level
+
+    def _flush_write_queue(self):
+        if self._encode_queue is not None:
+            self._encode_queue.join()
+            self._output_queue.join()
+        self._pipeline_indent_level = None
+        super(PipelinedMzMLWriter, self)._flush_write_queue()
+        self._raise_pipeline_error()
+
+    def end(self, exc_type=None, exc_value=None, traceback=None):
+        if exc_type is not None:
+            self._pipeline_cancelled = True
+        try:
+            super(PipelinedMzMLWriter, self).end(exc_type, exc_value, traceback)
+        finally:
+            self._stop_pipeline()
+
+
 MzMLWriter = IndexedMzMLWriter
 # MzMLWriter = PlainMzMLWriter
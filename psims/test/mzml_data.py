@@ -0,0 +1,196 @@
+from io import BytesIO
+
+import numpy as np
+
+from psims.mzml import MzMLWriter
+
+
+mz_array = [
+    255.22935009, 283.26141863, 284.26105318, 301.23572871,
+    304.908247, 329.26327093, 755.25267878, 910.6317435,
+    960.96747136, 971.31396162, 972.649568, 991.66036894,
+    1017.87649113, 1060.29899182, 1112.67519902, 1113.11545762,
+    1113.86200673, 1114.42377982, 1152.34596544, 1177.73119994,
+    1188.36935517, 1214.70161813, 1265.9795606, 1266.16111855,
+    1293.14606767, 1294.68263447, 1367.01605133, 1565.95282753,
+    1700.23290184, 969.65408783, 1110.37794027, 1170.89893785,
+    1175.34669421, 1183.40737076, 861.61958381, 1292.94207114,
+    1295.4429046, 876.96085225, 1335.39755355, 1357.92354342,
+    1365.96972386, 925.64504217, 958.65480011, 1438.49014079,
+    1452.48402739, 967.98859816, 986.63557879, 1480.46326372,
+    1001.97032019, 1007.67089513, 1525.51932956, 1016.67747057,
+    1080.3583722, 1090.03199733, 1133.01762219, 1186.72735997,
+    960.79647487, 1274.44354121, 1918.2693496, 961.85503396
+]
+
+intensity_array = [
+    1.90348869e+03, 1.92160377e+03, 3.26032338e+02,
+    1.05527732e+03, 9.50991606e+02, 1.52403574e+03,
+    8.63154395e+02, 4.11169655e+02, 2.33462730e+03,
+    2.62603673e+02, 2.73669694e+02, 8.62436899e+02,
+    4.22323174e+02, 2.54371429e+02, 1.02364420e+03,
+    5.44244205e+02, 4.93101348e+02, 2.64984906e+02,
+    9.36500725e+02, 4.79373626e+02, 9.26742857e+02,
+    4.52209221e+02, 3.02178809e+03, 4.94385979e+02,
+    1.67240655e+03, 9.41320838e+02, 7.25744090e+02,
+    1.27260012e+03, 8.24236545e+02, 4.93518583e+02,
+    7.33281806e+04, 9.60817582e+02, 2.64893187e+03,
+    7.95614286e+03, 4.94586514e+03, 2.35346153e+04,
+    1.50301526e+03, 5.36435167e+03, 3.78042332e+02,
+    1.09926345e+03, 3.10133857e+03, 7.41566590e+02,
+    2.77340229e+05, 1.00796887e+05, 4.69519356e+03,
+    1.55343822e+04, 5.45621612e+03, 5.53939031e+03,
+    9.49732490e+03, 8.05000735e+03, 2.65457068e+03,
+    1.36766228e+04, 2.69348480e+03, 6.71802368e+03,
+    4.46828571e+02, 1.39065143e+04, 4.29267365e+03,
+    2.73782365e+03, 1.35373492e+03, 1.17601397e+03
+]
+
+charge_array = [
+    -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1,
+    -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -2, -2, -2, -2, -2,
+    -3, -2, -2, -3, -2, -2, -2, -3, -3, -2, -2, -3, -3, -2, -3, -3, -2,
+    -3, -3, -3, -3, -3, -5, -4, -3, -6
+]
+
+
+sample = {
+    "name": "shotgun_explodeomics_precipitate_123",
+    "params": [
+        "certified organic",
+        {"acquired in": "1812"}
+    ]
+}
+
+encodings = {
+    "m/z array": np.float64,
+    "intensity array": np.float64,
+    "charge array": np.float64
+}
+
+
+def ms1_spectra(n=10):
+    """The :meth:`~.MzMLWriter.write_spectrum` arguments of ``n`` MS1 spectra with
+    shifted m/z arrays and an extra signal to noise array
+    """
+    return [dict(mz_array=np.array(mz_array) + i + 1, intensity_array=intensity_array,
+                 charge_array=charge_array, id='scanId=%d' % i, params=[{"name": "ms level", "value": 1}],
+                 encoding=encodings, other_arrays=[("signal to noise array", intensity_array)])
+            for i in range(n)]
+
+
+def ms2_spectra(n=12):
+    """The :meth:`~.MzMLWriter.write_spectrum` arguments of an MS1 spectrum followed by ``n``
+    MS2 spectra of varying length, centroiding and charge, with precursor information
+    """
+    spectra = [dict(
+        mz_array=mz_array, intensity_array=intensity_array, id='scan=0', scan_start_time=0.5,
+        params=[{"name": "ms level", "value": 1}, {"name": "total ion current", "value": 1e6}],
+        scan_window_list=[(100.0, 2000.0)])]
+    for i in range(1, n + 1):
+        spectra.append(dict(
+            mz_array=np.array(mz_array[:i * 3]) + i, intensity_array=intensity_array[:i * 3], id='scan=%d' % i,
+            scan_start_time=0.5 + i * 0.011, centroided=i % 3 != 0,
+            params=[{"name": "ms level", "value": 2}, {"name": "total ion current", "value": i * 1e3},
+                    ("filter string", 'FTMS + p NSI d "Full ms2 %d.0@hcd28.00" <&>\t' % i)],
+            encoding={"m/z array": 64},
+            other_arrays=[("signal to noise array", intensity_array[:i * 3 + (i % 2)])],
+            precursor_information={
+                "mz": 500.0 + i / 7., "intensity": i * 100., "charge": i % 4 or None,
+                "scan_id": 'scan=0', "activation": ["beam-type collisional dissociation",
+                                                    {"collision energy": 28 + i}],
+                "isolation_window_args": {"target": 500.0 + i / 7., "lower": 0.7, "upper": 0.7}}))
+    return spectra
+
+
+def scan_arguments(i):
+    """The :meth:`~.MzMLWriter.write_spectrum` arguments of a spectrum whose parameters
+    mostly recur across ``i``
+    """
+    return dict(
+        mz_array=mz_array, intensity_array=intensity_array, id='scan=%d' % i,
+        polarity='negative scan', scan_start_time=0.5 + i,
+        params=[{"name": "ms level", "value": 1 + (i % 3 == 2)}, "isolated ion",
+                {"name": "base peak m/z", "value": 255.22935009}],
+        scan_params=[{"name": "filter string", "value": "FTMS - p NSI Full ms"},
+                     {"name": "preset scan configuration", "value": 1}])
+
+
+def grouped_spectra(n=12):
+    """The :func:`scan_arguments` of ``n`` spectra, the eighth of which does not carry
+    all of the recurring parameters
+    """
+    spectra = [scan_arguments(i) for i in range(n)]
+    spectra[7]['params'] = spectra[7]['params'][:1]
+    return spectra
+
+
+tic = dict(time_array=np.arange(10), intensity_array=np.arange(10), id='TIC')
+
+
+def write_header(writer, groups=None, sample_spectra=None):
+    """Write every section between the ``<cvList>`` and the ``<run>``, in order"""
+    writer.file_description(["MSn spectrum"])
+    writer.reference_param_group_list(groups or [], sample_spectra=sample_spectra)
+    writer.software_list([writer.Software(version="0.0.0", id='psims', params=['python-psims'])])
+    writer.instrument_configuration_list([
+        writer.InstrumentConfiguration(id=1, component_list=writer.ComponentList([
+            writer.Source(params=['electrospray ionization'], order=1),
+            writer.Analyzer(params=['quadrupole'], order=2),
+            writer.Detector(params=['inductive detector'], order=3)
+        ]))
+    ])
+    writer.data_processing_list([
+        writer.DataProcessing(processing_methods=[
+            dict(order=0, software_reference='psims', params=['Conversion to mzML']),
+        ], id=1)
+    ])
+
+
+def write_mzml(spectra=(), chromatograms=(), stream=None, writer_type=MzMLWriter, spectrum_count=None,
+               header=None, **kwargs):
+    """Write a document with a ``writer_type`` built with ``kwargs``, and return its bytes
+
+    Parameters
+    ----------
+    spectra : list of dict or callable
+        The :meth:`~.MzMLWriter.write_spectrum` arguments of each spectrum, or a function
+        which writes the spectra given the writer
+    chromatograms : list of dict
+        The :meth:`~.MzMLWriter.write_chromatogram` arguments of each chromatogram
+    stream : file-like, optional
+        The stream to write to, a new :class:`BytesIO` if not given
+    writer_type : type
+    spectrum_count : int, optional
+        The count of the ``<spectrumList>``, the number of ``spectra`` if not given,
+        or deferred if they cannot be counted
+    header : callable, optional
+        Called with the writer after the ``<cvList>`` is written, to write the other
+        sections before the ``<run>`` or configure the writer
+    """
+    if stream is None:
+        stream = BytesIO()
+    if spectrum_count is None and not callable(spectra):
+        spectrum_count = len(spectra)
+    with writer_type(stream, close=False, **kwargs) as f:
+        f.controlled_vocabularies()
+        if header is not None:
+            header(f)
+        with f.run(id='test'):
+            with f.spectrum_list(count=spectrum_count):
+                if callable(spectra):
+                    spectra(f)
+                else:
+                    for spectrum in spectra:
+                        f.write_spectrum(**spectrum)
+            if chromatograms:
+                with f.chromatogram_list(count=len(chromatograms)):
+                    for chromatogram in chromatograms:
+                        f.write_chromatogram(**chromatogram)
+    return stream.getvalue()
+
+
+class NamedBytesIO(BytesIO):
+    def __init__(self, name):
+        BytesIO.__init__(self)
+        self.name = name
@@ -0,0 +1,127 @@
+import asyncio
+import re
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from psims.mzml import MzMLWriter
+from psims.async_writer import AsyncSection
+from psims.mzml.async_writer import AsyncMzMLWriter
+from psims.mzid import MzIdentMLWriter
+from psims.mzid.async_writer import AsyncMzIdentMLWriter
+from psims.test import mzid_data
+
+from .mzml_data import mz_array, intensity_array
+
+
+class DrainingStream(object):
+    def __init__(self):
+        self.buffer = BytesIO()
+        self.drains = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    async def drain(self):
+        self.drains += 1
+        await asyncio.sleep(0)
+
+    def close(self):
+        self.closed = True
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _write_mzml_sync(buffer):
+    with MzMLWriter(buffer, close=False) as f:
+        f.controlled_vocabularies()
+        f.software_list([{"id": "psims-writer", "version": "0.1.2", "params": ["python-psims"]}])
+        with f.run(id='test'):
+            with f.spectrum_list(count=5):
+                for i in range(5):
+                    f.write_spectrum(np.array(mz_array) + i, intensity_array, id='scan=%d' % i,
+                                     params=[{"ms level": 1}])
+            with f.chromatogram_list(count=1):
+                f.write_chromatogram(np.arange(10), np.arange(10), id='TIC')
+    return buffer.getvalue()
+
+
+async def _write_mzml_async(stream, **kwargs):
+    async with AsyncMzMLWriter(stream, close=True, **kwargs) as f:
+        await f.controlled_vocabularies()
+        await f.software_list([{"id": "psims-writer", "version": "0.1.2", "params": ["python-psims"]}])
+        async with f.run(id='test'):
+            async with f.spectrum_list(count=5):
+                for i in range(5):
+                    await f.write_spectrum(np.array(mz_array) + i, intensity_array, id='scan=%d' % i,
+                                           params=[{"ms level": 1}])
+            async with f.chromatogram_list(count=1):
+                await f.write_chromatogram(np.arange(10), np.arange(10), id='TIC')
+    return stream
+
+
+def test_async_mzml_writer():
+    expected = _write_mzml_sync(BytesIO())
+    stream = _run(_write_mzml_async(DrainingStream()))
+    assert stream.buffer.getvalue() == expected
+    assert stream.drains > 5
+    assert stream.closed
+    stream = _run(_write_mzml_async(DrainingStream(), encoding_workers=2))
+    assert stream.buffer.getvalue() == expected
+
+
+def test_async_state_machine():
+    async def write_out_of_order():
+        async with AsyncMzMLWriter(DrainingStream()) as f:
+            await f.controlled_vocabularies()
+            async with f.run(id='test'):
+                await f.write_chromatogram(np.arange(10), np.arange(10), id='TIC')
+
+    with pytest.warns(Warning):
+        _run(write_out_of_order())
+
+    def fail():
+        raise ValueError("cannot open section")
+
+    async def write_failed_section():
+        async with AsyncMzMLWriter(DrainingStream()) as f:
+            section = AsyncSection(f, fail, (), {})
+            with pytest.raises(ValueError):
+                await section.__aenter__()
+            assert section.section is None
+            await section.__aexit__(ValueError, None, None)
+
+    _run(write_failed_section())
+
+
+def test_async_mzid_writer():
+    buffer = BytesIO()
+    with MzIdentMLWriter(buffer, close=False) as f:
+        f.controlled_vocabularies()
+        f.provenance(software=mzid_data.software)
+        with f.sequence_collection():
+            f.write_db_sequence(**mzid_data.proteins[0])
+            f.write_peptide(**mzid_data.peptides[0])
+    expected = buffer.getvalue()
+
+    async def write():
+        stream = DrainingStream()
+        async with AsyncMzIdentMLWriter(stream) as f:
+            await f.controlled_vocabularies()
+            await f.provenance(software=mzid_data.software)
+            async with f.sequence_collection():
+                await f.write_db_sequence(**mzid_data.proteins[0])
+                await f.write_peptide(**mzid_data.peptides[0])
+        return stream.buffer.getvalue()
+
+    creation_date = re.compile(br'creationDate="[^"]+"')
+    assert creation_date.sub(b'', _run(write())) == creation_date.sub(b'', expected)
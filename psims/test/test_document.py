@@ -1,3 +1,5 @@
+import copy
+
 import pytest
 
 from io import BytesIO
@@ -47,3 +49,52 @@ def test_xmlwriter(output_path):
     f.close()
     with open(output_path, 'rb') as fh:
         print(fh.readline())
+
+
+def test_param_resolution_cache():
+    f = writer.MzMLWriter(BytesIO())
+    ctx = f.context
+    cache = ctx.param_cache
+    first = ctx.param("scan start time", 1.5, unit_name="minute")
+    second = ctx.param("scan start time", 2.5, unit_name="minute")
+    assert cache.misses == 1 and cache.hits == 1
+    assert second is not first
+    assert second.value == 2.5 and first.value == 1.5
+    assert second.attrs['unitAccession'] == first.attrs['unitAccession'] == 'UO:0000031'
+    assert list(second.attrs) == list(first.attrs)
+
+    user = ctx.param("not a real term", 3)
+    assert isinstance(user, document.UserParam)
+    assert isinstance(ctx.param("not a real term", 4), document.UserParam)
+    assert cache.hits == 2
+
+    # Replacing a vocabulary discards the prototypes resolved against it
+    ctx.vocabularies[0] = copy.copy(ctx.vocabularies[0])
+    ctx.param("scan start time", 3.5, unit_name="minute")
+    assert cache.misses == 3 and len(cache) == 1
+
+    ctx.param_cache = None
+    uncached = ctx.param("scan start time", 2.5, unit_name="minute")
+    assert uncached.attrs == second.attrs
+    f.close()
+
+
+def test_rendered_param_cache_bounds():
+    cache = document.RenderedParamCache(max_size=4, max_bytes=10)
+    for i in range(3):
+        cache.put(i, b'x' * 4)
+    # Evicted by size in bytes before reaching max_size
+    assert len(cache) == 2 and cache.nbytes == 8
+    assert cache.get(0) is None and cache.get(2) == b'xxxx'
+    cache.put(2, b'xx')
+    assert cache.nbytes == 6
+
+    vocabularies = [object()]
+    cache.synchronize(vocabularies)
+    assert len(cache) == 0 and cache.nbytes == 0
+    cache.put(0, b'x')
+    cache.synchronize(list(vocabularies))
+    assert len(cache) == 1
+    cache.synchronize([object()])
+    assert len(cache) == 0
+    assert cache.hits == 1 and cache.misses == 1
@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+from psims.mzml import PipelinedMzMLWriter, SpectrumMetadataIndex
+from psims.test.utils import output_path
+from psims.test.mzml_data import ms2_spectra, write_mzml, NamedBytesIO
+
+
+def test_metadata_index(output_path):
+    data = write_mzml(ms2_spectra(), stream=NamedBytesIO(output_path), metadata_index=True)
+    index = SpectrumMetadataIndex.load(output_path + '.meta.npz')
+    os.remove(output_path + '.meta.npz')
+    assert len(index) == 13
+    ms2 = index.query(ms_level=2)
+    assert ms2['id'].tolist() == ['scan=%d' % i for i in range(1, 13)]
+    assert data[ms2['offset'][3]:].startswith(b'<spectrum index="4"')
+    assert np.isnan(index.query(ms_level=1)['precursor_mz']).all()
+
+    rows = index.query(ms_level=2, precursor_mz=(500.5, 501.0), scan_start_time=(0.5, 0.56))
+    assert rows['id'].tolist() == ['scan=4', 'scan=5']
+    assert rows['charge'].tolist() == [0, 1]
+    assert np.allclose(rows['isolation_window_lower'], rows['precursor_mz'] - 0.7)
+    assert index.query(isolated_mz=501.9)['id'].tolist() == ['scan=9', 'scan=10', 'scan=11', 'scan=12']
+    assert len(index.query(scan_start_time=(None, 0.5))) == 1
+
+    metadata = SpectrumMetadataIndex()
+    write_mzml(ms2_spectra(), writer_type=PipelinedMzMLWriter, spectrum_templates=True,
+               metadata_index=metadata)
+    assert metadata.query(charge=2)['id'].tolist() == ['scan=2', 'scan=6', 'scan=10']
+
+    # Start times given in seconds are stored in minutes
+    metadata = SpectrumMetadataIndex()
+    metadata.add({"id": "scan=1", "scan_start_time": {
+        "name": "scan start time", "value": 90, "unit_name": "second"}})
+    metadata.add({"id": "scan=2", "scan_start_time": 2.0})
+    assert metadata.query(scan_start_time=(1.0, 2.0))['scan_start_time'].tolist() == [1.5, 2.0]
@@ -0,0 +1,71 @@
+import os
+
+from functools import partial
+from io import BytesIO
+
+import numpy as np
+from pyteomics import mzml
+
+import pytest
+
+from psims.mzml import MzMLReader
+from psims.mzml.writer import PlainMzMLWriter
+from psims.test.utils import output_path
+from psims.test.mzml_data import (
+    mz_array, intensity_array, tic, ms2_spectra, grouped_spectra, scan_arguments, write_header, write_mzml,
+    NamedBytesIO)
+
+
+def test_mzml_reader(output_path):
+    data = write_mzml(ms2_spectra(), stream=NamedBytesIO(output_path), offset_index=True)
+    with open(output_path, 'wb') as handle:
+        handle.write(data)
+    expected = mzml.MzML(BytesIO(data), use_index=True)
+    try:
+        for offset_index in (None, False):
+            with MzMLReader(output_path, offset_index=offset_index) as reader:
+                assert len(reader) == 13
+                assert [spectrum.id for spectrum in reader] == ['scan=%d' % i for i in range(13)]
+                for spectrum_id in ('scan=0', 'scan=5', 'scan=12'):
+                    spectrum = reader.get_by_id(spectrum_id)
+                    reference = expected.get_by_id(spectrum_id)
+                    assert spectrum.index == reference['index']
+                    assert sorted(spectrum.arrays) == sorted(
+                        key for key in reference if key.endswith(' array'))
+                    for name in spectrum.arrays:
+                        assert spectrum[name].dtype == reference[name].dtype
+                        assert np.allclose(spectrum[name], reference[name])
+                    assert spectrum['ms level'] == reference['ms level']
+                    assert spectrum['MS:1000285'] == reference['total ion current']
+                spectrum = reader[5]
+                assert spectrum.id == 'scan=5'
+                assert spectrum['filter string'] == 'FTMS + p NSI d "Full ms2 5.0@hcd28.00" <&>\t'
+                assert spectrum['selected ion m/z'] == 500.0 + 5 / 7.
+                assert spectrum.find_param('scan start time').unit_name == 'minute'
+                assert 'charge state' not in reader['scan=4']
+                assert reader[-1].id == 'scan=12'
+                with pytest.raises(KeyError):
+                    reader.get_by_id('scan=13')
+                with pytest.raises(IndexError):
+                    reader.get_by_index(13)
+    finally:
+        os.remove(output_path + '.idx')
+
+    reader = MzMLReader(BytesIO(write_mzml(grouped_spectra(), header=partial(
+        write_header, sample_spectra=[scan_arguments(i) for i in range(4)]))))
+    assert reader['scan=2']['filter string'] == 'FTMS - p NSI Full ms'
+    assert 'isolated ion' in reader['scan=2']
+    assert 'isolated ion' not in reader['scan=7']
+
+    spectra = [dict(mz_array=mz_array, intensity_array=intensity_array, id='scan=%d' % i, compression=compression,
+                    params=[{"name": "ms level", "value": 1}],
+                    other_arrays=[("ion mobility values", np.arange(len(mz_array)))])
+               for i, compression in enumerate(("numpress linear", "truncate zlib"))]
+    data = write_mzml(spectra, [tic], writer_type=PlainMzMLWriter)
+    # Without an index, the elements are found by scanning the document
+    reader = MzMLReader(BytesIO(data))
+    assert reader.spectra.ids() == ['scan=0', 'scan=1']
+    for spectrum in reader:
+        assert np.allclose(spectrum['m/z array'], mz_array, rtol=1e-3)
+        assert np.allclose(spectrum['ion mobility values'], np.arange(len(mz_array)), atol=1e-2)
+    assert np.allclose(reader.get_chromatogram('TIC')['time array'], np.arange(10))
@@ -1,9 +1,18 @@
 import itertools
 import gzip
+import logging
 import os
 import tempfile
+import re
 
-from psims.mzml import MzMLWriter, binary_encoding
+from io import BytesIO
+
+from psims.mzml import (
+    MzMLWriter, PipelinedMzMLWriter, SpectrumBatch, binary_encoding, numpress, write_spectrum_shards,
+    TotalIonChromatogram, BasePeakChromatogram, ExtractedIonChromatograms)
+from psims.mzml.writer import PlainMzMLWriter
+from psims.mzml.codec_selection import CompressionPolicy, COMPRESSION_AUTO
+from psims.document import RenderedParamCache
 from pyteomics import mzml
 import numpy as np
 from lxml import etree
@@ -12,70 +21,9 @@ import pytest
 
 from psims import compression as compression_registry
 from psims.test.utils import output_path, compressor
-
-
-mz_array = [
-    255.22935009, 283.26141863, 284.26105318, 301.23572871,
-    304.908247, 329.26327093, 755.25267878, 910.6317435,
-    960.96747136, 971.31396162, 972.649568, 991.66036894,
-    1017.87649113, 1060.29899182, 1112.67519902, 1113.11545762,
-    1113.86200673, 1114.42377982, 1152.34596544, 1177.73119994,
-    1188.36935517, 1214.70161813, 1265.9795606, 1266.16111855,
-    1293.14606767, 1294.68263447, 1367.01605133, 1565.95282753,
-    1700.23290184, 969.65408783, 1110.37794027, 1170.89893785,
-    1175.34669421, 1183.40737076, 861.61958381, 1292.94207114,
-    1295.4429046, 876.96085225, 1335.39755355, 1357.92354342,
-    1365.96972386, 925.64504217, 958.65480011, 1438.49014079,
-    1452.48402739, 967.98859816, 986.63557879, 1480.46326372,
-    1001.97032019, 1007.67089513, 1525.51932956, 1016.67747057,
-    1080.3583722, 1090.03199733, 1133.01762219, 1186.72735997,
-    960.79647487, 1274.44354121, 1918.2693496, 961.85503396
-]
-
-intensity_array = [
-    1.90348869e+03, 1.92160377e+03, 3.26032338e+02,
-    1.05527732e+03, 9.50991606e+02, 1.52403574e+03,
-    8.63154395e+02, 4.11169655e+02, 2.33462730e+03,
-    2.62603673e+02, 2.73669694e+02, 8.62436899e+02,
-    4.22323174e+02, 2.54371429e+02, 1.02364420e+03,
-    5.44244205e+02, 4.93101348e+02, 2.64984906e+02,
-    9.36500725e+02, 4.79373626e+02, 9.26742857e+02,
-    4.52209221e+02, 3.02178809e+03, 4.94385979e+02,
-    1.67240655e+03, 9.41320838e+02, 7.25744090e+02,
-    1.27260012e+03, 8.24236545e+02, 4.93518583e+02,
-    7.33281806e+04, 9.60817582e+02, 2.64893187e+03,
-    7.95614286e+03, 4.94586514e+03, 2.35346153e+04,
-    1.50301526e+03, 5.36435167e+03, 3.78042332e+02,
-    1.09926345e+03, 3.10133857e+03, 7.41566590e+02,
-    2.77340229e+05, 1.00796887e+05, 4.69519356e+03,
-    1.55343822e+04, 5.45621612e+03, 5.53939031e+03,
-    9.49732490e+03, 8.05000735e+03, 2.65457068e+03,
-    1.36766228e+04, 2.69348480e+03, 6.71802368e+03,
-    4.46828571e+02, 1.39065143e+04, 4.29267365e+03,
-    2.73782365e+03, 1.35373492e+03, 1.17601397e+03
-]
-
-charge_array = [
-    -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1,
-    -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -2, -2, -2, -2, -2,
-    -3, -2, -2, -3, -2, -2, -2, -3, -3, -2, -2, -3, -3, -2, -3, -3, -2,
-    -3, -3, -3, -3, -3, -5, -4, -3, -6
-]
-
-
-sample = {
-    "name": "shotgun_explodeomics_precipitate_123",
-    "params": [
-        "certified organic",
-        {"acquired in": "1812"}
-    ]
-}
-
-encodings = {
-    "m/z array": np.float64,
-    "intensity array": np.float64,
-    "charge array": np.float64
-}
+from psims.test.mzml_data import (
+    mz_array, intensity_array, charge_array, sample, encodings, tic, ms1_spectra, write_mzml,
+    ms2_spectra, scan_arguments)
 
 
 def test_array_codec():
@@ -93,6 +41,107 @@ def test_array_codec():
         np.allclose(original, decoded)
 
 
+def test_array_codec_no_copy():
+    original = np.array(intensity_array, dtype=np.float64)
+    view = binary_encoding.as_byte_view(original, np.float64)
+    assert np.shares_memory(np.frombuffer(view, dtype=np.uint8), original)
+    view = binary_encoding.as_byte_view(original, np.float32)
+    assert not np.shares_memory(np.frombuffer(view, dtype=np.uint8), original)
+    encoded = binary_encoding.encode_array(original[::2], binary_encoding.COMPRESSION_ZLIB, np.float64)
+    decoded = binary_encoding.decode_array(encoded, binary_encoding.COMPRESSION_ZLIB, np.float64)
+    assert np.all(decoded == original[::2])
+
+
+def test_numpress_codec():
+    encode = binary_encoding.encode_array
+    decode = binary_encoding.decode_array
+    error_bound = binary_encoding.error_bound
+
+    cases = [
+        (mz_array, binary_encoding.COMPRESSION_NUMPRESS_LINEAR),
+        (mz_array, binary_encoding.COMPRESSION_NUMPRESS_LINEAR_ZLIB),
+        (intensity_array, binary_encoding.COMPRESSION_NUMPRESS_PIC),
+        (intensity_array, binary_encoding.COMPRESSION_NUMPRESS_PIC_ZLIB),
+        (intensity_array, binary_encoding.COMPRESSION_NUMPRESS_SLOF),
+        (intensity_array, binary_encoding.COMPRESSION_NUMPRESS_SLOF_ZLIB),
+    ]
+
+    for data, compression in cases:
+        original = np.array(data, dtype=np.float64)
+        encoded = encode(original, compression, np.float64)
+        decoded = decode(encoded, compression, np.float64)
+        assert decoded.shape == original.shape
+        bound = error_bound(original, compression)
+        assert bound > 0
+        assert np.all(np.abs(original - decoded) <= bound)
+    assert error_bound(mz_array, binary_encoding.COMPRESSION_ZLIB) == 0
+
+    # Negative values are truncated toward zero, so they may move by more than half a unit
+    state = np.random.RandomState(3)
+    worst = 0.0
+    for _ in range(200):
+        original = state.uniform(-50, 50, 100)
+        encoded = encode(original, binary_encoding.COMPRESSION_NUMPRESS_LINEAR, np.float64)
+        decoded = decode(encoded, binary_encoding.COMPRESSION_NUMPRESS_LINEAR, np.float64)
+        bound = error_bound(original, binary_encoding.COMPRESSION_NUMPRESS_LINEAR)
+        assert np.all(np.abs(original - decoded) <= bound)
+        worst = max(worst, np.abs(original - decoded).max() / bound)
+    assert worst > 0.9
+
+    # Numpress decodes to 64-bit floats whatever type is asked for
+    decoded = decode(encode(mz_array, binary_encoding.COMPRESSION_NUMPRESS_LINEAR, np.float64),
+                     binary_encoding.COMPRESSION_NUMPRESS_LINEAR)
+    assert decoded.dtype == np.float64
+    assert np.all(np.abs(decoded - mz_array) <= error_bound(mz_array, binary_encoding.COMPRESSION_NUMPRESS_LINEAR))
+
+
+def test_numpress_reference_bytes():
+    # Reference values produced by the MS-Numpress C++ implementation
+    data = [100.0, 101.0, 102.5, 102.0, 0.0]
+    encoded = numpress.encode_linear(data, 10.0)
+    assert encoded == bytes(bytearray([
+        0x40, 0x24, 0, 0, 0, 0, 0, 0, 0xe8, 0x03, 0, 0, 0xf2, 0x03, 0, 0,
+        0x75, 0xec, 0xed, 0x90, 0xc0]))
+    assert np.allclose(numpress.decode_linear(encoded), data)
+
+    counts = [0, 1, 15, 16, 300]
+    encoded = numpress.encode_pic(counts)
+    assert encoded == bytes(bytearray([0x87, 0x17, 0xf6, 0x01, 0x5c, 0x21]))
+    assert np.all(numpress.decode_pic(encoded) == counts)
+
+    with pytest.raises(ValueError):
+        numpress.encode_pic([-5.0])
+
+
+def test_numpress_write_spectrum():
+    buffer = BytesIO()
+    compression = {
+        "m/z array": binary_encoding.COMPRESSION_NUMPRESS_LINEAR_ZLIB,
+        "intensity array": binary_encoding.COMPRESSION_NUMPRESS_SLOF,
+    }
+    with MzMLWriter(buffer, close=False) as f:
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.spectrum_list(count=1):
+                f.write_spectrum(
+                    mz_array, intensity_array, charge_array, id='scanId=1',
+                    params=[{"name": "ms level", "value": 1}],
+                    compression=compression)
+    buffer.seek(0)
+    tree = etree.parse(buffer)
+    arrays = tree.getroot().findall(".//{http://psi.hupo.org/ms/mzml}binaryDataArray")
+    assert len(arrays) == 3
+    names = [[p.attrib['name'] for p in arr.findall("{http://psi.hupo.org/ms/mzml}cvParam")] for arr in arrays]
+    assert binary_encoding.compression_map[compression['m/z array']] in names[0]
+    assert binary_encoding.compression_map[compression['intensity array']] in names[1]
+    assert "64-bit float" in names[1]
+    assert "zlib compression" in names[2]
+
+    binary = arrays[0].find("{http://psi.hupo.org/ms/mzml}binary").text
+    decoded = binary_encoding.decode_array(binary, compression['m/z array'], np.float64)
+    assert np.all(np.abs(decoded - mz_array) <= binary_encoding.error_bound(mz_array, compression['m/z array']))
+
+
 def test_write(output_path, compressor):
     with MzMLWriter(compressor(output_path, 'wb'), close=True) as f:
         f.register("Software", 'psims')
@@ -205,3 +254,615 @@ def test_write(output_path, compressor):
     line = reader.readline()
     assert line.startswith(b"""<?xml version='1.0' encoding='utf-8'?>""")
     return f
+
+
+def test_parallel_encoding():
+    serial = write_mzml(ms1_spectra(), [tic])
+    parallel = write_mzml(ms1_spectra(), [tic], encoding_workers=3, encoding_lookahead=4)
+    assert serial == parallel
+
+
+class _TaggedArray(np.ndarray):
+    pass
+
+
+def _reused_buffer_spectra(writer):
+    # np.asarray returns a new view of an ndarray subclass rather than the array itself
+    mz = np.linspace(100., 2000., 200000).view(_TaggedArray)
+    intensity = np.ones(len(mz), dtype=np.float32)
+    for i in range(4):
+        writer.write_spectrum(
+            mz, intensity, id='scanId=%d' % i, params=[{"name": "ms level", "value": 1}],
+            encoding={"m/z array": 64})
+        # Reuse the same buffer to make sure queued encodings are isolated
+        mz += 1
+
+
+def test_parallel_encoding_reused_subclass():
+    serial = write_mzml(_reused_buffer_spectra, spectrum_count=4)
+    assert write_mzml(_reused_buffer_spectra, spectrum_count=4, encoding_workers=2) == serial
+    assert write_mzml(_reused_buffer_spectra, spectrum_count=4, encoding_workers=2, encoding_cache=8) == serial
+
+
+def test_adaptive_compression():
+    policy = CompressionPolicy(sample_size=3, zlib_levels=(1, 9), max_error={"m/z array": 1e-3})
+    buffer = BytesIO()
+    with MzMLWriter(buffer, close=False, compression_policy=policy) as f:
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.spectrum_list(count=6):
+                for i in range(6):
+                    f.write_spectrum(
+                        mz_array, intensity_array, id='scanId=%d' % i,
+                        params=[{"name": "ms level", "value": 1}],
+                        compression=COMPRESSION_AUTO)
+        report = f.compression_report()
+    selected = {row.array_type: row for row in report if row.selected}
+    assert set(selected) == {"m/z array", "intensity array"}
+    # Lossy methods are only candidates where an error tolerance was given
+    lossy = set(row.array_type for row in report if row.compression.startswith("numpress"))
+    assert lossy == {"m/z array"}
+    assert "intensity array" in f.compression_selector.format_report()
+
+    buffer.seek(0)
+    reader = mzml.MzML(buffer)
+    for spectrum in reader:
+        assert np.allclose(spectrum['m/z array'], mz_array, atol=1e-3)
+        assert np.allclose(spectrum['intensity array'], intensity_array)
+
+    # Chromatograms are sampled apart from spectra, and do not complete their sample
+    with MzMLWriter(BytesIO(), close=False, compression_policy=policy) as f:
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.spectrum_list(count=2):
+                for i in range(2):
+                    f.write_spectrum(
+                        mz_array, intensity_array, id='scanId=%d' % i,
+                        params=[{"name": "ms level", "value": 1}], compression=COMPRESSION_AUTO)
+            with f.chromatogram_list(count=3):
+                for i in range(3):
+                    f.write_chromatogram(
+                        np.arange(100.), np.arange(100.), id='TIC%d' % i, compression=COMPRESSION_AUTO)
+        report = f.compression_report()
+    selected = set((row.entity_kind, row.array_type) for row in report if row.selected)
+    assert selected == {("chromatogram", "time array"), ("chromatogram", "intensity array")}
+    assert set(row.entity_kind for row in report) == {"spectrum", "chromatogram"}
+
+
+def test_adaptive_compression_fallback(caplog):
+    policy = CompressionPolicy(sample_size=2, max_error=1.0)
+    intensities = [np.array(intensity_array), np.array(intensity_array) * 2, np.array(intensity_array)]
+    # Baseline subtracted, which Pic cannot encode
+    intensities[2][5] = -20
+    buffer = BytesIO()
+    with caplog.at_level(logging.INFO, logger='psims.mzml.writer'):
+        with MzMLWriter(buffer, close=False, compression_policy=policy) as f:
+            f.controlled_vocabularies()
+            with f.run(id='test'):
+                with f.spectrum_list(count=3):
+                    for i, intensity in enumerate(intensities):
+                        f.write_spectrum(
+                            mz_array, intensity, id='scanId=%d' % i, params=[{"name": "ms level", "value": 1}],
+                            compression=COMPRESSION_AUTO)
+    selected = f.compression_selector.selected[("spectrum", "intensity array")]
+    assert selected.compression.startswith("numpress pic")
+    fallback = [row for row in f.compression_report() if row.fallbacks]
+    assert len(fallback) == 1
+    assert fallback[0].array_type == "intensity array" and fallback[0].fallbacks == 1
+    assert not fallback[0].compression.startswith("numpress")
+    assert "fallbacks" in caplog.text and "intensity array" in caplog.text
+
+    buffer.seek(0)
+    spectrum = list(mzml.MzML(buffer))[2]
+    assert np.allclose(spectrum['intensity array'], intensities[2])
+
+
+def test_decode_into_buffer():
+    mz = np.array(mz_array)
+    intensity = np.array(intensity_array, dtype=np.float32)
+    encoded_mz = binary_encoding.encode_array(mz, compression='zlib', dtype=np.float64)
+    encoded_intensity = binary_encoding.encode_array(intensity, dtype=np.float32)
+
+    out = np.zeros(len(mz) + 5)
+    filled = binary_encoding.decode_array_into(encoded_mz, out, compression='zlib', dtype=np.float64)
+    assert np.shares_memory(filled, out)
+    assert np.all(filled == mz)
+    with pytest.raises(ValueError):
+        binary_encoding.decode_array_into(encoded_mz, np.zeros(3), compression='zlib', dtype=np.float64)
+
+    batch = [(encoded_mz, 'zlib', np.float64), encoded_intensity, encoded_intensity]
+    buffer = np.zeros(len(mz) + 2 * len(intensity))
+    result = binary_encoding.decode_arrays(batch, out=buffer)
+    assert result.data is buffer
+    assert len(result) == 3
+    assert np.all(result[0] == mz)
+    assert np.all(result[-1] == intensity)
+    # Buffers which are too small are replaced by a larger one
+    result = binary_encoding.decode_arrays(batch, out=np.zeros(4))
+    assert list(result.offsets) == [0, len(mz), len(mz) + len(intensity), len(mz) + 2 * len(intensity)]
+    assert np.all(result[1] == intensity)
+
+
+def test_mantissa_truncation():
+    intensity = np.array(intensity_array, dtype=np.float32)
+    truncated = binary_encoding.truncate_mantissa(intensity, 8, np.float32)
+    assert np.all(np.abs(truncated - intensity) <= binary_encoding.error_bound(intensity, 'truncate zlib', 8))
+    assert np.all(truncated.view(np.uint32) & 0x7fff == 0)
+    with pytest.raises(ValueError):
+        binary_encoding.truncate_mantissa(np.arange(10), 8, np.int32)
+
+    buffer = BytesIO()
+    with MzMLWriter(buffer, close=False, significant_bits={"intensity array": 8}) as f:
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.spectrum_list(count=1):
+                f.write_spectrum(
+                    mz_array, intensity, id='scanId=1', params=[{"name": "ms level", "value": 1}],
+                    compression={"intensity array": "truncate zlib"})
+    assert b'name="%s" value="8"' % binary_encoding.TRUNCATION_PARAM.encode('ascii') in buffer.getvalue()
+    buffer.seek(0)
+    spectrum = next(mzml.MzML(buffer))
+    assert np.all(spectrum['intensity array'] == truncated)
+    assert np.allclose(spectrum['m/z array'], mz_array)
+
+
+def test_lossless_dtype_narrowing():
+    assert binary_encoding.narrowest_lossless_dtype(np.array(mz_array)) == np.float64
+    assert binary_encoding.narrowest_lossless_dtype(np.array(intensity_array, dtype=np.float32).astype(
+        np.float64)) == np.float32
+    assert binary_encoding.narrowest_lossless_dtype([1.5, np.nan, np.inf], True) == np.float16
+    assert binary_encoding.narrowest_lossless_dtype([1.5, np.nan, np.inf]) == np.float32
+    assert binary_encoding.narrowest_lossless_dtype(np.array([1, 2, 3], dtype=np.int64)) == np.int32
+    assert binary_encoding.narrowest_lossless_dtype(np.array([2 ** 40], dtype=np.int64)) == np.int64
+
+    intensity = np.array(intensity_array, dtype=np.float32).astype(np.float64)
+    buffer = BytesIO()
+    with MzMLWriter(buffer, close=False) as f:
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.spectrum_list(count=1):
+                f.write_spectrum(
+                    mz_array, intensity, np.array(charge_array, dtype=np.int64), id='scanId=1',
+                    params=[{"name": "ms level", "value": 1}], encoding='auto-lossless')
+    buffer.seek(0)
+    spectrum = next(mzml.MzML(buffer))
+    assert spectrum['m/z array'].dtype == np.float64
+    assert spectrum['intensity array'].dtype == np.float32
+    assert np.all(spectrum['m/z array'] == mz_array)
+    assert np.all(spectrum['intensity array'] == intensity)
+    assert np.all(spectrum['charge array'] == charge_array)
+
+
+def test_streaming_encoding():
+    intensity = np.array(intensity_array, dtype=np.float64)
+    for compression in ('none', 'zlib', 'truncate zlib'):
+        for dtype in (np.float32, np.float64):
+            encoder = binary_encoding.StreamingArrayEncoder(
+                intensity, compression=compression, dtype=dtype, chunk_size=40)
+            expected = binary_encoding.encode_array(intensity, compression=compression, dtype=dtype)
+            assert len(encoder) == len(expected)
+            assert b''.join(encoder) == expected
+    with pytest.raises(ValueError):
+        binary_encoding.StreamingArrayEncoder(intensity, compression='numpress linear')
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        mapped = np.memmap(path, dtype=np.float64, mode='w+', shape=(len(mz_array),))
+        mapped[:] = mz_array
+        mapped.flush()
+        mapped = np.memmap(path, dtype=np.float64, mode='r')
+        serial = BytesIO()
+        streamed = BytesIO()
+        for buffer, threshold in ((serial, None), (streamed, 0)):
+            with MzMLWriter(buffer, close=False, streaming_threshold=threshold) as f:
+                f.controlled_vocabularies()
+                with f.run(id='test'):
+                    with f.spectrum_list(count=1):
+                        f.write_spectrum(
+                            mapped, intensity_array, id='scanId=1', params=[{"name": "ms level", "value": 1}],
+                            encoding={"m/z array": 64}, compression={"intensity array": "none"})
+        del mapped
+    finally:
+        os.remove(path)
+    assert serial.getvalue() == streamed.getvalue()
+
+
+def test_encoding_cache():
+    cache = binary_encoding.EncodingCache(2)
+    keys = [cache.make_key(np.arange(i + 1), np.float64, 'zlib') for i in range(3)]
+    assert keys[0] == cache.make_key(np.arange(1.0), np.float64, 'zlib')
+    assert keys[0] != cache.make_key(np.arange(1.0), np.float32, 'zlib')
+    for i, key in enumerate(keys):
+        cache.put(key, i)
+    assert len(cache) == 2
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) == 2
+    assert cache.hit_rate == 0.5
+
+    uncached = write_mzml(ms1_spectra(), [tic])
+    assert write_mzml(ms1_spectra(), [tic], encoding_cache=8) == uncached
+    # The intensity, charge and signal to noise arrays repeat in every spectrum, and
+    # the chromatogram's intensity array is identical to its time array
+    parallel = binary_encoding.EncodingCache(8)
+    assert write_mzml(ms1_spectra(), [tic], encoding_cache=parallel, encoding_workers=2) == uncached
+    assert parallel.hits == 28
+    assert parallel.misses == 14
+
+
+def test_spectrum_templates():
+    expected = write_mzml(ms2_spectra())
+    assert write_mzml(ms2_spectra(), spectrum_templates=True) == expected
+    assert write_mzml(ms2_spectra(), spectrum_templates=True, encoding_workers=2) == write_mzml(
+        ms2_spectra(), encoding_workers=2)
+
+    buffer = BytesIO()
+    with MzMLWriter(buffer, close=False, spectrum_templates=True) as f:
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.spectrum_list(count=2):
+                for i in range(4):
+                    f.write_spectrum(
+                        mz_array, intensity_array, id='scan=%d' % i, params=[{"name": "ms level", "value": 2}],
+                        precursor_information={"mz": 500.0, "intensity": 1.0, "charge": 2, "scan_id": 'scan=0'})
+        # One shape, compiled from the first spectrum and used for the rest
+        assert len(f._spectrum_templates) == 1
+        assert list(f._spectrum_templates.values())[0] is not None
+
+
+def test_pipelined_writer():
+    expected = write_mzml(ms1_spectra(), [tic])
+    assert write_mzml(ms1_spectra(), [tic], writer_type=PipelinedMzMLWriter, queue_size=2) == expected
+    assert write_mzml(ms1_spectra(), [tic], writer_type=PipelinedMzMLWriter, encoding_workers=2) == expected
+    expected = write_mzml(ms2_spectra())
+    assert write_mzml(ms2_spectra(), writer_type=PipelinedMzMLWriter, spectrum_templates=True) == expected
+
+    # Errors raised while building a spectrum surface in the calling thread
+    buffer = BytesIO()
+    with pytest.raises(KeyError):
+        with PipelinedMzMLWriter(buffer, close=False) as f:
+            f.controlled_vocabularies()
+            with f.run(id='test'):
+                with f.spectrum_list(count=2):
+                    f.write_spectrum(mz_array, intensity_array, id='scan=1', encoding=17)
+                    f.write_spectrum(mz_array, intensity_array, id='scan=2')
+    assert not f._pipeline_threads
+
+
+def _render_ms2_spectra(writer, start, stop):
+    for i in range(start, stop):
+        writer.write_spectrum(
+            np.array(mz_array[:i + 3]) + i, intensity_array[:i + 3], id='scan=%d' % i,
+            scan_start_time=0.5 + i * 0.011, params=[{"name": "ms level", "value": 2}],
+            precursor_information={"mz": 500.0 + i / 7., "intensity": i * 100., "charge": 2,
+                                   "scan_id": 'scan=%d' % (i // 4 * 4)})
+
+
+def _sharded_spectra(ranges, **kwargs):
+    def write(writer):
+        if kwargs:
+            write_spectrum_shards(writer, _render_ms2_spectra, ranges, **kwargs)
+        else:
+            for start, stop in ranges:
+                _render_ms2_spectra(writer, start, stop)
+    return write
+
+
+def test_spectrum_shards():
+    ranges = [(0, 7), (7, 8), (8, 15)]
+    count = ranges[-1][1]
+    expected = write_mzml(_sharded_spectra(ranges), [tic], spectrum_count=count)
+    assert write_mzml(_sharded_spectra(ranges, processes=0), [tic], spectrum_count=count) == expected
+    assert write_mzml(
+        _sharded_spectra(ranges, processes=2, spectrum_templates=True), [tic], spectrum_count=count) == expected
+    reader = mzml.MzML(BytesIO(expected), use_index=True)
+    assert reader.get_by_id('scan=12')['index'] == 12
+
+
+def _check_checksum(data):
+    from hashlib import sha1
+    end = data.index(b'<fileChecksum>') + len(b'<fileChecksum>')
+    checksum = data[end:data.index(b'</fileChecksum>')].decode('ascii')
+    assert sha1(data[:end]).hexdigest() == checksum
+
+
+def test_deferred_count(output_path):
+    def write(stream, count):
+        with MzMLWriter(stream, close=False) as f:
+            f.controlled_vocabularies()
+            with f.run(id='test'):
+                with f.spectrum_list(count=count):
+                    for i in range(12):
+                        f.write_spectrum(mz_array, intensity_array, id='scan=%d' % i,
+                                         params=[{"name": "ms level", "value": 1}])
+                with f.chromatogram_list(count=count and 1):
+                    f.write_chromatogram(np.arange(10), np.arange(10), id='TIC')
+
+    buffer = BytesIO()
+    write(buffer, None)
+    data = buffer.getvalue()
+    assert b'<spectrumList count="0000000012"' in data
+    assert b'<chromatogramList count="0000000001"' in data
+    _check_checksum(data)
+    reader = mzml.MzML(BytesIO(data), use_index=True)
+    assert reader.get_by_id('scan=7')['index'] == 7
+    assert reader.get_by_id('TIC')['id'] == 'TIC'
+
+    # Files opened write-only are reopened by name to read back
+    with open(output_path, 'wb') as fh:
+        write(fh, None)
+    with open(output_path, 'rb') as fh:
+        assert fh.read() == data
+
+    with pytest.raises(ValueError):
+        write(_Unseekable(), None)
+    # A gzip file reports that it is seekable, but cannot seek backward while writing
+    with gzip.GzipFile(output_path, 'wb') as fh:
+        with pytest.raises(ValueError):
+            write(fh, None)
+
+
+class _Unseekable(BytesIO):
+    def seekable(self):
+        return False
+
+
+def test_write_spectra():
+    def write_each(writer):
+        for i in range(10):
+            writer.write_spectrum(
+                np.array(mz_array[:i + 5]) + i, intensity_array[:i + 5], id='scan=%d' % i,
+                scan_start_time=0.5 + i, polarity=-1, compression='none',
+                params=[{"name": "ms level", "value": i % 2 + 1}])
+
+    def write_batch(batch, **kwargs):
+        def write(writer):
+            assert writer.write_spectra(batch, polarity=-1, compression='none') == 10
+        return write_mzml(write, **kwargs)
+
+    # Both are written with a deferred count
+    expected = write_mzml(write_each)
+    lengths = np.arange(10) + 5
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    mzs = np.concatenate([np.array(mz_array[:n]) + i for i, n in enumerate(lengths)])
+    intensities = np.concatenate([intensity_array[:n] for n in lengths])
+    metadata = np.zeros(10, dtype=[('id', 'S10'), ('scan_start_time', float), ('ms level', int)])
+    metadata['id'] = ['scan=%d' % i for i in range(10)]
+    metadata['scan_start_time'] = 0.5 + np.arange(10)
+    metadata['ms level'] = np.arange(10) % 2 + 1
+    batch = SpectrumBatch(metadata, mzs, intensities, offsets[:-1])
+    assert write_batch(batch) == expected
+    assert write_batch(list(batch)) == expected
+    assert write_batch(batch, spectrum_templates=True) == expected
+    assert write_batch(batch, writer_type=PipelinedMzMLWriter) == expected
+
+    with pytest.raises(ValueError):
+        SpectrumBatch(metadata, mzs, intensities, offsets[:5])
+    with pytest.raises(TypeError):
+        MzMLWriter(BytesIO(), close=False).write_spectra(batch, centroid=False)
+
+
+def test_derived_chromatograms():
+    targets = [mz_array[3], mz_array[10], 2000.0]
+
+    def write(writer_type=MzMLWriter, count=None):
+        buffer = BytesIO()
+        derived = [TotalIonChromatogram(), BasePeakChromatogram(),
+                   ExtractedIonChromatograms(targets, ppm_tolerance=5)]
+        with writer_type(buffer, close=False, derived_chromatograms=derived) as f:
+            f.controlled_vocabularies()
+            with f.run(id='test'):
+                with f.spectrum_list(count=600):
+                    for i in range(600):
+                        f.write_spectrum(
+                            mz_array, np.array(intensity_array) * (i + 1), id='scan=%d' % i,
+                            scan_start_time=i / 10., params=[{"name": "ms level", "value": i % 3 // 2 + 1}])
+                with f.chromatogram_list(count=count):
+                    f.write_chromatogram(np.arange(10), np.arange(10), id='pressure')
+        return buffer.getvalue()
+
+    data = write()
+    assert write(PipelinedMzMLWriter) == data
+    assert b'<chromatogramList count="0000000006"' in data
+    assert b'<chromatogramList count="6"' in write(count=1)
+    reader = mzml.MzML(BytesIO(data), use_index=True)
+    ms1 = [i for i in range(600) if i % 3 != 2]
+    tic = reader.get_by_id('TIC')
+    assert np.allclose(tic['time array'], np.array(ms1) / 10.)
+    assert np.allclose(tic['intensity array'], np.sum(intensity_array) * (np.array(ms1) + 1), rtol=1e-6)
+    assert 'total ion current chromatogram' in tic
+    bpc = reader.get_by_id('BPC')
+    assert np.allclose(bpc['intensity array'], np.max(intensity_array) * (np.array(ms1) + 1), rtol=1e-6)
+    xic = reader.get_by_id('XIC mz=%0.4f' % targets[1])
+    assert np.allclose(xic['intensity array'], intensity_array[10] * (np.array(ms1) + 1), rtol=1e-6)
+    assert not reader.get_by_id('XIC mz=2000.0000')['intensity array'].any()
+    assert reader.get_by_id('pressure')['index'] == 0
+
+    def write_timed(times, chromatograms=True):
+        buffer = BytesIO()
+        with MzMLWriter(buffer, close=False, derived_chromatograms=[TotalIonChromatogram()]) as f:
+            f.controlled_vocabularies()
+            with f.run(id='test'):
+                with f.spectrum_list(count=len(times)):
+                    for i, time in enumerate(times):
+                        f.write_spectrum(mz_array, intensity_array, id='scan=%d' % i, scan_start_time=time,
+                                         params=[{"name": "ms level", "value": 1}])
+                if chromatograms:
+                    with f.chromatogram_list(count=0):
+                        pass
+        return buffer.getvalue()
+
+    # Start times are converted to the minutes the time array is labelled with
+    data = write_timed([{"name": "scan start time", "value": 60, "unit_name": "second"},
+                        {"value": 120, "unit_name": "second"}, 2.5])
+    tic = mzml.MzML(BytesIO(data), use_index=True).get_by_id('TIC')
+    assert np.allclose(tic['time array'], [1.0, 2.0, 2.5])
+    assert re.search(br'name="time array" value="" unitCvRef="UO" unitAccession="UO:0000031"', data)
+    # The parameter name may be left out of a start time given with a unit
+    spectrum = mzml.MzML(BytesIO(data), use_index=True).get_by_id('scan=1')
+    assert spectrum['scanList']['scan'][0]['scan start time'] == 120
+    assert spectrum['scanList']['scan'][0]['scan start time'].unit_info == 'second'
+    with pytest.raises(ValueError):
+        write_timed([{"name": "scan start time", "value": 60, "unit_name": "electronvolt"}])
+    with pytest.warns(UserWarning, match="Derived chromatograms"):
+        write_timed([1.0], chromatograms=False)
+
+
+class _EncodeCountingWriter(MzMLWriter):
+    counts = {}
+
+    def _encode_array_data(self, array, *args, **kwargs):
+        self.counts[id(array)] = self.counts.get(id(array), 0) + 1
+        return super(_EncodeCountingWriter, self)._encode_array_data(array, *args, **kwargs)
+
+
+def test_write_chromatograms():
+    times = np.linspace(0, 10, 50)
+    intensities = np.random.RandomState(5).uniform(0, 1e4, (40, 50))
+    transitions = np.zeros(40, dtype=[('precursor_mz', float), ('product_mz', float), ('collision_energy', float)])
+    transitions['precursor_mz'] = 400 + np.arange(40) // 4
+    transitions['product_mz'] = 200 + np.arange(40) * 3.5
+    transitions['collision_energy'] = 20 + np.arange(40) % 4
+
+    def write(bulk, writer_type=MzMLWriter, ragged=False, **kwargs):
+        buffer = BytesIO()
+        with writer_type(buffer, close=False, **kwargs) as f:
+            f.controlled_vocabularies()
+            with f.run(id='test'):
+                with f.chromatogram_list(count=41):
+                    f.write_chromatogram(times, intensities.sum(axis=0), id='TIC')
+                    if bulk:
+                        time_array = [times] * 40 if ragged else times
+                        assert f.write_chromatograms(time_array, intensities, transitions) == 40
+                        if writer_type is MzMLWriter:
+                            # One template, compiled from the first transition and used for the rest
+                            assert len(f._chromatogram_templates) == 1
+                            assert list(f._chromatogram_templates.values())[0] is not None
+                        transition_list = []
+                    else:
+                        transition_list = transitions.tolist()
+                    for row, (q1, q3, ce) in zip(intensities, transition_list):
+                        f.write_chromatogram(
+                            times, np.asarray(row, dtype=np.float32),
+                            id="SRM SIC Q1=%0.4f Q3=%0.4f CE=%0.2f" % (q1, q3, ce),
+                            chromatogram_type="selected reaction monitoring chromatogram",
+                            precursor_information={
+                                "isolation_window_args": {"target": q1},
+                                "activation": ["collision-induced dissociation",
+                                               {"name": "collision energy", "value": ce,
+                                                "unit_name": "electronvolt"}]},
+                            product_information={"isolation_window_args": {"target": q3}})
+        return buffer.getvalue()
+
+    expected = write(False)
+    assert write(True) == expected
+    assert write(True, ragged=True) == expected
+    assert write(True, writer_type=PipelinedMzMLWriter) == expected
+    assert write(True, encoding_workers=2) == expected
+    # The shared time axis is encoded for the first transition, which is written normally,
+    # and once for the template, and each intensity row once
+    assert write(True, writer_type=_EncodeCountingWriter) == expected
+    assert _EncodeCountingWriter.counts[id(times)] == 3
+    assert sum(_EncodeCountingWriter.counts.values()) == 44
+
+    reader = mzml.MzML(BytesIO(expected), use_index=True)
+    chromatogram = reader.get_by_id("SRM SIC Q1=402.0000 Q3=231.5000 CE=21.00")
+    assert chromatogram['index'] == 10
+    assert chromatogram['precursor'][0]['activation']['collision energy'] == 21
+    assert chromatogram['product'][0]['isolationWindow']['isolation window target m/z'] == 231.5
+    assert np.allclose(chromatogram['intensity array'], intensities[9])
+
+    # Transitions differing only in collision energy, as when optimizing it, get distinct ids
+    optimized = [{"precursor_mz": 400.0, "product_mz": 200.0, "collision_energy": ce} for ce in (18, 20, 22)]
+    buffer = BytesIO()
+    with MzMLWriter(buffer, close=False) as f:
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.chromatogram_list(count=3):
+                assert f.write_chromatograms(times, intensities[:3], optimized) == 3
+                with pytest.raises(ValueError):
+                    f.write_chromatograms(times, intensities[:2], [optimized[0], dict(optimized[0])])
+    reader = mzml.MzML(BytesIO(buffer.getvalue()), use_index=True)
+    assert sorted(reader.index['chromatogram']) == [
+        "SRM SIC Q1=400.0000 Q3=200.0000 CE=%0.2f" % ce for ce in (18, 20, 22)]
+
+
+def _cached_param_spectra():
+    spectra = [scan_arguments(i) for i in range(12)]
+    for i, spectrum in enumerate(spectra):
+        # Equal to 1, but written differently
+        spectrum['scan_params'][1]['value'] = 1.0 if i % 4 == 3 else 1
+    return spectra
+
+
+def _use_rendered_param_cache(cache):
+    def header(writer):
+        writer.context.rendered_param_cache = cache
+    return header
+
+
+def test_rendered_param_cache(output_path):
+    cache = RenderedParamCache(max_size=64)
+    expected = write_mzml(_cached_param_spectra(), header=_use_rendered_param_cache(None))
+    assert write_mzml(_cached_param_spectra(), header=_use_rendered_param_cache(cache)) == expected
+    assert b'name="preset scan configuration" value="1.0"' in expected
+    assert cache.hits > 0
+    assert 0 < cache.hit_rate < 1
+    assert cache.nbytes == sum(map(len, cache._store.values()))
+    assert 0 < len(cache) <= 64
+
+    small = RenderedParamCache(max_size=64, max_bytes=400)
+    assert write_mzml(_cached_param_spectra(), header=_use_rendered_param_cache(small)) == expected
+    assert 0 < small.nbytes <= 400
+
+    # An output given as a path cannot have pre-rendered markup written to it
+    path_cache = RenderedParamCache(max_size=64)
+    with PlainMzMLWriter(output_path) as f:
+        f.context.rendered_param_cache = path_cache
+        f.controlled_vocabularies()
+        with f.run(id='test'):
+            with f.spectrum_list(count=12):
+                for spectrum in _cached_param_spectra():
+                    f.write_spectrum(**spectrum)
+    with open(output_path, 'rb') as fh:
+        data = fh.read()
+    assert data == write_mzml(_cached_param_spectra(), writer_type=PlainMzMLWriter)
+    assert len(path_cache) == 0
+
+
+def _check_index_offsets(data):
+    offsets = etree.fromstring(data).iter('{*}offset')
+    count = 0
+    for offset in offsets:
+        position = int(offset.text)
+        tag = data[position:data.index(b'>', position)]
+        assert tag.startswith(b'<' + offset.getparent().get('name').encode('utf8') + b' ')
+        assert (b'id="%s"' % offset.get('idRef').encode('utf8')) in tag
+        count += 1
+    return count
+
+
+def test_reported_offsets():
+    assert _check_index_offsets(write_mzml(ms1_spectra(), [tic])) == 11
+    for writer_type in (MzMLWriter, PipelinedMzMLWriter):
+        data = write_mzml(ms2_spectra(), writer_type=writer_type, spectrum_templates=True)
+        assert _check_index_offsets(data) == 13
+
+
+class _CountingStream(BytesIO):
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return BytesIO.write(self, data)
+
+
+def test_write_coalescing():
+    unbuffered = _CountingStream()
+    expected = write_mzml(ms2_spectra(), stream=unbuffered, write_buffer_size=0)
+    coalesced = _CountingStream()
+    assert write_mzml(ms2_spectra(), stream=coalesced, write_buffer_size=2 ** 14) == expected
+    assert coalesced.writes < unbuffered.writes / 100.
+    for writer_type in (MzMLWriter, PipelinedMzMLWriter):
+        assert write_mzml(
+            ms2_spectra(), writer_type=writer_type, write_buffer_size=100, threaded_checksum=True) == expected
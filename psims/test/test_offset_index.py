@@ -0,0 +1,43 @@
+import os
+import re
+
+from io import BytesIO
+
+from lxml import etree
+
+import pytest
+
+from psims.mzml import OffsetIndex
+from psims.test.utils import output_path
+from psims.test.mzml_data import ms1_spectra, ms2_spectra, tic, write_mzml, NamedBytesIO
+
+
+def test_offset_index(output_path):
+    data = write_mzml(ms1_spectra(), [tic], stream=NamedBytesIO(output_path), offset_index=True)
+    index = OffsetIndex.load(output_path + '.idx')
+    try:
+        assert index.document_size == len(data)
+        assert index.checksum == re.search(br'<fileChecksum>(\w+)<', data).group(1).decode('ascii')
+        assert len(index.spectrum) == 10
+        assert index.spectrum.ids() == ['scanId=%d' % i for i in range(10)]
+        for offset in etree.fromstring(data).iter('{*}offset'):
+            section = index[offset.getparent().get('name')]
+            assert section.offset_of(offset.get('idRef')) == int(offset.text)
+        assert index.spectrum.offset_at(7) == index.spectrum['scanId=7']
+        assert data[index.chromatogram['TIC']:].startswith(b'<chromatogram ')
+        assert 'scanId=10' not in index.spectrum
+        with pytest.raises(KeyError):
+            index.spectrum.offset_of('TIC')
+        with pytest.raises(IndexError):
+            index.spectrum.offset_at(10)
+    finally:
+        del index
+        os.remove(output_path + '.idx')
+
+    sidecar = BytesIO()
+    write_mzml(ms2_spectra(), offset_index=sidecar)
+    sidecar.seek(0)
+    index = OffsetIndex.load(sidecar)
+    assert index.spectrum.offset_of('scan=12') == index.spectrum.offset_at(12)
+    with pytest.raises(ValueError):
+        write_mzml(ms1_spectra(), [tic], offset_index=True)
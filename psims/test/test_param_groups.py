@@ -0,0 +1,47 @@
+import warnings
+
+from functools import partial
+from io import BytesIO
+
+from pyteomics import mzml
+
+from psims.mzml import ParamGroupFactorer
+from psims.mzml.param_groups import SPECTRUM_PARAMS
+from psims.test.mzml_data import grouped_spectra, scan_arguments, write_header, write_mzml
+
+
+def test_param_group_factoring():
+    samples = [scan_arguments(i) for i in range(4)]
+    expected = write_mzml(grouped_spectra(), header=write_header)
+    data = write_mzml(grouped_spectra(), header=partial(write_header, sample_spectra=samples))
+    assert len(data) < len(expected)
+    assert data.count(b'<referenceableParamGroupRef ref="CommonSpectrumParams"') == 11
+    assert data.count(b'<referenceableParamGroupRef ref="CommonScanParams"') == 12
+    assert write_mzml(
+        grouped_spectra(), header=partial(write_header, sample_spectra=samples), spectrum_templates=True) == data
+
+    plain = mzml.MzML(BytesIO(expected), use_index=True)
+    factored = mzml.MzML(BytesIO(data), use_index=True)
+    for i in (0, 2, 7):
+        spectrum_id = 'scan=%d' % i
+        left, right = plain.get_by_id(spectrum_id), factored.get_by_id(spectrum_id)
+        for key in ('ms level', 'negative scan', 'centroid spectrum', 'isolated ion', 'base peak m/z'):
+            assert (key in left) == (key in right)
+            assert left.get(key) == right.get(key)
+        assert left['scanList']['scan'][0]['filter string'] == right['scanList']['scan'][0]['filter string']
+
+
+def test_param_group_factoring_id_collision():
+    groups = [{'id': 'CommonSpectrumParams', 'params': [{"proven": "inductively"}]}]
+    samples = [scan_arguments(i) for i in range(4)]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", UserWarning)
+        data = write_mzml(grouped_spectra(), header=partial(write_header, groups=groups, sample_spectra=samples))
+    assert data.count(b'<referenceableParamGroup id="CommonSpectrumParams"') == 1
+    assert data.count(b'<referenceableParamGroup id="CommonSpectrumParams_1"') == 1
+    assert data.count(b'<referenceableParamGroupRef ref="CommonSpectrumParams_1"') == 11
+
+    factorer = ParamGroupFactorer()
+    factorer.observe({SPECTRUM_PARAMS: ['centroid spectrum', 'negative scan']})
+    assert [group.id for group in factorer.build(['CommonSpectrumParams', 'CommonSpectrumParams_1'])] == [
+        'CommonSpectrumParams_2']
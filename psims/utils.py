@@ -265,6 +265,80 @@ class KeyToAttrProxy(object):
         return len(self.keys())
 
 
+class LRUCache(object):
+    """A bounded least-recently-used cache which counts the hits and misses of its lookups.
+
+    Subclasses define how keys are built, and may bound the cache by more than the
+    number of entries by overriding :meth:`_is_full`, :meth:`_added` and :meth:`_removed`.
+
+    Attributes
+    ----------
+    max_size : int
+        The maximum number of entries to keep
+    hits : int
+        The number of lookups which found an entry
+    misses : int
+        The number of lookups which did not find an entry
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+
+    def get(self, key):
+        """Look up the value stored under ``key``, counting the hit or miss
+
+        Returns
+        -------
+        object or None
+        """
+        try:
+            value = self._store.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._store[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._store:
+            self._removed(self._store.pop(key))
+        self._store[key] = value
+        self._added(value)
+        while self._store and self._is_full():
+            _, evicted = self._store.popitem(last=False)
+            self._removed(evicted)
+
+    def _is_full(self):
+        return len(self._store) > self.max_size
+
+    def _added(self, value):
+        pass
+
+    def _removed(self, value):
+        pass
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / float(total)
+
+    def clear(self):
+        self._store.clear()
+
+    def __len__(self):
+        return len(self._store)
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({size}/{self.max_size}, hits={self.hits}, misses={self.misses})".format(
+            self=self, size=len(self))
+
+
 class StateSpaceBase(object):
     def validate(self, start, end):
         raise NotImplementedError()
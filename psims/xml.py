@@ -428,6 +428,28 @@ class CVParam(TagBase):
         super(CVParam, self).__init__(self.tag_name, **attrs)
         self.patch_accession(accession, ref)
 
+    @classmethod
+    def from_prototype(cls, attrs, value=None):
+        """Build a parameter from an already resolved and normalized set of attributes,
+        as captured from :attr:`attrs` of an earlier instance, skipping all normalization.
+
+        Parameters
+        ----------
+        attrs : tuple
+            The ``(key, value)`` pairs of the prototype's attributes, in order
+        value : object, optional
+            The value of the new parameter
+
+        Returns
+        -------
+        :class:`CVParam`
+        """
+        inst = cls.__new__(cls)
+        TagBase.__init__(inst, cls.tag_name)
+        inst.attrs = dict(attrs)
+        inst.attrs['value'] = value if value is not None else ''
+        return inst
+
     @property
     def value(self):
         return self.attrs.get("value")
@@ -716,6 +738,8 @@ class XMLFormattingStreamWriter(object):
 
     Attributes
     ----------
+    encoding : str or None
+        The encoding of the XML written
     indent_chars : str
         The characters to indent with
     indent_level : int
@@ -733,6 +757,7 @@ class XMLFormattingStreamWriter(object):
 
     def __init__(self, stream, encoding=None, indent='  ', **kwargs):
         self.stream = stream
+        self.encoding = encoding
         self.xmlfile = etree.xmlfile(self.stream, encoding=encoding, buffered=False, **kwargs)
         self.writer = None
         self.indent_level = 0
@@ -772,6 +797,34 @@ class XMLFormattingStreamWriter(object):
                 self._indent_tag()
         self.writer.write(*args, **kwargs)
 
+    def write_raw(self, data):
+        """Write pre-rendered markup directly to the underlying stream, after
+        flushing anything the XML writer has buffered
+
+        Parameters
+        ----------
+        data : bytes
+            The encoded markup to write
+        """
+        self.writer.flush()
+        self.stream.write(data)
+
+    def write_text_chunks(self, chunks):
+        """Write a sequence of pieces of text as one contiguous run of text,
+        formatted as if they had been written in a single call to :meth:`write`
+
+        Parameters
+        ----------
+        chunks : :class:`Iterable`
+            The pieces of text to write
+        """
+        chunks = iter(chunks)
+        for chunk in chunks:
+            self.write(chunk)
+            break
+        for chunk in chunks:
+            self.writer.write(chunk)
+
     def flush(self):
         self.writer.flush()
 